@@ -13,11 +13,16 @@ from imaplib import IMAP4
 from inbox.sendmail.base import generate_attachments
 from inbox.sendmail.message import create_email
 from inbox.util.misc import imap_folder_path
+from inbox.util.itert import chunk
 
 log = get_logger()
 
 PROVIDER = 'generic'
 
+# The most UIDs sent in a single STORE/COPY command, to keep command lines
+# within what servers accept.
+MAX_UIDS_PER_COMMAND = 1000
+
 __all__ = ['set_remote_starred', 'set_remote_unread', 'remote_move',
            'remote_save_draft', 'remote_delete_draft', 'remote_create_folder',
            'remote_update_folder', 'remote_delete_folder']
@@ -28,15 +33,23 @@ __all__ = ['set_remote_starred', 'set_remote_unread', 'remote_move',
 # * should add support for rolling back message.categories() on failure.
 
 
-def uids_by_folder(message_id, db_session):
-    results = db_session.query(ImapUid.msg_uid, Folder.name).join(Folder). \
-        filter(ImapUid.message_id == message_id).all()
+def uids_by_folder(message_ids, db_session):
+    """ Returns the UIDs of the messages `message_ids`, by folder name. """
     mapping = defaultdict(list)
-    for uid, folder_name in results:
-        mapping[folder_name].append(uid)
+    for ids in chunk(message_ids, MAX_UIDS_PER_COMMAND):
+        results = db_session.query(ImapUid.msg_uid, Folder.name). \
+            join(Folder).filter(ImapUid.message_id.in_(ids)).all()
+        for uid, folder_name in results:
+            mapping[folder_name].append(uid)
     return mapping
 
 
+def uid_sets(uids):
+    """ Split `uids` into sorted sets of at most MAX_UIDS_PER_COMMAND. """
+    return [list(uid_set) for uid_set in
+            chunk(sorted(set(uids)), MAX_UIDS_PER_COMMAND)]
+
+
 def _create_email(account, message):
     blocks = [p.block for p in message.attachments]
     attachments = generate_attachments(blocks)
@@ -56,42 +69,44 @@ def _create_email(account, message):
     return msg
 
 
-def _set_flag(account_id, message_id, flag_name, is_add):
+def _set_flag(account_id, message_ids, flag_name, is_add):
     with session_scope(account_id) as db_session:
-        uids_for_message = uids_by_folder(message_id, db_session)
-    if not uids_for_message:
-        log.warning('No UIDs found for message', message_id=message_id)
+        uids_for_messages = uids_by_folder(message_ids, db_session)
+    if not uids_for_messages:
+        log.warning('No UIDs found for messages', message_ids=message_ids)
         return
 
     with writable_connection_pool(account_id).get() as crispin_client:
-        for folder_name, uids in uids_for_message.items():
+        for folder_name, uids in uids_for_messages.items():
             crispin_client.select_folder(folder_name, uidvalidity_cb)
-            if is_add:
-                crispin_client.conn.add_flags(uids, [flag_name])
-            else:
-                crispin_client.conn.remove_flags(uids, [flag_name])
+            for uid_set in uid_sets(uids):
+                if is_add:
+                    crispin_client.conn.add_flags(uid_set, [flag_name])
+                else:
+                    crispin_client.conn.remove_flags(uid_set, [flag_name])
 
 
-def set_remote_starred(account, message_id, starred):
-    _set_flag(account, message_id, '\\Flagged', starred)
+def set_remote_starred(account, message_ids, starred):
+    _set_flag(account, message_ids, '\\Flagged', starred)
 
 
-def set_remote_unread(account, message_id, unread):
-    _set_flag(account, message_id, '\\Seen', not unread)
+def set_remote_unread(account, message_ids, unread):
+    _set_flag(account, message_ids, '\\Seen', not unread)
 
 
-def remote_move(account_id, message_id, destination):
+def remote_move(account_id, message_ids, destination):
     with session_scope(account_id) as db_session:
-        uids_for_message = uids_by_folder(message_id, db_session)
-    if not uids_for_message:
-        log.warning('No UIDs found for message', message_id=message_id)
+        uids_for_messages = uids_by_folder(message_ids, db_session)
+    if not uids_for_messages:
+        log.warning('No UIDs found for messages', message_ids=message_ids)
         return
 
     with writable_connection_pool(account_id).get() as crispin_client:
-        for folder_name, uids in uids_for_message.items():
+        for folder_name, uids in uids_for_messages.items():
             crispin_client.select_folder(folder_name, uidvalidity_cb)
-            crispin_client.conn.copy(uids, destination)
-            crispin_client.delete_uids(uids)
+            for uid_set in uid_sets(uids):
+                crispin_client.conn.copy(uid_set, destination)
+                crispin_client.delete_uids(uid_set)
 
 
 def remote_create_folder(account_id, category_id):
@@ -2,7 +2,7 @@
 
 import imapclient
 from inbox.crispin import writable_connection_pool
-from inbox.actions.backends.generic import uids_by_folder
+from inbox.actions.backends.generic import uids_by_folder, uid_sets
 from inbox.mailsync.backends.imap.generic import uidvalidity_cb
 from inbox.models.category import Category
 from inbox.models.session import session_scope
@@ -17,17 +17,19 @@ def _encode_labels(labels):
     return map(imapclient.imap_utf7.encode, labels)
 
 
-def remote_change_labels(account_id, message_id, removed_labels, added_labels):
+def remote_change_labels(account_id, message_ids, removed_labels,
+                         added_labels):
     with session_scope(account_id) as db_session:
-        uids_for_message = uids_by_folder(message_id, db_session)
+        uids_for_messages = uids_by_folder(message_ids, db_session)
 
     with writable_connection_pool(account_id).get() as crispin_client:
-        for folder_name, uids in uids_for_message.items():
+        for folder_name, uids in uids_for_messages.items():
             crispin_client.select_folder(folder_name, uidvalidity_cb)
-            crispin_client.conn.add_gmail_labels(
-                uids, _encode_labels(added_labels))
-            crispin_client.conn.remove_gmail_labels(
-                uids, _encode_labels(removed_labels))
+            for uid_set in uid_sets(uids):
+                crispin_client.conn.add_gmail_labels(
+                    uid_set, _encode_labels(added_labels))
+                crispin_client.conn.remove_gmail_labels(
+                    uid_set, _encode_labels(removed_labels))
 
 
 def remote_create_label(account_id, category_id):
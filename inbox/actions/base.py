@@ -45,24 +45,40 @@ log = get_logger()
 
 
 def mark_unread(account_id, message_id, args):
+    mark_unread_multiple(account_id, [message_id], args)
+
+
+def mark_unread_multiple(account_id, message_ids, args):
     unread = args['unread']
-    set_remote_unread(account_id, message_id, unread)
+    set_remote_unread(account_id, message_ids, unread)
 
 
 def mark_starred(account_id, message_id, args):
+    mark_starred_multiple(account_id, [message_id], args)
+
+
+def mark_starred_multiple(account_id, message_ids, args):
     starred = args['starred']
-    set_remote_starred(account_id, message_id, starred)
+    set_remote_starred(account_id, message_ids, starred)
 
 
 def move(account_id, message_id, args):
+    move_multiple(account_id, [message_id], args)
+
+
+def move_multiple(account_id, message_ids, args):
     destination = args['destination']
-    remote_move(account_id, message_id, destination)
+    remote_move(account_id, message_ids, destination)
 
 
 def change_labels(account_id, message_id, args):
+    change_labels_multiple(account_id, [message_id], args)
+
+
+def change_labels_multiple(account_id, message_ids, args):
     added_labels = args['added_labels']
     removed_labels = args['removed_labels']
-    remote_change_labels(account_id, message_id, removed_labels,
+    remote_change_labels(account_id, message_ids, removed_labels,
                          added_labels)
 
 
@@ -0,0 +1,182 @@
+"""
+Internal endpoints for trusted backend services. These are not scoped to a
+namespace, so they're authenticated with the ADMIN_API_KEY shared secret
+instead of a namespace access token, and are disabled unless that's set.
+
+"""
+import hmac
+
+from flask import (request, g, Blueprint, make_response, Response,
+                   stream_with_context)
+from flask import jsonify as flask_jsonify
+
+from inbox.api.err import APIException, InputError
+from inbox.models.namespace_cache import resolve_namespace
+from inbox.api.validation import valid_public_id, valid_delta_object_types
+from inbox.config import config
+from inbox.ignition import long_held_connections
+from inbox.instrumentation import handle_query_profiler_request
+from inbox.models import Namespace
+from inbox.models.session import session_scope_by_shard_id
+from inbox.transactions import delta_sync
+from nylas.logging import get_logger
+log = get_logger()
+
+# Upper bound on the number of namespaces multiplexed onto one stream.
+MAX_STREAMING_NAMESPACES = 10000
+
+app = Blueprint(
+    'admin_api',
+    __name__,
+    url_prefix='/admin')
+
+
+@app.before_request
+def auth():
+    admin_key = config.get('ADMIN_API_KEY')
+    if not admin_key:
+        return make_response(('Not found', 404))
+
+    if request.authorization and request.authorization.username:
+        key = request.authorization.username
+    else:
+        parts = request.headers.get('Authorization', '').split()
+        key = parts[1] if len(parts) == 2 and \
+            parts[0].lower() == 'bearer' else None
+
+    if not _key_matches(key, admin_key):
+        return make_response((
+            "Could not verify access credential.", 401,
+            {'WWW-Authenticate': 'Basic realm="Admin API '
+             'Access Token Required"'}))
+
+
+def _key_matches(key, admin_key):
+    if key is None:
+        return False
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    if isinstance(admin_key, unicode):
+        admin_key = admin_key.encode('utf-8')
+    # Constant-time, so the key can't be guessed from response timings.
+    return hmac.compare_digest(key, admin_key)
+
+
+@app.errorhandler(APIException)
+def handle_input_error(error):
+    log.info('Returning API error to client', error=error)
+    response = flask_jsonify(message=error.message,
+                             type='invalid_request_error')
+    response.status_code = error.status_code
+    return response
+
+
+@app.route('/delta/streaming', methods=['POST'])
+def multi_namespace_stream_changes():
+    """
+    Stream deltas for many namespaces over a single connection. The request
+    body has the form:
+
+        {"cursors": {<namespace public id>: <cursor>, ...},
+         "timeout": <seconds>,
+         "exclude_types": "<comma separated types>",
+         "include_types": "<comma separated types>"}
+
+    All namespaces must be on the same shard. Each streamed delta has an
+    additional `namespace_id` field with the public id of its namespace.
+
+    """
+    data = request.get_json(force=True)
+    if not isinstance(data, dict):
+        raise InputError('Request body must be a JSON object')
+    cursors = data.get('cursors')
+    if not isinstance(cursors, dict) or not cursors:
+        raise InputError('Request body must contain a non-empty "cursors" '
+                         'object mapping namespace ids to cursors')
+    if len(cursors) > MAX_STREAMING_NAMESPACES:
+        raise InputError('Too many namespaces (at most {})'.format(
+            MAX_STREAMING_NAMESPACES))
+
+    exclude_types = data.get('exclude_types')
+    include_types = data.get('include_types')
+    if exclude_types is not None:
+        exclude_types = valid_delta_object_types(exclude_types)
+    if include_types is not None:
+        include_types = valid_delta_object_types(include_types)
+    if include_types and exclude_types:
+        raise InputError('Cannot specify both include_types and '
+                         'exclude_types')
+    try:
+        timeout = float(data.get('timeout') or 1800)
+    except (TypeError, ValueError):
+        raise InputError('Invalid timeout')
+
+    records = {}
+    for public_id in cursors:
+        valid_public_id(public_id)
+        record = resolve_namespace(public_id)
+        if record is None:
+            raise InputError('Invalid namespace id {}'.format(public_id))
+        records[public_id] = record
+
+    shard_ids = {record.shard_id for record in records.values()}
+    if len(shard_ids) != 1:
+        raise InputError('All namespaces must be on the same shard')
+    shard_id = shard_ids.pop()
+
+    pointers = {}
+    with session_scope_by_shard_id(shard_id) as db_session:
+        namespaces = db_session.query(Namespace).filter(
+            Namespace.id.in_([r.namespace_id for r in records.values()])).all()
+        for public_id, cursor in cursors.iteritems():
+            namespace_id = records[public_id].namespace_id
+            if cursor == '0':
+                pointers[namespace_id] = 0
+                continue
+            pointer = delta_sync.get_transaction_id_for_cursor(
+                namespace_id, cursor, db_session)
+            if pointer is None:
+                raise InputError('Invalid cursor {}'.format(cursor))
+            pointers[namespace_id] = pointer
+        for namespace in namespaces:
+            db_session.expunge(namespace)
+
+    if len(namespaces) != len(records):
+        raise InputError('Invalid namespace ids')
+
+    poll_interval = config.get('STREAMING_API_POLL_INTERVAL', 1)
+    is_n1 = request.environ.get('IS_N1', False)
+    g.log = log.new(endpoint=request.endpoint, shard_id=shard_id,
+                    namespace_count=len(namespaces))
+    generator = delta_sync.multi_namespace_streaming_change_generator(
+        namespaces, transaction_pointers=pointers,
+        poll_interval=poll_interval, timeout=timeout,
+        exclude_types=exclude_types, include_types=include_types,
+        is_n1=is_n1)
+    return Response(stream_with_context(generator),
+                    mimetype='text/event-stream')
+
+
+@app.route('/sql_profile', methods=['GET', 'POST'])
+def sql_profile():
+    """
+    Per-statement and per-call-site SQL statistics for this API process.
+    POST {"enabled": true} to start profiling, {"enabled": false} to stop it
+    and {"reset": true} to clear the collected statistics.
+
+    """
+    return flask_jsonify(handle_query_profiler_request(request))
+
+
+@app.route('/db_connections')
+def db_connections():
+    """
+    The database connections this API process has had checked out for at
+    least `min_age` seconds (default 0), longest-held first.
+
+    """
+    try:
+        min_age = float(request.args.get('min_age', 0))
+    except ValueError:
+        raise InputError('Invalid min_age')
+    return flask_jsonify(connections=long_held_connections(min_age))
@@ -10,149 +10,195 @@ from inbox.models.event import RecurringEvent
 from inbox.sqlalchemy_ext.util import bakery
 
 
-def _threads_filters(namespace_id, thread_public_id, started_before,
-                     started_after, last_message_before, last_message_after,
-                     subject):
-    filters = [Thread.namespace_id == namespace_id]
+def _bake_category_filter(query, in_, param_dict):
+    """
+    Filter on a category matched by name, display name or public id. Assumes
+    the Category table has already been joined.
+
+    """
+    try:
+        valid_public_id(in_)
+        # Type conversion and bindparams interact poorly -- you can't do
+        # e.g.
+        # query.filter(or_(Category.name == bindparam('in_'),
+        #                  Category.public_id == bindparam('in_')))
+        # because the binary conversion defined by Category.public_id will
+        # be applied to the bound value prior to its insertion in the
+        # query. So we define another bindparam for the public_id:
+        param_dict['in_id'] = in_
+        query += lambda q: q.filter(
+            Category.namespace_id == bindparam('namespace_id'),
+            or_(Category.name == bindparam('in_'),
+                Category.display_name == bindparam('in_'),
+                Category.public_id == bindparam('in_id')))
+    except InputError:
+        query += lambda q: q.filter(
+            Category.namespace_id == bindparam('namespace_id'),
+            or_(Category.name == bindparam('in_'),
+                Category.display_name == bindparam('in_')))
+    return query
+
+
+def _any_email_bindparams(any_email, param_dict):
+    """
+    IN clauses need one bindparam per value, so queries filtering on
+    `any_email` are baked once per number of addresses.
+
+    """
+    names = []
+    for i, email in enumerate(any_email):
+        name = 'any_email_{}'.format(i)
+        param_dict[name] = email
+        names.append(name)
+    return names
+
+
+def _contact_subquery(session, by_thread, *criteria):
+    """
+    Returns a subquery selecting the ids (or, if `by_thread`, the thread ids)
+    of messages associated with contacts matching `criteria`.
+
+    """
+    if by_thread:
+        query = session.query(Message.thread_id). \
+            join(MessageContactAssociation)
+    else:
+        query = session.query(MessageContactAssociation.message_id)
+    return query.join(Contact). \
+        filter(Contact.namespace_id == bindparam('namespace_id'),
+               *criteria).subquery()
+
+
+def threads(namespace_id, subject, from_addr, to_addr, cc_addr, bcc_addr,
+            any_email, thread_public_id, started_before, started_after,
+            last_message_before, last_message_after, filename, in_, unread,
+            starred, limit, offset, view, db_session):
+    # Like messages_or_drafts below, this query is baked to avoid paying query
+    # compilation overhead on every request: every parameter that can vary
+    # between calls *must* be inserted via bindparam(), and any step whose
+    # structure depends on the arguments must add them to the cache key via
+    # query.add_criteria().
+
+    param_dict = {
+        'namespace_id': namespace_id,
+        'subject': subject,
+        'from_addr': from_addr,
+        'to_addr': to_addr,
+        'cc_addr': cc_addr,
+        'bcc_addr': bcc_addr,
+        'thread_public_id': thread_public_id,
+        'started_before': started_before,
+        'started_after': started_after,
+        'last_message_before': last_message_before,
+        'last_message_after': last_message_after,
+        'filename': filename,
+        'in_': in_,
+        'read': None if unread is None else not unread,
+        'starred': starred,
+        'limit': limit,
+        'offset': offset
+    }
+
+    if view == 'count':
+        query = bakery(lambda s: s.query(func.count(distinct(Thread.id))))
+    elif view == 'ids':
+        query = bakery(lambda s: s.query(Thread.public_id))
+    else:
+        query = bakery(lambda s: s.query(Thread))
+
+    if in_ is not None:
+        query += lambda q: q.join(Thread.messages). \
+            join(Message.messagecategories). \
+            join(MessageCategory.category)
+        query = _bake_category_filter(query, in_, param_dict)
+
+    query += lambda q: q.filter(
+        Thread.namespace_id == bindparam('namespace_id'))
+
     if thread_public_id is not None:
-        filters.append(Thread.public_id == thread_public_id)
+        query += lambda q: q.filter(
+            Thread.public_id == bindparam('thread_public_id'))
 
     if started_before is not None:
-        filters.append(Thread.subjectdate < started_before)
+        query += lambda q: q.filter(
+            Thread.subjectdate < bindparam('started_before'))
 
     if started_after is not None:
-        filters.append(Thread.subjectdate > started_after)
+        query += lambda q: q.filter(
+            Thread.subjectdate > bindparam('started_after'))
 
     if last_message_before is not None:
-        filters.append(Thread.recentdate < last_message_before)
+        query += lambda q: q.filter(
+            Thread.recentdate < bindparam('last_message_before'))
 
     if last_message_after is not None:
-        filters.append(Thread.recentdate > last_message_after)
+        query += lambda q: q.filter(
+            Thread.recentdate > bindparam('last_message_after'))
 
     if subject is not None:
-        filters.append(Thread.subject == subject)
-    return filters
-
-
-def _threads_subqueries(namespace_id, from_addr, to_addr, cc_addr, bcc_addr,
-                        any_email, filename, unread, starred, db_session):
-    subqueries = []
-    if from_addr is not None:
-        subqueries.append(db_session.query(Message.thread_id).
-                          join(MessageContactAssociation).
-                          join(Contact).
-                          filter(Contact.email_address == from_addr,
-                                 Contact.namespace_id == namespace_id,
-                                 MessageContactAssociation.field == 'from_addr').subquery())
-
-    if to_addr is not None:
-        subqueries.append(db_session.query(Message.thread_id).
-                          join(MessageContactAssociation).
-                          join(Contact).
-                          filter(Contact.email_address == to_addr,
-                                 Contact.namespace_id == namespace_id,
-                                 MessageContactAssociation.field == 'to_addr').subquery())
-
-    if cc_addr is not None:
-        subqueries.append(db_session.query(Message.thread_id).
-                          join(MessageContactAssociation).
-                          join(Contact).
-                          filter(Contact.email_address == cc_addr,
-                                 Contact.namespace_id == namespace_id,
-                                 MessageContactAssociation.field == 'cc_addr').subquery())
-
-    if bcc_addr is not None:
-        subqueries.append(db_session.query(Message.thread_id).
-                          join(MessageContactAssociation).
-                          join(Contact).
-                          filter(Contact.email_address == bcc_addr,
-                                 Contact.namespace_id == namespace_id,
-                                 MessageContactAssociation.field == 'bcc_addr').subquery())
+        query += lambda q: q.filter(Thread.subject == bindparam('subject'))
+
+    for field, value in (('from_addr', from_addr), ('to_addr', to_addr),
+                         ('cc_addr', cc_addr), ('bcc_addr', bcc_addr)):
+        if value is not None:
+            query.add_criteria(
+                lambda q, field=field: q.filter(Thread.id.in_(
+                    _contact_subquery(
+                        q.session, True,
+                        MessageContactAssociation.field == field,
+                        Contact.email_address == bindparam(field)))),
+                field)
 
     if any_email is not None:
-        subqueries.append(db_session.query(Message.thread_id).
-                          join(MessageContactAssociation).
-                          join(Contact).
-                          filter(Contact.email_address.in_(any_email),
-                                 Contact.namespace_id == namespace_id).subquery())
+        names = _any_email_bindparams(any_email, param_dict)
+        query.add_criteria(
+            lambda q: q.filter(Thread.id.in_(
+                _contact_subquery(
+                    q.session, True,
+                    Contact.email_address.in_([bindparam(n)
+                                               for n in names])))),
+            len(names))
 
     if filename is not None:
-        subqueries.append(db_session.query(Message.thread_id).
-                          join(Part).
-                          join(Block).
-                          filter(Block.filename == filename,
-                                 Block.namespace_id == namespace_id).subquery())
+        query += lambda q: q.filter(Thread.id.in_(
+            q.session.query(Message.thread_id).join(Part).join(Block).
+            filter(Block.filename == bindparam('filename'),
+                   Block.namespace_id == bindparam('namespace_id')).
+            subquery()))
 
     if unread is not None:
-        read = not unread
-        subqueries.append(db_session.query(Message.thread_id).
-                          filter(Message.namespace_id == namespace_id,
-                                 Message.is_read == read).subquery())
+        query += lambda q: q.filter(Thread.id.in_(
+            q.session.query(Message.thread_id).
+            filter(Message.namespace_id == bindparam('namespace_id'),
+                   Message.is_read == bindparam('read')).subquery()))
 
     if starred is not None:
-        subqueries.append(db_session.query(Message.thread_id).
-                          filter(Message.namespace_id == namespace_id,
-                                 Message.is_starred == starred).subquery())
-    return subqueries
-
-
-def _threads_join_category(thread_query, namespace_id, in_):
-    if in_ is not None:
-        category_filters = [Category.name == in_, Category.display_name == in_]
-        try:
-            valid_public_id(in_)
-            category_filters.append(Category.public_id == in_)
-        except InputError:
-            pass
-        return thread_query.join(Thread.messages). \
-            join(Message.messagecategories). \
-            join(MessageCategory.category). \
-            filter(Category.namespace_id == namespace_id,
-                   or_(*category_filters))
-    return thread_query
-
-
-def threads(namespace_id, subject, from_addr, to_addr, cc_addr, bcc_addr,
-            any_email, thread_public_id, started_before, started_after,
-            last_message_before, last_message_after, filename, in_, unread,
-            starred, limit, offset, view, db_session):
-
-    if view == 'count':
-        query = db_session.query(func.count(distinct(Thread.id)))
-    elif view == 'ids':
-        query = db_session.query(Thread.public_id)
-    else:
-        query = db_session.query(Thread)
-
-    filters = _threads_filters(namespace_id, thread_public_id, started_before,
-                               started_after, last_message_before,
-                               last_message_after, subject)
-
-    query = _threads_join_category(query, namespace_id, in_)
-    query = query.filter(*filters)
-    for subquery in _threads_subqueries(namespace_id, from_addr, to_addr,
-                                        cc_addr, bcc_addr, any_email, filename,
-                                        unread, starred, db_session):
-        query = query.filter(Thread.id.in_(subquery))
+        query += lambda q: q.filter(Thread.id.in_(
+            q.session.query(Message.thread_id).
+            filter(Message.namespace_id == bindparam('namespace_id'),
+                   Message.is_starred == bindparam('starred')).subquery()))
 
     if view == 'count':
-        return {"count": query.one()[0]}
+        res = query(db_session).params(**param_dict).one()[0]
+        return {"count": res}
 
     # Eager-load some objects in order to make constructing API
     # representations faster.
     if view != 'ids':
         expand = (view == 'expanded')
-        query = query.options(*Thread.api_loading_options(expand))
-
-    query = query.order_by(desc(Thread.recentdate)).limit(limit)
+        query.add_criteria(
+            lambda q: q.options(*Thread.api_loading_options(expand)), expand)
 
+    query += lambda q: q.order_by(desc(Thread.recentdate))
+    query += lambda q: q.limit(bindparam('limit'))
     if offset:
-        query = query.offset(offset)
+        query += lambda q: q.offset(bindparam('offset'))
 
     if view == 'ids':
-        return [x[0] for x in query.all()]
+        res = query(db_session).params(**param_dict).all()
+        return [x[0] for x in res]
 
-    return query.all()
+    return query(db_session).params(**param_dict).all()
 
 
 def messages_or_drafts(namespace_id, drafts, subject, from_addr, to_addr,
@@ -170,8 +216,10 @@ def messages_or_drafts(namespace_id, drafts, subject, from_addr, to_addr,
     # every request. This requires some attention: every parameter that can
     # vary between calls *must* be inserted via bindparam(), or else the first
     # value passed will be baked into the query and reused on each request.
-    # Subqueries (on contact tables) can't be properly baked, so we have to
-    # call query.spoil() on those code paths.
+    # Likewise, steps whose structure depends on the arguments (e.g. the
+    # number of `any_email` addresses) must be added with
+    # query.add_criteria(fn, *args) so that the args become part of the cache
+    # key.
 
     param_dict = {
         'namespace_id': namespace_id,
@@ -250,50 +298,26 @@ def messages_or_drafts(namespace_id, drafts, subject, from_addr, to_addr,
         query += lambda q: q.filter(
             Message.received_date > bindparam('received_after'))
 
-    if to_addr is not None:
-        query.spoil()
-        to_query = db_session.query(MessageContactAssociation.message_id). \
-            join(Contact).filter(
-                MessageContactAssociation.field == 'to_addr',
-                Contact.email_address == to_addr,
-                Contact.namespace_id == bindparam('namespace_id')).subquery()
-        query += lambda q: q.filter(Message.id.in_(to_query))
-
-    if from_addr is not None:
-        query.spoil()
-        from_query = db_session.query(MessageContactAssociation.message_id). \
-            join(Contact).filter(
-                MessageContactAssociation.field == 'from_addr',
-                Contact.email_address == from_addr,
-                Contact.namespace_id == bindparam('namespace_id')).subquery()
-        query += lambda q: q.filter(Message.id.in_(from_query))
-
-    if cc_addr is not None:
-        query.spoil()
-        cc_query = db_session.query(MessageContactAssociation.message_id). \
-            join(Contact).filter(
-                MessageContactAssociation.field == 'cc_addr',
-                Contact.email_address == cc_addr,
-                Contact.namespace_id == bindparam('namespace_id')).subquery()
-        query += lambda q: q.filter(Message.id.in_(cc_query))
-
-    if bcc_addr is not None:
-        query.spoil()
-        bcc_query = db_session.query(MessageContactAssociation.message_id). \
-            join(Contact).filter(
-                MessageContactAssociation.field == 'bcc_addr',
-                Contact.email_address == bcc_addr,
-                Contact.namespace_id == bindparam('namespace_id')).subquery()
-        query += lambda q: q.filter(Message.id.in_(bcc_query))
+    for field, value in (('to_addr', to_addr), ('from_addr', from_addr),
+                         ('cc_addr', cc_addr), ('bcc_addr', bcc_addr)):
+        if value is not None:
+            query.add_criteria(
+                lambda q, field=field: q.filter(Message.id.in_(
+                    _contact_subquery(
+                        q.session, False,
+                        MessageContactAssociation.field == field,
+                        Contact.email_address == bindparam(field)))),
+                field)
 
     if any_email is not None:
-        query.spoil()
-        any_email_query = db_session.query(
-            MessageContactAssociation.message_id).join(Contact). \
-            filter(Contact.email_address.in_(any_email),
-                   Contact.namespace_id == bindparam('namespace_id')). \
-            subquery()
-        query += lambda q: q.filter(Message.id.in_(any_email_query))
+        names = _any_email_bindparams(any_email, param_dict)
+        query.add_criteria(
+            lambda q: q.filter(Message.id.in_(
+                _contact_subquery(
+                    q.session, False,
+                    Contact.email_address.in_([bindparam(n)
+                                               for n in names])))),
+            len(names))
 
     if filename is not None:
         query += lambda q: q.join(Part).join(Block). \
@@ -301,26 +325,9 @@ def messages_or_drafts(namespace_id, drafts, subject, from_addr, to_addr,
                    Block.namespace_id == bindparam('namespace_id'))
 
     if in_ is not None:
-        query.spoil()
-        category_filters = [Category.name == bindparam('in_'),
-                            Category.display_name == bindparam('in_')]
-        try:
-            valid_public_id(in_)
-            category_filters.append(Category.public_id == bindparam('in_id'))
-            # Type conversion and bindparams interact poorly -- you can't do
-            # e.g.
-            # query.filter(or_(Category.name == bindparam('in_'),
-            #                  Category.public_id == bindparam('in_')))
-            # because the binary conversion defined by Category.public_id will
-            # be applied to the bound value prior to its insertion in the
-            # query. So we define another bindparam for the public_id:
-            param_dict['in_id'] = in_
-        except InputError:
-            pass
         query += lambda q: q.prefix_with('STRAIGHT_JOIN'). \
-            join(Message.messagecategories).join(MessageCategory.category). \
-            filter(Category.namespace_id == namespace_id,
-                   or_(*category_filters))
+            join(Message.messagecategories).join(MessageCategory.category)
+        query = _bake_category_filter(query, in_, param_dict)
 
     if view == 'count':
         res = query(db_session).params(**param_dict).one()[0]
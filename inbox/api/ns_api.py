@@ -17,7 +17,7 @@ from sqlalchemy.orm.exc import NoResultFound
 from nylas.logging import get_logger
 log = get_logger()
 from inbox.models import (Message, Block, Part, Thread, Namespace,
-                          Contact, Calendar, Event, Transaction,
+                          Contact, Calendar, Event,
                           DataProcessingCache, Category, MessageCategory)
 from inbox.models.event import RecurringEvent, RecurringEventOverride
 from inbox.models.category import EPOCH
@@ -46,9 +46,8 @@ from inbox.contacts.search import ContactSearchClient
 from inbox.sendmail.base import (create_message_from_json, update_draft,
                                  delete_draft, create_draft_from_mime,
                                  SendMailException)
-from inbox.ignition import engine_manager
 from inbox.models.action_log import schedule_action
-from inbox.models.session import new_session, session_scope
+from inbox.models.session import new_session, session_scope, engine_for_id
 from inbox.search.base import get_search_client, SearchBackendException
 from inbox.transactions import delta_sync
 from inbox.api.err import (err, APIException, NotFoundError, InputError,
@@ -63,6 +62,11 @@ DEFAULT_LIMIT = 100
 LONG_POLL_REQUEST_TIMEOUT = 120
 SEND_TIMEOUT = 60
 
+# GET endpoints that write to the database, and so can't use a read-only
+# session.
+WRITING_GET_ENDPOINTS = ('namespace_api.groups_intrinsic',
+                         'namespace_api.contact_rankings')
+
 app = Blueprint(
     'namespace_api',
     __name__,
@@ -92,8 +96,11 @@ if config.get('DEBUG_PROFILING_ON'):
 
 @app.before_request
 def start():
-    engine = engine_manager.get_for_id(g.namespace_id)
-    g.db_session = new_session(engine)
+    # Reads may be served by a replica.
+    read_only = request.method == 'GET' and \
+        request.endpoint not in WRITING_GET_ENDPOINTS
+    engine = engine_for_id(g.namespace_id, read_only)
+    g.db_session = new_session(engine, read_only=read_only)
     g.namespace = Namespace.get(g.namespace_id, g.db_session)
 
     if not g.namespace:
@@ -1472,6 +1479,18 @@ def multi_send_finish(draft_id):
 ##
 # Client syncing
 ##
+def _transaction_id_for_cursor(cursor):
+    pointer = delta_sync.get_transaction_id_for_cursor(
+        g.namespace.id, cursor, g.db_session)
+    if pointer is None and g.db_session.info.get('read_only'):
+        # The cursor may be for a transaction that the replica serving this
+        # request doesn't have yet.
+        with session_scope(g.namespace.id) as db_session:
+            pointer = delta_sync.get_transaction_id_for_cursor(
+                g.namespace.id, cursor, db_session)
+    return pointer
+
+
 @app.route('/delta')
 @app.route('/delta/longpoll')
 def sync_deltas():
@@ -1517,11 +1536,8 @@ def sync_deltas():
     if cursor == '0':
         start_pointer = 0
     else:
-        try:
-            start_pointer, = g.db_session.query(Transaction.id). \
-                filter(Transaction.public_id == cursor,
-                       Transaction.namespace_id == g.namespace.id).one()
-        except NoResultFound:
+        start_pointer = _transaction_id_for_cursor(cursor)
+        if start_pointer is None:
             raise InputError('Invalid cursor parameter')
 
     # The client wants us to wait until there are changes
@@ -1530,7 +1546,7 @@ def sync_deltas():
 
     start_time = time.time()
     while time.time() - start_time < timeout:
-        with session_scope(g.namespace.id) as db_session:
+        with session_scope(g.namespace.id, read_only=True) as db_session:
             deltas, _ = delta_sync.format_transactions_after_pointer(
                 g.namespace, start_pointer, db_session, args['limit'],
                 exclude_types, include_types, exclude_folders,
@@ -1637,12 +1653,9 @@ def stream_changes():
     if cursor == '0':
         transaction_pointer = 0
     else:
-        query_result = g.db_session.query(Transaction.id).filter(
-            Transaction.namespace_id == g.namespace.id,
-            Transaction.public_id == cursor).first()
-        if query_result is None:
+        transaction_pointer = _transaction_id_for_cursor(cursor)
+        if transaction_pointer is None:
             raise InputError('Invalid cursor {}'.format(args['cursor']))
-        transaction_pointer = query_result[0]
 
     # Hack to not keep a database session open for the entire (long) request
     # duration.
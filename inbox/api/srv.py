@@ -1,7 +1,6 @@
 from flask import Flask, request, jsonify, make_response, g
 from flask.ext.restful import reqparse
 from werkzeug.exceptions import default_exceptions, HTTPException
-from sqlalchemy.orm.exc import NoResultFound
 
 from inbox.api.kellogs import APIEncoder
 from nylas.logging import get_logger
@@ -10,11 +9,13 @@ from inbox.models.session import global_session_scope
 from inbox.api.validation import (bounded_str, ValidatableArgument,
                                   strict_parse_args, limit)
 from inbox.api.validation import valid_public_id
+from inbox.models.namespace_cache import resolve_namespace
 
 from ns_api import app as ns_api
 from ns_api import DEFAULT_LIMIT
 
 from inbox.webhooks.gpush_notifications import app as webhooks_api
+from inbox.api.admin import app as admin_api
 
 app = Flask(__name__)
 # Handle both /endpoint and /endpoint/ without redirecting.
@@ -41,7 +42,9 @@ for code in default_exceptions.iterkeys():
 def auth():
     """ Check for account ID on all non-root URLS """
     if request.path in ('/accounts', '/accounts/', '/') \
-            or request.path.startswith('/w/'):
+            or request.path.startswith('/w/') \
+            or request.path.startswith('/admin/'):
+        # The admin blueprint does its own authentication.
         return
 
     if not request.authorization or not request.authorization.username:
@@ -64,18 +67,15 @@ def auth():
     else:
         namespace_public_id = request.authorization.username
 
-    with global_session_scope() as db_session:
-        try:
-            valid_public_id(namespace_public_id)
-            namespace = db_session.query(Namespace) \
-                .filter(Namespace.public_id == namespace_public_id).one()
-            g.namespace_id = namespace.id
-            g.account_id = namespace.account.id
-        except NoResultFound:
-            return make_response((
-                "Could not verify access credential.", 401,
-                {'WWW-Authenticate': 'Basic realm="API '
-                 'Access Token Required"'}))
+    valid_public_id(namespace_public_id)
+    namespace = resolve_namespace(namespace_public_id)
+    if namespace is None:
+        return make_response((
+            "Could not verify access credential.", 401,
+            {'WWW-Authenticate': 'Basic realm="API '
+             'Access Token Required"'}))
+    g.namespace_id = namespace.namespace_id
+    g.account_id = namespace.account_id
 
 
 @app.after_request
@@ -131,3 +131,4 @@ def logout():
 
 app.register_blueprint(ns_api)
 app.register_blueprint(webhooks_api)  # /w/...
+app.register_blueprint(admin_api)  # /admin/...
@@ -8,7 +8,7 @@ from flanker.addresslib import address
 from inbox.config import config
 from inbox.models import Contact
 from inbox.models.session import session_scope
-from inbox.sqlalchemy_ext.util import safer_yield_per
+from inbox.sqlalchemy_ext.util import keyset_scan
 
 from sqlalchemy.orm import joinedload
 
@@ -191,7 +191,7 @@ def index_namespace(namespace_id):
             query = db_session.query(Contact).options(
                 joinedload("phone_numbers")).filter_by(
                     namespace_id=namespace_id)
-            for contact in safer_yield_per(query, Contact.id, 0, 1000):
+            for contact in keyset_scan(query, Contact.id, window=1000):
                 log.info("indexing", contact_id=contact.id)
                 current_records.add(long(contact.id))
                 contact_object = cloudsearch_contact_repr(contact)
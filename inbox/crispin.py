@@ -30,13 +30,14 @@ from backports import ssl
 from gevent import socket
 from gevent.lock import BoundedSemaphore
 from gevent.queue import Queue
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, with_polymorphic
 
+from inbox.config import config
 from inbox.util.concurrency import retry
 from inbox.util.itert import chunk
 from inbox.util.misc import or_none
 from inbox.basicauth import GmailSettingError
-from inbox.models.session import session_scope
+from inbox.models.session import session_scope, session_scope_by_shard_id
 from inbox.models.backends.imap import ImapAccount
 from inbox.models.backends.generic import GenericAccount
 from inbox.models.backends.gmail import GmailAccount
@@ -82,6 +83,42 @@ class FolderMissingError(Exception):
     pass
 
 
+# Account info loaded ahead of time by prewarm_account_info(), for the next
+# connection pool created for each account (if it's created soon enough).
+_prewarmed_account_info = {}
+PREWARMED_ACCOUNT_INFO_MAX_AGE = 600
+
+
+def _account_info(account):
+    return dict(sync_state=account.sync_state,
+                provider=account.provider,
+                provider_info=account.provider_info,
+                email_address=account.email_address,
+                auth_handler=account.auth_handler)
+
+
+def prewarm_account_info(account_ids):
+    """
+    Load the account info that connection pools need for all of
+    `account_ids` at once, with one query per shard (per thousand accounts),
+    rather than one query per pool as each account's sync starts.
+    """
+    from inbox.ignition import engine_manager
+    by_shard = defaultdict(list)
+    for account_id in account_ids:
+        by_shard[engine_manager.shard_key_for_id(account_id)].append(
+            account_id)
+    for shard_id, shard_account_ids in by_shard.iteritems():
+        with session_scope_by_shard_id(shard_id) as db_session:
+            # Load the subclass columns (e.g. GenericAccount.provider) too.
+            accounts = with_polymorphic(ImapAccount, '*')
+            for chnk in chunk(shard_account_ids, 1000):
+                for account in db_session.query(accounts).filter(
+                        accounts.id.in_(chnk)):
+                    _prewarmed_account_info[account.id] = \
+                        (time.time(), _account_info(account))
+
+
 def _get_connection_pool(account_id, pool_size, pool_map, readonly):
     with _lock_map[account_id]:
         if account_id not in pool_map:
@@ -107,7 +144,15 @@ def connection_pool(account_id, pool_size=3, pool_map=dict()):
     return _get_connection_pool(account_id, pool_size, pool_map, True)
 
 
-def writable_connection_pool(account_id, pool_size=1, pool_map=dict()):
+# How many read-write connections syncback may open to each account, i.e.
+# how many of an account's actions it may execute at the same time.
+WRITABLE_CONNECTIONS_PER_ACCOUNT = config.get(
+    'SYNCBACK_CONNECTIONS_PER_ACCOUNT', 2)
+
+
+def writable_connection_pool(account_id,
+                             pool_size=WRITABLE_CONNECTIONS_PER_ACCOUNT,
+                             pool_map=dict()):
     """ Per-account crispin connection pool, with *read-write* connections.
 
     Use like this:
@@ -185,17 +230,22 @@ class CrispinConnectionPool(object):
             self._sem.release()
 
     def _set_account_info(self):
-        with session_scope(self.account_id) as db_session:
-            account = db_session.query(ImapAccount).get(self.account_id)
-            self.sync_state = account.sync_state
-            self.provider = account.provider
-            self.provider_info = account.provider_info
-            self.email_address = account.email_address
-            self.auth_handler = account.auth_handler
-            if account.provider == 'gmail':
-                self.client_cls = GmailCrispinClient
-            else:
-                self.client_cls = CrispinClient
+        loaded_at, info = _prewarmed_account_info.pop(self.account_id,
+                                                      (None, None))
+        if info is None or \
+                time.time() - loaded_at > PREWARMED_ACCOUNT_INFO_MAX_AGE:
+            with session_scope(self.account_id) as db_session:
+                account = db_session.query(ImapAccount).get(self.account_id)
+                info = _account_info(account)
+        self.sync_state = info['sync_state']
+        self.provider = info['provider']
+        self.provider_info = info['provider_info']
+        self.email_address = info['email_address']
+        self.auth_handler = info['auth_handler']
+        if self.provider == 'gmail':
+            self.client_cls = GmailCrispinClient
+        else:
+            self.client_cls = CrispinClient
 
     def _new_raw_connection(self):
         """Returns a new, authenticated IMAPClient instance for the account."""
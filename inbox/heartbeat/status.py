@@ -45,9 +45,23 @@ def get_ping_status(account_ids, host=None, port=6379, threshold=ALIVE_EXPIRY):
         return accounts
 
 
-def clear_heartbeat_status(account_id, folder_id=None, device_id=None):
+def get_dead_folders(account_ids=None, host=None, port=6379,
+                     threshold=ALIVE_EXPIRY):
+    # Find the folders that haven't had a heartbeat for `threshold` seconds,
+    # across `account_ids` or all accounts, without fetching every folder.
+    store = HeartbeatStore.store(host, port)
+    expiry = time.time() - threshold
+    dead = store.get_dead_folders(expiry, account_ids)
+    return {account_id: AccountPing(account_id,
+                                    [FolderPing(int(fid), False, ts)
+                                     for (fid, ts) in folders])
+            for account_id, folders in dead.iteritems()}
+
+
+def clear_heartbeat_status(account_id, folder_id=None, device_id=None,
+                           host=None, port=6379):
     # Clears the status for the account, folder and/or device.
     # Returns the number of folders cleared.
-    store = HeartbeatStore.store()
+    store = HeartbeatStore.store(host, port)
     n = store.remove_folders(account_id, folder_id, device_id)
     return n
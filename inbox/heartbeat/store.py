@@ -1,5 +1,10 @@
 import time
 import itertools
+from collections import defaultdict
+
+import gevent
+
+from inbox.config import config
 from inbox.util.itert import chunk
 
 from nylas.logging import get_logger
@@ -11,6 +16,13 @@ log = get_logger()
 import inbox.heartbeat.config as heartbeat_config
 from inbox.heartbeat.config import (CONTACTS_FOLDER_ID, EVENTS_FOLDER_ID)
 
+# A folder's heartbeat is written at most once every
+# HEARTBEAT_PUBLISH_INTERVAL seconds (except for its first one, which is
+# written right away). Heartbeats that are due are batched up and written
+# every HEARTBEAT_FLUSH_INTERVAL seconds by the HeartbeatFlusher.
+HEARTBEAT_PUBLISH_INTERVAL = config.get('HEARTBEAT_PUBLISH_INTERVAL', 30)
+HEARTBEAT_FLUSH_INTERVAL = config.get('HEARTBEAT_FLUSH_INTERVAL', 10)
+
 
 def safe_failure(f):
     def wrapper(*args, **kwargs):
@@ -67,12 +79,22 @@ class HeartbeatStatusProxy(object):
         self.folder_id = folder_id
         self.device_id = device_id
         self.store = HeartbeatStore.store()
+        self.flusher = HeartbeatFlusher.flusher()
+        self.heartbeat_at = None
+        self.published_at = None
 
     @safe_failure
     def publish(self, **kwargs):
         try:
             self.heartbeat_at = time.time()
-            self.store.publish(self.key, self.heartbeat_at)
+            if self.published_at is None:
+                self.store.publish(self.key, self.heartbeat_at)
+            elif (self.heartbeat_at - self.published_at <
+                    HEARTBEAT_PUBLISH_INTERVAL):
+                return
+            else:
+                self.flusher.add(self.key, self.heartbeat_at)
+            self.published_at = self.heartbeat_at
         except Exception:
             log = get_logger()
             log.error('Error while writing the heartbeat status',
@@ -83,10 +105,53 @@ class HeartbeatStatusProxy(object):
 
     @safe_failure
     def clear(self):
+        self.flusher.discard(self.key)
+        self.published_at = None
         self.store.remove_folders(self.account_id, self.folder_id,
                                   self.device_id)
 
 
+class HeartbeatFlusher(object):
+    """
+    Process-wide buffer of heartbeats, written to the store in one pipeline
+    per Redis shard every `interval` seconds by a background greenlet. Only
+    the latest heartbeat of each folder is kept.
+
+    """
+    _instance = None
+
+    def __init__(self, store=None, interval=HEARTBEAT_FLUSH_INTERVAL):
+        self.store = store or HeartbeatStore.store()
+        self.interval = interval
+        self.pending = {}
+        self.greenlet = None
+
+    @classmethod
+    def flusher(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def add(self, key, timestamp):
+        self.pending[key.key] = (key, timestamp)
+        if self.greenlet is None or self.greenlet.dead:
+            self.greenlet = gevent.spawn(self._run)
+
+    def discard(self, key):
+        self.pending.pop(key.key, None)
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.interval)
+            self.flush()
+
+    @safe_failure
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        if pending:
+            self.store.publish_many(pending.values())
+
+
 class HeartbeatStore(object):
     """ Store that proxies requests to Redis with handlers that also
         update indexes and handle scanning through results. """
@@ -107,6 +172,46 @@ class HeartbeatStore(object):
     def publish(self, key, timestamp):
         # Update indexes
         self.update_folder_index(key, float(timestamp))
+        self.update_accounts_index(key)
+
+    def _group_by_shard(self, account_ids):
+        """
+        Yields (client, account ids) for the Redis shards of `account_ids`,
+        in chunks small enough to pipeline.
+
+        """
+        shard_num = heartbeat_config.account_redis_shard_number
+        for _, group in itertools.groupby(sorted(account_ids, key=shard_num),
+                                          key=shard_num):
+            group = list(group)
+            client = heartbeat_config.get_redis_client(group[0])
+            # Because of the way pipelining works, redis buffers data.
+            # We break our requests in chunk to not have to ask for
+            # impossibly big numbers.
+            for chnk in chunk(group, 10000):
+                yield client, chnk
+
+    def publish_many(self, heartbeats):
+        """
+        Write the (key, timestamp) pairs `heartbeats`, with one pipeline per
+        Redis shard.
+
+        """
+        by_shard = defaultdict(list)
+        for key, timestamp in heartbeats:
+            shard = heartbeat_config.account_redis_shard_number(
+                key.account_id)
+            by_shard[shard].append((key, float(timestamp)))
+        for shard_heartbeats in by_shard.itervalues():
+            client = heartbeat_config.get_redis_client(
+                shard_heartbeats[0][0].account_id)
+            for chnk in chunk(shard_heartbeats, 10000):
+                pipe = client.pipeline(transaction=False)
+                for key, timestamp in chnk:
+                    self.update_folder_index(key, timestamp, pipe)
+                pipe.execute()
+        self.update_accounts_index_many({key.account_id
+                                         for key, _ in heartbeats})
 
     def remove(self, key, device_id=None):
         # Remove a key from the store, or device entry from a key.
@@ -133,37 +238,80 @@ class HeartbeatStore(object):
             return 1  # 1 item removed
         else:
             # Remove all folder timestamps and account-level indices
-            match = HeartbeatStatusKey.all_folders(account_id)
-
-            client = heartbeat_config.get_redis_client(account_id)
-            pipeline = client.pipeline()
-            n = 0
-            for key in client.scan_iter(match, 100):
-                self.remove(key, device_id, pipeline)
-                n += 1
+            return self.remove_accounts([account_id], device_id)
+
+    def remove_accounts(self, account_ids, device_id=None):
+        """
+        Remove the heartbeats of all the folders of `account_ids`, and the
+        accounts' indexes, with three pipelines per shard. If `device_id` is
+        given, only remove its entries, and the folders that it was the last
+        device with an entry for. Returns the number of folders removed.
+
+        """
+        removed = 0
+        for client, chnk in self._group_by_shard(account_ids):
+            pipe = client.pipeline(transaction=False)
+            for account_id in chnk:
+                pipe.zrange(account_id, 0, -1)
+            keys = [HeartbeatStatusKey(account_id, folder_id)
+                    for account_id, folder_ids in zip(chnk, pipe.execute())
+                    for folder_id in folder_ids]
+
+            if device_id:
+                pipe = client.pipeline(transaction=False)
+                for key in keys:
+                    pipe.hdel(key, device_id)
+                    pipe.hlen(key)
+                results = pipe.execute()
+                keys = [key for key, deleted, remaining in
+                        zip(keys, results[::2], results[1::2])
+                        if deleted and not remaining]
+
+            pipe = client.pipeline(transaction=False)
+            for key in keys:
+                if not device_id:
+                    pipe.delete(key)
+                self.remove_from_folder_index(key, pipe)
             if not device_id:
-                self.remove_from_account_index(account_id, pipeline)
-            pipeline.execute()
-            pipeline.reset()
-            return n
+                for account_id in chnk:
+                    self.remove_from_account_index(account_id, pipe)
+            pipe.execute()
+            removed += len(keys)
 
-    def update_folder_index(self, key, timestamp):
+        if device_id:
+            self.update_accounts_index_many(account_ids)
+        return removed
+
+    def update_folder_index(self, key, timestamp, client=None):
         assert isinstance(timestamp, float)
         # Update the folder timestamp index for this specific account, too
-        client = heartbeat_config.get_redis_client(key.account_id)
+        if client is None:
+            client = heartbeat_config.get_redis_client(key.account_id)
         client.zadd(key.account_id, timestamp, key.folder_id)
 
     def update_accounts_index(self, key):
-        # Find the oldest heartbeat from the account-folder index
-        try:
-            client = heartbeat_config.get_redis_client(key.account_id)
-            f, oldest_heartbeat = client.zrange(key.account_id, 0, 0,
-                                                withscores=True).pop()
-            client.zadd('account_index', oldest_heartbeat, key.account_id)
-        except:
-            # If all heartbeats were deleted at the same time as this, the pop
-            # will fail -- ignore it.
-            pass
+        self.update_accounts_index_many([key.account_id])
+
+    def update_accounts_index_many(self, account_ids):
+        """
+        Set the score of `account_ids` in the account index to their oldest
+        folder heartbeat (or remove them if they have none), with two
+        pipelines per shard.
+
+        """
+        for client, chnk in self._group_by_shard(account_ids):
+            pipe = client.pipeline(transaction=False)
+            for account_id in chnk:
+                pipe.zrange(account_id, 0, 0, withscores=True)
+            oldest = pipe.execute()
+
+            pipe = client.pipeline(transaction=False)
+            for account_id, folders in zip(chnk, oldest):
+                if folders:
+                    pipe.zadd('account_index', folders[0][1], account_id)
+                else:
+                    pipe.zrem('account_index', account_id)
+            pipe.execute()
 
     def remove_from_folder_index(self, key, client):
         client.zrem('folder_index', key)
@@ -184,34 +332,66 @@ class HeartbeatStore(object):
         # to multiple shards and return the results to a single caller.
         # Preferred method of querying for multiple accounts. Uses pipelining
         # to reduce the number of requests to redis.
-        account_ids_grouped_by_shards = []
+        results = dict()
+        for client, chnk in self._group_by_shard(account_ids):
+            pipe = client.pipeline()
+            for index in chnk:
+                pipe.zrange(index, 0, -1, withscores=True)
 
-        # A magic one-liner to group account ids by shard.
-        # http://stackoverflow.com/questions/8793772/how-to-split-a-sequence-according-to-a-predicate
-        shard_num = heartbeat_config.account_redis_shard_number
-        account_ids_grouped_by_shards = [
-            list(v[1]) for v in itertools.groupby(sorted(account_ids, key=shard_num), key=shard_num)
-        ]
+            pipe_results = pipe.execute()
 
-        results = dict()
-        for account_group in account_ids_grouped_by_shards:
-            if not account_group:
-                continue
+            for i, account_id in enumerate(chnk):
+                account_id = int(account_id)
+                results[account_id] = pipe_results[i]
 
-            client = heartbeat_config.get_redis_client(account_group[0])
+        return results
 
-            # Because of the way pipelining works, redis buffers data.
-            # We break our requests in chunk to not have to ask for
-            # impossibly big numbers.
-            for chnk in chunk(account_group, 10000):
-                pipe = client.pipeline()
-                for index in chnk:
-                    pipe.zrange(index, 0, -1, withscores=True)
+    def get_oldest_heartbeats(self, account_ids):
+        """
+        Returns a dict mapping those of `account_ids` that have any folder
+        heartbeats to the timestamp of their oldest one (according to the
+        account index), with one pipeline per shard.
 
-                pipe_results = pipe.execute()
+        """
+        results = dict()
+        for client, chnk in self._group_by_shard(account_ids):
+            pipe = client.pipeline(transaction=False)
+            for account_id in chnk:
+                pipe.zscore('account_index', account_id)
+            for account_id, timestamp in zip(chnk, pipe.execute()):
+                if timestamp is not None:
+                    results[int(account_id)] = timestamp
+        return results
 
-                for i, account_id in enumerate(chnk):
-                    account_id = int(account_id)
-                    results[account_id] = pipe_results[i]
+    def get_dead_folders(self, cutoff, account_ids=None):
+        """
+        Find the folders whose last heartbeat is older than the timestamp
+        `cutoff`, among the folders of `account_ids`, or of all accounts.
+        Without `account_ids`, only the accounts whose oldest heartbeat is
+        older than `cutoff` (according to the account index) are looked at.
+
+        Returns
+        -------
+        dict
+            Maps account ids to lists of (folder id, timestamp) pairs.
+
+        """
+        if account_ids is None:
+            account_ids = []
+            for shard_num in range(len(heartbeat_config.REDIS_SHARDS)):
+                # Shard numbers are valid account ids for their shard.
+                client = heartbeat_config.get_redis_client(shard_num)
+                account_ids.extend(int(account_id) for account_id in
+                                   client.zrangebyscore('account_index',
+                                                        '-inf', cutoff))
 
+        results = dict()
+        for client, chnk in self._group_by_shard(account_ids):
+            pipe = client.pipeline(transaction=False)
+            for account_id in chnk:
+                pipe.zrangebyscore(account_id, '-inf', cutoff,
+                                   withscores=True)
+            for account_id, folders in zip(chnk, pipe.execute()):
+                if folders:
+                    results[int(account_id)] = folders
         return results
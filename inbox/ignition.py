@@ -1,6 +1,9 @@
 import time
+import random
 import weakref
+import itertools
 import gevent
+from collections import defaultdict
 from socket import gethostname
 from urllib import quote_plus as urlquote
 from sqlalchemy import create_engine, event
@@ -18,11 +21,98 @@ DB_POOL_SIZE = config.get_required('DB_POOL_SIZE')
 # Sane default of max overflow=5 if value missing in config.
 DB_POOL_MAX_OVERFLOW = config.get('DB_POOL_MAX_OVERFLOW') or 5
 DB_POOL_TIMEOUT = config.get('DB_POOL_TIMEOUT') or 60
+# Replicas lagging further than this (in seconds) aren't read from.
+DB_REPLICA_MAX_LAG = config.get('DB_REPLICA_MAX_LAG', 5)
+DB_REPLICA_LAG_CHECK_INTERVAL = config.get('DB_REPLICA_LAG_CHECK_INTERVAL', 5)
+
+
+# Source attribution (stack walking) is done for one in this many
+# connection checkouts.
+DB_POOL_SOURCE_SAMPLE_RATE = config.get('DB_POOL_SOURCE_SAMPLE_RATE') or 10
+# Seconds between reports of connection pool gauges.
+DB_POOL_METRICS_INTERVAL = config.get('DB_POOL_METRICS_INTERVAL') or 10
 
 
 pool_tracker = weakref.WeakKeyDictionary()
 
 
+class PoolMetrics(object):
+    """
+    Reports gauges for the connection pools of this process every
+    `interval` seconds, from a background greenlet, instead of on every
+    checkout. Besides the current number of checked out and overflow
+    connections, the peak number checked out since the last report is sent,
+    so that short bursts aren't missed.
+
+    """
+
+    def __init__(self, interval=DB_POOL_METRICS_INTERVAL):
+        self.interval = interval
+        # metric prefix -> pool
+        self.pools = {}
+        # metric prefix -> peak checkedout since the last report
+        self.peaks = {}
+        self._reporter = None
+
+    def register(self, metric_prefix, pool):
+        self.pools[metric_prefix] = pool
+        self.peaks[metric_prefix] = 0
+
+    def record_checkout(self, metric_prefix, checkedout):
+        if checkedout > self.peaks[metric_prefix]:
+            self.peaks[metric_prefix] = checkedout
+        # Started lazily, so that processes which fork after importing this
+        # module don't inherit the greenlet.
+        if self._reporter is None:
+            self._reporter = gevent.spawn(self._run)
+
+    def report(self):
+        for metric_prefix, pool in self.pools.items():
+            checkedout = pool.checkedout()
+            statsd_client.gauge(metric_prefix + '.checkedout', checkedout)
+            statsd_client.gauge(metric_prefix + '.checkedout_peak',
+                                max(self.peaks[metric_prefix], checkedout))
+            statsd_client.gauge(metric_prefix + '.overflow', pool.overflow())
+            self.peaks[metric_prefix] = checkedout
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.interval)
+            try:
+                self.report()
+            except Exception:
+                log.error('Error reporting pool metrics', exc_info=True)
+
+
+pool_metrics = PoolMetrics()
+
+
+def long_held_connections(min_age=0):
+    """
+    Returns the database connections that have been checked out for at
+    least `min_age` seconds, longest-held first. Where and why a connection
+    was checked out is only known for the sample of checkouts for which it
+    was recorded (see DB_POOL_SOURCE_SAMPLE_RATE).
+
+    """
+    now = time.time()
+    connections = []
+    for entry in pool_tracker.values():
+        age = now - entry['checkedout_at']
+        if age < min_age:
+            continue
+        context = entry['context']
+        connections.append({
+            'database': entry['database'],
+            'age': age,
+            'source': entry['source'],
+            'context': {k: str(v) for k, v in context.items()}
+            if context is not None else None
+        })
+    connections.sort(key=lambda c: c['age'], reverse=True)
+    return connections
+
+
 # See
 # https://github.com/PyMySQL/mysqlclient-python/blob/master/samples/waiter_gevent.py
 def gevent_waiter(fd, hub=gevent.hub.get_hub()):
@@ -54,36 +144,31 @@ def engine(database_name, database_uri, pool_size=DB_POOL_SIZE,
                                          'waiter': gevent_waiter,
                                          'connect_timeout': 60})
 
+    metric_prefix = '.'.join(['dbconn', database_name,
+                              gethostname().replace('.', '-'),
+                              str(config.get('PROCESS_NAME', 'unknown'))])
+    pool_metrics.register(metric_prefix, engine.pool)
+    checkouts = itertools.count()
+
     @event.listens_for(engine, 'checkout')
     def receive_checkout(dbapi_connection, connection_record,
                          connection_proxy):
-        '''Log checkedout and overflow when a connection is checked out'''
-        hostname = gethostname().replace(".", "-")
-        process_name = str(config.get("PROCESS_NAME", "unknown"))
-
-        statsd_client.gauge(".".join(
-            ["dbconn", database_name, hostname, process_name,
-             "checkedout"]),
-            connection_proxy._pool.checkedout())
-
-        statsd_client.gauge(".".join(
-            ["dbconn", database_name, hostname, process_name,
-             "overflow"]),
-            connection_proxy._pool.overflow())
-
-        # Keep track of where and why this connection was checked out.
-        log = get_logger()
-        context = log._context._dict.copy()
-        f, name = find_first_app_frame_and_name(ignores=['sqlalchemy',
-                                                         'inbox.ignition',
-                                                         'nylas.logging'])
-        source = '{}:{}'.format(name, f.f_lineno)
-
-        pool_tracker[dbapi_connection] = {
-            'source': source,
-            'context': context,
+        """Keep track of when (and, for a sample of checkouts, where and
+        why) this connection was checked out."""
+        pool_metrics.record_checkout(metric_prefix,
+                                     connection_proxy._pool.checkedout())
+        entry = {
+            'database': database_name,
+            'source': None,
+            'context': None,
             'checkedout_at': time.time()
         }
+        if next(checkouts) % DB_POOL_SOURCE_SAMPLE_RATE == 0:
+            f, name = find_first_app_frame_and_name(
+                ignores=['sqlalchemy', 'inbox.ignition', 'nylas.logging'])
+            entry['source'] = '{}:{}'.format(name, f.f_lineno)
+            entry['context'] = get_logger()._context._dict.copy()
+        pool_tracker[dbapi_connection] = entry
 
     @event.listens_for(engine, 'checkin')
     def receive_checkin(dbapi_connection, connection_record):
@@ -94,9 +179,25 @@ def engine(database_name, database_uri, pool_size=DB_POOL_SIZE,
 
 
 class EngineManager(object):
+    """
+    Creates and holds the engine for every shard.
+
+    Each entry in `databases` (the DATABASE_HOSTS config) may also list
+    read replicas of that database host:
+
+        "REPLICAS": [{"HOSTNAME": "...", "PORT": 3306}, ...]
+
+    in which case a replica engine is created for each of its shards too.
+    Credentials for a replica are looked up in `users` by its hostname,
+    falling back to those of the primary.
+
+    """
 
     def __init__(self, databases, users, include_disabled=False):
         self.engines = {}
+        self.replica_engines = defaultdict(list)
+        # (hostname, port) -> (time checked, lag in seconds or None)
+        self._replica_lag = {}
         keys = set()
         schema_names = set()
         use_proxysql = config.get('USE_PROXYSQL', False)
@@ -131,11 +232,68 @@ class EngineManager(object):
                                 port=port)
                 self.engines[key] = engine(schema_name, uri)
 
+                for i, replica in enumerate(database.get('REPLICAS', [])):
+                    replica_hostname = '127.0.0.1' if use_proxysql else \
+                        replica['HOSTNAME']
+                    replica_user = users.get(replica_hostname,
+                                             users[hostname])
+                    uri = build_uri(username=replica_user['USER'],
+                                    password=replica_user['PASSWORD'],
+                                    database_name=schema_name,
+                                    hostname=replica_hostname,
+                                    port=replica['PORT'])
+                    self.replica_engines[key].append(
+                        engine('{}-replica{}'.format(schema_name, i), uri))
+
     def shard_key_for_id(self, id_):
         return id_ >> 48
 
-    def get_for_id(self, id_):
-        return self.engines[self.shard_key_for_id(id_)]
+    def get_for_id(self, id_, read_only=False):
+        """
+        Returns the engine for the shard of `id_`. If `read_only` is True and
+        the shard has a replica that's no more than DB_REPLICA_MAX_LAG
+        seconds behind, returns that replica's engine instead.
+
+        """
+        key = self.shard_key_for_id(id_)
+        if read_only and self.replica_engines.get(key):
+            replicas = list(self.replica_engines[key])
+            random.shuffle(replicas)
+            for replica in replicas:
+                lag = self.replica_lag(replica)
+                if lag is not None and lag <= DB_REPLICA_MAX_LAG:
+                    return replica
+            statsd_client.incr('db.replica.fallback')
+        return self.engines[key]
+
+    def has_replicas(self, id_):
+        return bool(self.replica_engines.get(self.shard_key_for_id(id_)))
+
+    def replica_lag(self, replica):
+        """
+        Returns how many seconds the replica is behind its primary, or None
+        if it isn't replicating or can't be reached. This is checked at most
+        once every DB_REPLICA_LAG_CHECK_INTERVAL seconds per replica host.
+
+        """
+        host = (replica.url.host, replica.url.port)
+        now = time.time()
+        checked_at, lag = self._replica_lag.get(host, (None, None))
+        if checked_at is not None and \
+                now - checked_at < DB_REPLICA_LAG_CHECK_INTERVAL:
+            return lag
+        # Record the check before making it, so that concurrent callers keep
+        # using the previous value instead of all checking at once.
+        self._replica_lag[host] = (now, lag)
+        try:
+            status = replica.execute('SHOW SLAVE STATUS').first()
+            lag = status['Seconds_Behind_Master'] if status else None
+        except Exception:
+            log.warning('Error checking replica lag', host=host[0],
+                        port=host[1], exc_info=True)
+            lag = None
+        self._replica_lag[host] = (time.time(), lag)
+        return lag
 
 engine_manager = EngineManager(config.get_required('DATABASE_HOSTS'),
                                config.get_required('DATABASE_USERS'))
@@ -1,5 +1,7 @@
 import collections
 import math
+import random
+import re
 import signal
 import socket
 import sys
@@ -9,15 +11,18 @@ import gevent.hub
 import gevent._threading  # This is a clone of the *real* threading module
 import greenlet
 import psutil
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from inbox.config import config
 from inbox.util.concurrency import retry_with_logging
-from inbox.util.stats import get_statsd_client
-from nylas.logging import get_logger
+from inbox.util.stats import get_statsd_client, statsd_client
+from nylas.logging import get_logger, find_first_app_frame_and_name
 
 
 MAX_BLOCKING_TIME = 5
 GREENLET_SAMPLING_INTERVAL = 1
 LOGGING_INTERVAL = 60
+N_PLUS_ONE_THRESHOLD = config.get('SQL_PROFILING_N_PLUS_ONE_THRESHOLD', 10)
 
 
 class ProfileCollector(object):
@@ -221,3 +226,218 @@ class GreenletTracer(object):
         except Exception:
             if sys is not None:
                 raise
+
+
+class QueryStats(object):
+    """Aggregated statistics for one normalized statement at one call site.
+    Latencies are kept in a fixed-size reservoir sample so that percentiles
+    can be estimated in bounded memory."""
+
+    RESERVOIR_SIZE = 1000
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.
+        self.max_time = 0.
+        self.rows = 0
+        self.n_plus_one = 0
+        self.latencies = []
+
+    def record(self, elapsed, rows):
+        self.count += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        if rows > 0:
+            self.rows += rows
+        if len(self.latencies) < self.RESERVOIR_SIZE:
+            self.latencies.append(elapsed)
+        else:
+            i = random.randrange(self.count)
+            if i < self.RESERVOIR_SIZE:
+                self.latencies[i] = elapsed
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1,
+                                 int(p / 100. * len(latencies)))]
+        return {
+            'count': self.count,
+            'total_time': self.total_time,
+            'mean_time': self.total_time / self.count if self.count else None,
+            'p50_time': percentile(50),
+            'p95_time': percentile(95),
+            'p99_time': percentile(99),
+            'max_time': self.max_time,
+            'rows': self.rows,
+            'n_plus_one': self.n_plus_one
+        }
+
+
+class QueryProfiler(object):
+    """Opt-in SQL profiler: records the latency and number of rows of every
+    statement executed by this process, aggregated by normalized statement
+    and by the application call site that issued it, and reports statement
+    timings to statsd.
+
+    It also detects likely N+1 query patterns: the same statement issued from
+    the same call site `n_plus_one_threshold` or more times within a single
+    database transaction.
+
+    Profiling is disabled until enable() is called, and can be toggled at
+    runtime. While disabled, the cost is a single attribute check per
+    statement.
+
+    """
+
+    # Modules to skip when looking for the call site of a statement.
+    IGNORED_MODULES = ['sqlalchemy', 'inbox.sqlalchemy_ext',
+                       'inbox.instrumentation', 'inbox.models.session',
+                       'nylas.logging', 'contextlib']
+    MAX_NORMALIZED_STATEMENTS = 10000
+
+    _normalizers = [
+        (re.compile(r"'(?:[^'\\]|\\.)*'"), '?'),
+        (re.compile(r'%\(\w+\)s|%s'), '?'),
+        (re.compile(r'\b\d+\b'), '?'),
+        (re.compile(r'\s+'), ' '),
+        # Collapse IN lists and VALUES tuples of any length.
+        (re.compile(r'\(\?(?:, \?)*\)'), '(?)'),
+    ]
+
+    def __init__(self, n_plus_one_threshold=N_PLUS_ONE_THRESHOLD):
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.enabled = False
+        self._listening = False
+        self._started = None
+        self._stats = collections.defaultdict(QueryStats)
+        self._normalized = {}
+        self.log = get_logger()
+
+    def enable(self):
+        if not self._listening:
+            event.listen(Engine, 'before_cursor_execute',
+                         self._before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute',
+                         self._after_cursor_execute)
+            event.listen(Engine, 'commit', self._end_transaction)
+            event.listen(Engine, 'rollback', self._end_transaction)
+            self._listening = True
+        if not self.enabled:
+            self._started = time.time()
+            self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self._started = time.time()
+        self._stats = collections.defaultdict(QueryStats)
+
+    def stats(self, limit=100, sort='total_time'):
+        """Returns the statistics for the `limit` most expensive
+        (statement, call site) pairs, as a JSON-serializable dict."""
+        # dict.items() is atomic, so this is safe to call from the
+        # frontend thread while queries are being recorded.
+        summaries = []
+        for (statement, call_site), stats in self._stats.items():
+            summary = stats.summary()
+            summary['statement'] = statement
+            summary['call_site'] = call_site
+            summaries.append(summary)
+        summaries.sort(key=lambda s: s.get(sort), reverse=True)
+        return {
+            'enabled': self.enabled,
+            'elapsed': (time.time() - self._started
+                        if self._started is not None else 0),
+            'statements': len(summaries),
+            'queries': summaries[:limit]
+        }
+
+    def normalize(self, statement):
+        normalized = self._normalized.get(statement)
+        if normalized is None:
+            normalized = statement
+            for pattern, replacement in self._normalizers:
+                normalized = pattern.sub(replacement, normalized)
+            normalized = normalized.strip()
+            if len(self._normalized) >= self.MAX_NORMALIZED_STATEMENTS:
+                self._normalized.clear()
+            self._normalized[statement] = normalized
+        return normalized
+
+    def _call_site(self):
+        frame, modname = find_first_app_frame_and_name(
+            ignores=self.IGNORED_MODULES)
+        if frame is None:
+            return 'unknown', 'unknown'
+        return ('{}:{}:{}'.format(modname, frame.f_code.co_name,
+                                  frame.f_lineno),
+                '{}.{}'.format(modname.replace('.', '-'),
+                               frame.f_code.co_name))
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        # Kept on the execution context rather than the connection, so
+        # that nothing is left behind when a statement raises.
+        if self.enabled and context is not None:
+            context._profiler_start_time = time.time()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        start_time = getattr(context, '_profiler_start_time', None)
+        if start_time is None or not self.enabled:
+            return
+        elapsed = time.time() - start_time
+        call_site, metric_suffix = self._call_site()
+        key = (self.normalize(statement), call_site)
+        stats = self._stats[key]
+        stats.record(elapsed, cursor.rowcount)
+        statsd_client.timing('db.query.{}.{}'.format(conn.engine.url.database,
+                                                     metric_suffix),
+                             int(elapsed * 1000))
+
+        counts = conn.info.setdefault('profiler_transaction_counts', {})
+        counts[key] = counts.get(key, 0) + 1
+        if counts[key] == self.n_plus_one_threshold:
+            stats.n_plus_one += 1
+            statsd_client.incr('db.query.n_plus_one.{}'.format(metric_suffix))
+            if stats.n_plus_one == 1:
+                self.log.warning('Possible N+1 query', call_site=call_site,
+                                 statement=key[0],
+                                 count=self.n_plus_one_threshold)
+
+    def _end_transaction(self, conn):
+        conn.info.pop('profiler_transaction_counts', None)
+
+
+query_profiler = QueryProfiler()
+
+
+def handle_query_profiler_request(request):
+    """Shared implementation of the HTTP endpoints that control the query
+    profiler. POST requests take a JSON body with optional boolean `enabled`
+    and `reset` keys; all requests return the current statistics. GET
+    requests can pass `limit` and `sort` (e.g. 'count', 'p99_time',
+    'n_plus_one') query parameters."""
+    if request.method == 'POST':
+        data = request.get_json(force=True, silent=True) or {}
+        if data.get('enabled') is True:
+            query_profiler.enable()
+        elif data.get('enabled') is False:
+            query_profiler.disable()
+        if data.get('reset'):
+            query_profiler.reset()
+    try:
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        limit = 100
+    sort = request.args.get('sort', 'total_time')
+    if sort not in ('count', 'total_time', 'mean_time', 'p50_time',
+                    'p95_time', 'p99_time', 'max_time', 'rows',
+                    'n_plus_one'):
+        sort = 'total_time'
+    return query_profiler.stats(limit=limit, sort=sort)
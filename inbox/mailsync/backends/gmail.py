@@ -23,14 +23,16 @@ from __future__ import division
 from collections import OrderedDict
 from datetime import datetime, timedelta
 from gevent import kill, spawn, sleep
-from sqlalchemy.orm import joinedload, load_only
+from sqlalchemy import bindparam
+from sqlalchemy.orm import load_only
 
 from inbox.util.itert import chunk
+from inbox.sqlalchemy_ext.util import keyset_windows, existing_values
 from inbox.util.debug import bind_context
 
 from nylas.logging import get_logger
 from gevent.lock import Semaphore
-from inbox.models import Message, Folder, Namespace, Account, Label, Category
+from inbox.models import Message, Folder, Account, Label, Category
 from inbox.models.category import EPOCH
 from inbox.models.backends.imap import ImapFolderInfo, ImapUid, ImapThread
 from inbox.models.session import session_scope
@@ -226,12 +228,11 @@ class GmailFolderSyncEngine(FolderSyncEngine):
             remote_uids = sorted(crispin_client.all_uids(), key=int)
             with self.syncmanager_lock:
                 with session_scope(self.namespace_id) as db_session:
-                    local_uids = common.local_uids(self.account_id, db_session,
-                                                   self.folder_id)
+                    deleted_uids, unknown_uids = common.uid_diff(
+                        self.account_id, db_session, self.folder_id,
+                        remote_uids)
                 common.remove_deleted_uids(
-                    self.account_id, self.folder_id,
-                    set(local_uids) - set(remote_uids))
-                unknown_uids = set(remote_uids) - local_uids
+                    self.account_id, self.folder_id, deleted_uids)
                 with session_scope(self.namespace_id) as db_session:
                     self.update_uid_counts(
                         db_session, remote_uid_count=len(remote_uids),
@@ -295,22 +296,36 @@ class GmailFolderSyncEngine(FolderSyncEngine):
                 msg_uids = crispin_client.all_uids()
                 mapping = {g_msgid: msg_uid for msg_uid, g_msgid in
                            crispin_client.g_msgids(msg_uids).iteritems()}
-            imap_uid_entries = db_session.query(ImapUid)\
-                .options(load_only('msg_uid'),
-                         joinedload('message').load_only('g_msgid'))\
-                .filter_by(account_id=self.account_id,
-                           folder_id=self.folder_id)
-
-            chunk_size = 1000
-            for entry in imap_uid_entries.yield_per(chunk_size):
-                if entry.message.g_msgid in mapping:
-                    log.debug('X-GM-MSGID {} from UID {} to UID {}'.format(
-                        entry.message.g_msgid,
-                        entry.msg_uid,
-                        mapping[entry.message.g_msgid]))
-                    entry.msg_uid = mapping[entry.message.g_msgid]
-                else:
-                    db_session.delete(entry)
+            # Scan just the columns we need, a window at a time, and apply
+            # the changes with bulk statements rather than through the ORM,
+            # so that memory use doesn't grow with the size of the folder.
+            imapuid_table = ImapUid.__table__
+            imap_uid_entries = db_session.query(
+                ImapUid.id, ImapUid.msg_uid, Message.g_msgid). \
+                join(Message, ImapUid.message_id == Message.id). \
+                filter(ImapUid.account_id == self.account_id,
+                       ImapUid.folder_id == self.folder_id)
+            update_uid = imapuid_table.update(). \
+                where(imapuid_table.c.id == bindparam('imapuid_id')). \
+                values(msg_uid=bindparam('new_msg_uid'))
+
+            for entries in keyset_windows(imap_uid_entries, ImapUid.id,
+                                          window=1000):
+                updates = []
+                deleted_ids = []
+                for imapuid_id, msg_uid, g_msgid in entries:
+                    if g_msgid in mapping:
+                        log.debug('X-GM-MSGID {} from UID {} to UID {}'.format(
+                            g_msgid, msg_uid, mapping[g_msgid]))
+                        updates.append({'imapuid_id': imapuid_id,
+                                        'new_msg_uid': mapping[g_msgid]})
+                    else:
+                        deleted_ids.append(imapuid_id)
+                if updates:
+                    db_session.execute(update_uid, updates)
+                if deleted_ids:
+                    db_session.execute(imapuid_table.delete().where(
+                        imapuid_table.c.id.in_(deleted_ids)))
             log.debug('UIDVALIDITY from {} to {}'.format(
                 imap_folder_info_entry.uidvalidity, uidvalidity))
             imap_folder_info_entry.uidvalidity = uidvalidity
@@ -492,19 +507,6 @@ class GmailFolderSyncEngine(FolderSyncEngine):
 def g_msgids(namespace_id, session, in_):
     if not in_:
         return []
-    # Easiest way to account-filter Messages is to namespace-filter from
-    # the associated thread. (Messages may not necessarily have associated
-    # ImapUids.)
     in_ = {long(i) for i in in_}  # in case they are strings
-    if len(in_) > 1000:
-        # If in_ is really large, passing all the values to MySQL can get
-        # deadly slow. (Approximate threshold empirically determined)
-        query = session.query(Message.g_msgid).join(Namespace). \
-            filter(Message.namespace_id == namespace_id).all()
-        return sorted(g_msgid for g_msgid, in query if g_msgid in in_)
-    # But in the normal case that in_ only has a few elements, it's way better
-    # to not fetch a bunch of values from MySQL only to return a few of them.
-    query = session.query(Message.g_msgid). \
-        filter(Message.namespace_id == namespace_id,
-               Message.g_msgid.in_(in_)).all()
-    return {g_msgid for g_msgid, in query}
+    return existing_values(session, Message.g_msgid, in_,
+                           Message.namespace_id == namespace_id)
@@ -22,7 +22,7 @@ from inbox.models import Account, Message, Folder, ActionLog
 from inbox.models.backends.imap import ImapUid, ImapFolderInfo
 from inbox.models.session import session_scope
 from inbox.models.util import reconcile_message
-from inbox.sqlalchemy_ext.util import bakery
+from inbox.sqlalchemy_ext.util import bakery, ValueSet
 from nylas.logging import get_logger
 
 log = get_logger()
@@ -42,6 +42,28 @@ def local_uids(account_id, session, folder_id, limit=None):
     return {u for u, in results}
 
 
+def uid_diff(account_id, session, folder_id, remote_uids, new=True):
+    """
+    Compare the UIDs stored for a folder with the folder's `remote_uids`.
+    Large folders are compared in the database (see ValueSet) instead of by
+    loading every stored UID.
+
+    Returns
+    -------
+    (set, set)
+        The stored UIDs that aren't in `remote_uids`, and (unless `new` is
+        False, in which case None) the remote UIDs that aren't stored.
+
+    """
+    criteria = (ImapUid.account_id == account_id,
+                ImapUid.folder_id == folder_id)
+    with ValueSet(session, remote_uids, ImapUid.msg_uid.type) as remote:
+        deleted_uids = remote.extra(ImapUid.msg_uid, *criteria)
+        new_uids = remote.missing(ImapUid.msg_uid, *criteria) if new \
+            else None
+    return deleted_uids, new_uids
+
+
 def lastseenuid(account_id, session, folder_id):
     q = bakery(lambda session: session.query(func.max(ImapUid.msg_uid)))
     q += lambda q: q.filter(
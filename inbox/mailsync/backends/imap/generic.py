@@ -62,8 +62,10 @@ sessions reduce scalability.
 """
 from __future__ import division
 
+import hashlib
 from datetime import datetime, timedelta
 from gevent import Greenlet, kill, spawn, sleep
+from gevent.event import Event
 import imaplib
 from sqlalchemy import func
 from sqlalchemy.orm import load_only
@@ -74,7 +76,7 @@ from inbox.basicauth import ValidationError
 from inbox.util.concurrency import retry_with_logging
 from inbox.util.debug import bind_context
 from inbox.util.itert import chunk
-from inbox.util.misc import or_none
+from inbox.util.misc import or_none, dt_to_timestamp
 from inbox.util.threading import fetch_corresponding_thread, MAX_THREAD_LENGTH
 from inbox.util.stats import statsd_client
 from nylas.logging import get_logger
@@ -145,7 +147,11 @@ class FolderSyncEngine(Greenlet):
         self.state = None
         self.provider_name = provider_name
         self.last_fast_refresh = None
+        # Fingerprints of the last flags refresh response for each limit.
         self.flags_fetch_results = {}
+        # Set when the account is handed off to another process; the engine
+        # then exits as soon as whatever it's in the middle of is committed.
+        self.draining = Event()
         self.conn_pool = connection_pool(self.account_id)
 
         self.state_handlers = {
@@ -197,6 +203,7 @@ class FolderSyncEngine(Greenlet):
         # time if it receives a shutdown command. The shutdown command is
         # equivalent to ctrl-c.
         while True:
+            self.check_draining()
             old_state = self.state
             try:
                 self.state = self.state_handlers[old_state]()
@@ -252,6 +259,54 @@ class FolderSyncEngine(Greenlet):
                 # error. It's safe to reset the uidvalidity counter.
                 self.uidinvalid_count = 0
 
+    def drain(self):
+        """
+        Make the engine exit at the next point where all its work so far is
+        committed (see check_draining()), rather than wherever it happens to
+        be when killed.
+        """
+        self.draining.set()
+
+    def check_draining(self):
+        if self.draining.is_set():
+            log.info('Folder sync engine drained', account_id=self.account_id,
+                     folder_id=self.folder_id)
+            raise MailsyncDone()
+
+    def handoff_state(self):
+        """
+        Returns the state this engine has cached (and would otherwise have to
+        load from the database or rebuild from the remote), as a dict that
+        can be serialized as JSON and passed to resume_from() in another
+        process.
+        """
+        state = {'flags_fetch_results': self.flags_fetch_results}
+        for attr in ('uidvalidity', 'uidnext', 'highestmodseq'):
+            if hasattr(self, '_' + attr):
+                state[attr] = getattr(self, '_' + attr)
+        if getattr(self, '_last_slow_refresh', None) is not None:
+            state['last_slow_refresh'] = dt_to_timestamp(
+                self._last_slow_refresh)
+        if self.last_fast_refresh is not None:
+            state['last_fast_refresh'] = dt_to_timestamp(
+                self.last_fast_refresh)
+        return state
+
+    def resume_from(self, state):
+        """ Take on state handed off by an engine in another process. """
+        for attr in ('uidvalidity', 'uidnext', 'highestmodseq'):
+            if attr in state:
+                setattr(self, '_' + attr, state[attr])
+        if 'last_slow_refresh' in state:
+            self._last_slow_refresh = datetime.utcfromtimestamp(
+                state['last_slow_refresh'])
+        if 'last_fast_refresh' in state:
+            self.last_fast_refresh = datetime.utcfromtimestamp(
+                state['last_fast_refresh'])
+        self.flags_fetch_results = {
+            int(max_uids): fingerprint for max_uids, fingerprint in
+            state.get('flags_fetch_results', {}).items()}
+
     def _load_state(self):
         with session_scope(self.namespace_id) as db_session:
             try:
@@ -345,13 +400,11 @@ class FolderSyncEngine(Greenlet):
             remote_uids = crispin_client.all_uids()
             with self.syncmanager_lock:
                 with session_scope(self.namespace_id) as db_session:
-                    local_uids = common.local_uids(self.account_id, db_session,
-                                                   self.folder_id)
+                    deleted_uids, new_uids = common.uid_diff(
+                        self.account_id, db_session, self.folder_id,
+                        remote_uids)
                 common.remove_deleted_uids(
-                    self.account_id, self.folder_id,
-                    set(local_uids).difference(remote_uids))
-
-            new_uids = set(remote_uids).difference(local_uids)
+                    self.account_id, self.folder_id, deleted_uids)
             with session_scope(self.namespace_id) as db_session:
                 account = db_session.query(Account).get(self.account_id)
                 throttled = account.throttled
@@ -421,7 +474,8 @@ class FolderSyncEngine(Greenlet):
                 idling = False
         # Close IMAP connection before sleeping
         if not idling:
-            sleep(self.poll_frequency)
+            self.draining.wait(self.poll_frequency)
+        self.check_draining()
 
     def resync_uids_impl(self):
         # First, let's check if the UIVDALIDITY change was spurious, if
@@ -550,6 +604,7 @@ class FolderSyncEngine(Greenlet):
 
         log.info('Committed new UIDs',
                  new_committed_message_count=len(new_uids))
+        self.check_draining()
         # If we downloaded uids, record message velocity (#uid / latency)
         if self.state == 'initial' and len(new_uids):
             self._report_message_velocity(datetime.utcnow() - start,
@@ -680,9 +735,9 @@ class FolderSyncEngine(Greenlet):
                 self.highestmodseq = interim_highestmodseq
 
         with session_scope(self.namespace_id) as db_session:
-            local_uids = common.local_uids(self.account_id, db_session,
-                                           self.folder_id)
-            expunged_uids = set(local_uids).difference(remote_uids)
+            expunged_uids, _ = common.uid_diff(self.account_id, db_session,
+                                               self.folder_id, remote_uids,
+                                               new=False)
 
         if expunged_uids:
             # If new UIDs have appeared since we last checked in
@@ -725,8 +780,8 @@ class FolderSyncEngine(Greenlet):
                                            limit=max_uids)
 
         flags = crispin_client.flags(local_uids)
-        if (max_uids in self.flags_fetch_results and
-                self.flags_fetch_results[max_uids] == (local_uids, flags)):
+        fingerprint = flags_fingerprint(local_uids, flags)
+        if self.flags_fetch_results.get(max_uids) == fingerprint:
             # If the flags fetch response is exactly the same as the last one
             # we got, then we don't need to persist any changes.
             log.debug('Unchanged flags refresh response, '
@@ -740,7 +795,7 @@ class FolderSyncEngine(Greenlet):
         with session_scope(self.namespace_id) as db_session:
             common.update_metadata(self.account_id, self.folder_id,
                                    self.folder_role, flags, db_session)
-        self.flags_fetch_results[max_uids] = (local_uids, flags)
+        self.flags_fetch_results[max_uids] = fingerprint
 
     def check_uid_changes(self, crispin_client):
         self.get_new_uids(crispin_client)
@@ -830,6 +885,15 @@ class FolderSyncEngine(Greenlet):
         return select_info
 
 
+def flags_fingerprint(local_uids, flags):
+    """
+    A digest of a flags refresh response, so that responses can be compared
+    without keeping them around.
+    """
+    return hashlib.sha1(repr((sorted(local_uids),
+                              sorted(flags.items())))).hexdigest()
+
+
 class UidInvalid(Exception):
     """Raised when a folder's UIDVALIDITY changes, requiring a resync."""
     pass
@@ -1,17 +1,17 @@
-from gevent import sleep
+from gevent import sleep, joinall
+from gevent.event import Event
 from gevent.pool import Group
 from gevent.coros import BoundedSemaphore
 from sqlalchemy.orm import load_only
 from inbox.basicauth import ValidationError
 from nylas.logging import get_logger
-from inbox.crispin import retry_crispin, connection_pool
+from inbox.crispin import retry_crispin, connection_pool, RawFolder
 from inbox.models import Account, Folder, Category
 from inbox.models.constants import MAX_FOLDER_NAME_LENGTH
 from inbox.models.session import session_scope
 from inbox.mailsync.backends.base import BaseMailSyncMonitor
 from inbox.mailsync.backends.imap.generic import FolderSyncEngine
 from inbox.mailsync.backends.imap.s3 import S3FolderSyncEngine
-from inbox.mailsync.gc import DeleteHandler
 log = get_logger()
 
 
@@ -36,7 +36,10 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
         self.sync_engine_class = FolderSyncEngine
 
         self.folder_monitors = Group()
-        self.delete_handler = None
+        self.draining = Event()
+        # Folder sync engine state handed off by another process, by folder
+        # name.
+        self.resume_state = {}
 
         BaseMailSyncMonitor.__init__(self, account, heartbeat)
 
@@ -59,6 +62,37 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
 
         return sync_folders
 
+    def drain(self, timeout):
+        """
+        Stop starting folder sync engines, and have the running ones exit
+        once they've committed what they're in the middle of, waiting up to
+        `timeout` seconds for them. Returns the state to hand off to the
+        account's next sync process (see resume_from()).
+        """
+        self.draining.set()
+        engines = [engine for engine in self.folder_monitors
+                   if not isinstance(engine, S3FolderSyncEngine)]
+        for engine in engines:
+            engine.drain()
+        # S3 engines weren't told to drain, so don't wait for them.
+        joinall(engines, timeout=timeout)
+        return {
+            'remote_folders': self.saved_remote_folders,
+            'folders': {engine.folder_name: engine.handoff_state()
+                        for engine in engines}
+        }
+
+    def resume_from(self, state):
+        """
+        Take on state handed off by drain() in another process, so that we
+        don't redo the work it had already done. Must be called before the
+        monitor is started.
+        """
+        if state.get('remote_folders') is not None:
+            self.saved_remote_folders = [RawFolder(*folder) for folder in
+                                         state['remote_folders']]
+        self.resume_state = state.get('folders', {})
+
     def save_folder_names(self, db_session, raw_folders):
         """
         Save the folders present on the remote backend for an account.
@@ -124,6 +158,8 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
             s3_resync = account._sync_status.get('s3_resync', False)
 
         for folder_name in self.prepare_sync():
+            if self.draining.is_set():
+                return
             if folder_name in running_monitors:
                 thread = running_monitors[folder_name]
             else:
@@ -136,6 +172,8 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
                                                 self.email_address,
                                                 self.provider_name,
                                                 self.syncmanager_lock)
+                if folder_name in self.resume_state:
+                    thread.resume_from(self.resume_state.pop(folder_name))
                 self.folder_monitors.start(thread)
 
                 if s3_resync:
@@ -158,22 +196,13 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
                          folder_name=folder_name,
                          error=thread.exception)
 
-    def start_delete_handler(self):
-        if self.delete_handler is None:
-            self.delete_handler = DeleteHandler(
-                account_id=self.account_id,
-                namespace_id=self.namespace_id,
-                provider_name=self.provider_name,
-                uid_accessor=lambda m: m.imapuids)
-            self.delete_handler.start()
-
     def sync(self):
         try:
-            self.start_delete_handler()
             self.start_new_folder_sync_engines()
             while True:
                 sleep(self.refresh_frequency)
-                self.start_new_folder_sync_engines()
+                if not self.draining.is_set():
+                    self.start_new_folder_sync_engines()
         except ValidationError as exc:
             log.error(
                 'Error authenticating; stopping sync', exc_info=True,
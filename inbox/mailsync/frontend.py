@@ -3,7 +3,9 @@ import gevent._threading  # This is a clone of the *real* threading module
 from pympler import muppy, summary
 from werkzeug.serving import run_simple, WSGIRequestHandler
 from flask import Flask, jsonify, request
-from inbox.instrumentation import GreenletTracer, ProfileCollector
+from inbox.ignition import long_held_connections
+from inbox.instrumentation import (GreenletTracer, ProfileCollector,
+                                   handle_query_profiler_request)
 
 
 class HTTPFrontend(object):
@@ -37,12 +39,19 @@ class HTTPFrontend(object):
         @app.route('/unassign', methods=['POST'])
         def unassign_account():
             account_id = request.json['account_id']
-            ret = self.sync_service.stop_sync(account_id)
+            # Unless asked not to, let the sync finish what it's doing and
+            # hand off its state to the account's next sync process.
+            drain = request.json.get('drain', True)
+            ret = self.sync_service.stop_sync(account_id, drain=drain)
             if ret:
                 return 'OK'
             else:
                 return 'Account not assigned to this process', 409
 
+        @app.route('/startup')
+        def startup():
+            return jsonify(self.sync_service.startup_progress)
+
         @app.route('/profile')
         def profile():
             if self.profiler is None:
@@ -61,6 +70,18 @@ class HTTPFrontend(object):
                 self.tracer.reset()
             return resp
 
+        @app.route('/sql_profile', methods=['GET', 'POST'])
+        def sql_profile():
+            return jsonify(handle_query_profiler_request(request))
+
+        @app.route('/db_connections')
+        def db_connections():
+            try:
+                min_age = float(request.args.get('min_age', 0))
+            except ValueError:
+                return 'Invalid min_age\n', 400
+            return jsonify(connections=long_held_connections(min_age))
+
         @app.route('/mem')
         def mem():
             objs = muppy.get_objects()
@@ -1,17 +1,20 @@
 import datetime
+from collections import defaultdict
 
 import gevent
-from sqlalchemy import func
-from sqlalchemy.orm import load_only
+from sqlalchemy import exists
+from sqlalchemy.orm import load_only, subqueryload
 from nylas.logging import get_logger
 log = get_logger()
-from inbox.models import Message
+from inbox.models import Message, Thread
+from inbox.models.backends.imap import ImapUid
 from inbox.models.category import Category, EPOCH
 from inbox.models.message import MessageCategory
 from inbox.models.folder import Folder
-from inbox.models.session import session_scope
+from inbox.models.session import session_scope, session_scope_by_shard_id
 from inbox.util.concurrency import retry_with_logging
 from inbox.util.itert import chunk
+from inbox.util.throttle import get_throttle
 from inbox.mailsync.backends.imap import common
 from inbox.util.debug import bind_context
 from inbox.mailsync.backends.imap.generic import uidvalidity_cb
@@ -19,7 +22,7 @@ from inbox.crispin import connection_pool
 from imapclient.imap_utf7 import encode as utf7_encode
 
 DEFAULT_MESSAGE_TTL = 120
-MAX_FETCH = 1000
+BATCH_SIZE = 100
 
 
 class DeleteHandler(gevent.Greenlet):
@@ -35,34 +38,36 @@ class DeleteHandler(gevent.Greenlet):
 
     It also periodically deletes categories which have no associated messages.
 
+    One DeleteHandler covers all the IMAP accounts a sync process syncs. Each
+    check runs one query per shard for the marked messages of all those
+    accounts (using the namespace_id, deleted_at index), and deletes them in
+    batches of `batch_size`, with one transaction per batch, recomputing
+    each affected thread once per batch.
+
     Parameters
     ----------
-    account_id, namespace_id: int
-        IDs for the namespace to check.
-    uid_accessor: function
-        Function that takes a message and returns a list of associated uid
-        objects. For IMAP sync, this would just be
-        `uid_accessor=lambda m: m.imapuids`
+    namespace_ids: function
+        Function that returns the ids of the namespaces to check.
     message_ttl: int
         Number of seconds to wait after a message is marked for deletion before
         deleting it for good.
+    batch_size: int
+        Maximum number of messages to delete per transaction.
+    throttle: bool
+        Whether to rate-limit deletions per shard (see inbox.util.throttle).
 
     """
 
-    def __init__(self, account_id, namespace_id, provider_name, uid_accessor,
-                 message_ttl=DEFAULT_MESSAGE_TTL):
-        bind_context(self, 'deletehandler', account_id)
-        self.account_id = account_id
-        self.namespace_id = namespace_id
-        self.provider_name = provider_name
-        self.uids_for_message = uid_accessor
-        self.log = log.new(account_id=account_id)
+    def __init__(self, namespace_ids, message_ttl=DEFAULT_MESSAGE_TTL,
+                 batch_size=BATCH_SIZE, throttle=False):
+        self.namespace_ids = namespace_ids
         self.message_ttl = datetime.timedelta(seconds=message_ttl)
+        self.batch_size = batch_size
+        self.throttle = throttle
         gevent.Greenlet.__init__(self)
 
     def _run(self):
-        return retry_with_logging(self._run_impl, account_id=self.account_id,
-                                  provider=self.provider_name)
+        return retry_with_logging(self._run_impl, log)
 
     def _run_impl(self):
         while True:
@@ -71,76 +76,107 @@ class DeleteHandler(gevent.Greenlet):
             self.gc_deleted_categories()
             gevent.sleep(self.message_ttl.total_seconds())
 
+    def _namespace_ids_by_shard(self):
+        from inbox.ignition import engine_manager
+        by_shard = defaultdict(list)
+        for namespace_id in self.namespace_ids():
+            by_shard[engine_manager.shard_key_for_id(namespace_id)].append(
+                namespace_id)
+        return by_shard
+
     def check(self, current_time):
-        with session_scope(self.namespace_id) as db_session:
-            dangling_messages = db_session.query(Message).filter(
-                Message.namespace_id == self.namespace_id,
-                Message.deleted_at <= current_time - self.message_ttl
-            ).limit(MAX_FETCH)
-            for message in dangling_messages:
-                # If the message isn't *actually* dangling (i.e., it has
-                # imapuids associated with it), undelete it.
-                if self.uids_for_message(message):
-                    message.deleted_at = None
-                    continue
-
-                thread = message.thread
-
-                if not thread or message not in thread.messages:
-                    self.log.warning("Running delete handler check but message"
-                                     " is not part of referenced thread: {}",
-                                     thread_id=thread.id)
-                    # Nothing to check
-                    continue
-
-                # Remove message from thread, so that the change to the thread
-                # gets properly versioned.
+        for shard_id, namespace_ids in self._namespace_ids_by_shard().items():
+            throttle = get_throttle('message_gc', shard_id) if self.throttle \
+                else None
+            self.check_shard(shard_id, namespace_ids, current_time, throttle)
+
+    def check_shard(self, shard_id, namespace_ids, current_time,
+                    throttle=None):
+        last_id = 0
+        while True:
+            with session_scope_by_shard_id(shard_id) as db_session:
+                dangling = db_session.query(Message.id, Message.thread_id). \
+                    filter(Message.namespace_id.in_(namespace_ids),
+                           Message.deleted_at <= current_time -
+                           self.message_ttl,
+                           Message.id > last_id). \
+                    order_by(Message.id).limit(self.batch_size).all()
+            if not dangling:
+                return
+            last_id = dangling[-1].id
+            # Wait without holding a connection or an open transaction.
+            if throttle is not None:
+                throttle.acquire(len(dangling))
+            with session_scope_by_shard_id(shard_id) as db_session:
+                self._delete_batch(db_session, dangling)
+                # Delete statements may cause InnoDB index locks to be
+                # acquired, so commit after each batch in order to prevent
+                # bulk deletes from creating a long-running, blocking
+                # transaction.
+                db_session.commit()
+            if len(dangling) < self.batch_size:
+                return
+
+    def _delete_batch(self, db_session, dangling):
+        message_ids = {row.id for row in dangling}
+
+        # If a message isn't *actually* dangling (i.e., it has imapuids
+        # associated with it), undelete it.
+        undangled = {message_id for message_id, in
+                     db_session.query(ImapUid.message_id).filter(
+                         ImapUid.message_id.in_(message_ids)).distinct()}
+        if undangled:
+            for message in db_session.query(Message).filter(
+                    Message.id.in_(undangled)):
+                message.deleted_at = None
+            message_ids -= undangled
+
+        thread_ids = {row.thread_id for row in dangling
+                      if row.id in message_ids}
+        if not thread_ids:
+            return
+        threads = db_session.query(Thread).filter(
+            Thread.id.in_(thread_ids)).options(subqueryload(Thread.messages))
+        for thread in threads:
+            deleted = [m for m in thread.messages if m.id in message_ids]
+            for message in deleted:
+                # Remove message from thread, so that the change to the
+                # thread gets properly versioned.
                 thread.messages.remove(message)
                 # Also need to explicitly delete, so that message shows up in
                 # db_session.deleted.
                 db_session.delete(message)
-                if not thread.messages:
-                    db_session.delete(thread)
-                else:
-                    # TODO(emfree): This is messy. We need better
-                    # abstractions for recomputing a thread's attributes
-                    # from messages, here and in mail sync.
-                    non_draft_messages = [m for m in thread.messages if not
-                                          m.is_draft]
-                    if not non_draft_messages:
-                        continue
-                    # The value of thread.messages is ordered oldest-to-newest.
-                    first_message = non_draft_messages[0]
-                    last_message = non_draft_messages[-1]
-                    thread.subject = first_message.subject
-                    thread.subjectdate = first_message.received_date
-                    thread.recentdate = last_message.received_date
-                    thread.snippet = last_message.snippet
-                # YES this is at the right indentation level. Delete statements
-                # may cause InnoDB index locks to be acquired, so we opt to
-                # simply commit after each delete in order to prevent bulk
-                # delete scenarios from creating a long-running, blocking
-                # transaction.
-                db_session.commit()
+            if not thread.messages:
+                db_session.delete(thread)
+                continue
+            # TODO(emfree): This is messy. We need better abstractions for
+            # recomputing a thread's attributes from messages, here and in
+            # mail sync.
+            non_draft_messages = [m for m in thread.messages if not
+                                  m.is_draft]
+            if not non_draft_messages:
+                continue
+            # The value of thread.messages is ordered oldest-to-newest.
+            first_message = non_draft_messages[0]
+            last_message = non_draft_messages[-1]
+            thread.subject = first_message.subject
+            thread.subjectdate = first_message.received_date
+            thread.recentdate = last_message.received_date
+            thread.snippet = last_message.snippet
 
     def gc_deleted_categories(self):
-        # Delete categories which have been deleted on the backend.
-        # Go through all the categories and check if there are messages
-        # associated with it. If not, delete it.
-        with session_scope(self.namespace_id) as db_session:
-            categories = db_session.query(Category).filter(
-                Category.namespace_id == self.namespace_id,
-                Category.deleted_at > EPOCH)
-
-            for category in categories:
-                # Check if no message is associated with the category. If yes,
-                # delete it.
-                count = db_session.query(func.count(MessageCategory.id)).filter(
-                    MessageCategory.category_id == category.id).scalar()
-
-                if count == 0:
+        # Delete categories which have been deleted on the backend and have no
+        # messages associated with them any more.
+        for shard_id, namespace_ids in self._namespace_ids_by_shard().items():
+            with session_scope_by_shard_id(shard_id) as db_session:
+                categories = db_session.query(Category).filter(
+                    Category.namespace_id.in_(namespace_ids),
+                    Category.deleted_at > EPOCH,
+                    ~exists().where(
+                        MessageCategory.category_id == Category.id))
+                for category in categories:
                     db_session.delete(category)
-                    db_session.commit()
+                db_session.commit()
 
 
 class LabelRenameHandler(gevent.Greenlet):
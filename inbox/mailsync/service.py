@@ -11,7 +11,9 @@ from inbox.providers import providers
 from inbox.config import config
 from inbox.contacts.remote_sync import ContactSync
 from inbox.events.remote_sync import EventSync, GoogleEventSync
+from inbox.crispin import prewarm_account_info
 from inbox.heartbeat.status import clear_heartbeat_status
+from inbox.heartbeat.store import HeartbeatStore
 from nylas.logging import get_logger
 from nylas.logging.sentry import log_uncaught_errors
 from inbox.models.session import session_scope
@@ -19,8 +21,11 @@ from inbox.models import Account
 from inbox.scheduling.queue import QueueClient
 from inbox.util.concurrency import retry_with_logging
 from inbox.util.stats import statsd_client
+from inbox.util.throttle import AdaptiveRateLimiter
 
 from inbox.mailsync.backends import module_registry
+from inbox.mailsync.backends.imap.monitor import ImapSyncMonitor
+from inbox.mailsync.gc import DeleteHandler
 
 USE_GOOGLE_PUSH_NOTIFICATIONS = \
     'GOOGLE_PUSH_NOTIFICATIONS' in config.get('FEATURE_FLAGS', [])
@@ -33,6 +38,18 @@ NUM_CPU_SAMPLES = (OVERLOAD_MIN * 60) / SYNC_POLL_INTERVAL
 NOMINAL_THRESHOLD = 90.0
 
 MAX_ACCOUNTS_PER_PROCESS = config.get('MAX_ACCOUNTS_PER_PROCESS', 150)
+# How much sync work a process takes on, in units of account cost (see
+# inbox.scheduling.cost), i.e. roughly how many idle accounts it can sync.
+PROCESS_CAPACITY = config.get('SYNC_PROCESS_CAPACITY', 150)
+# Minimum time between handing accounts back to the queue when overloaded.
+REBALANCE_INTERVAL = config.get('SYNC_REBALANCE_INTERVAL', 600)
+# How long to wait for an account's mail sync to finish what it's in the
+# middle of when handing the account off to another process.
+DRAIN_TIMEOUT = config.get('SYNC_DRAIN_TIMEOUT', 60)
+# How many accounts per second (and at most at once) to start syncing while
+# ramping up after the process starts.
+STARTUP_RATE = config.get('SYNC_STARTUP_RATE', 2)
+STARTUP_BURST = config.get('SYNC_STARTUP_BURST', 10)
 
 
 class SyncService(object):
@@ -47,10 +64,12 @@ class SyncService(object):
         sync service on the system should get a different value.)
     poll_interval : int
         Seconds between polls for account changes.
+    capacity : float
+        Total estimated cost of the accounts to sync in this process.
     """
 
     def __init__(self, process_identifier, process_number,
-                 poll_interval=SYNC_POLL_INTERVAL):
+                 poll_interval=SYNC_POLL_INTERVAL, capacity=PROCESS_CAPACITY):
         self.host = platform.node()
         self.process_number = process_number
         self.process_identifier = process_identifier
@@ -72,6 +91,7 @@ class SyncService(object):
         self.contact_sync_monitors = {}
         self.event_sync_monitors = {}
         self.poll_interval = poll_interval
+        self.capacity = capacity
         self.semaphore = BoundedSemaphore(1)
 
         self.stealing_enabled = config.get('SYNC_STEAL_ACCOUNTS', True)
@@ -79,6 +99,19 @@ class SyncService(object):
         self.queue_client = QueueClient(self.zone)
         self.rolling_cpu_counts = collections.deque(maxlen=NUM_CPU_SAMPLES)
         self.last_unloaded_account = time.time()
+        self.last_rebalanced = None
+        self.handoff_greenlet = None
+        self.startup_throttle = AdaptiveRateLimiter(
+            'mailsync.startup', [], STARTUP_RATE, STARTUP_BURST)
+        self.startup_progress = {'state': 'pending'}
+        self.ramp_up_greenlet = None
+        # Assigned accounts that ramp_up() will start, so poll() leaves them
+        # alone.
+        self.ramping_accounts = set()
+        # Garbage-collects deleted messages for all the IMAP accounts this
+        # process syncs.
+        self.delete_handler = DeleteHandler(self.imap_namespace_ids,
+                                            throttle=True)
 
         # Fill the queue with initial values.
         null_cpu_values = [0.0 for cpu in psutil.cpu_percent(percpu=True)]
@@ -93,10 +126,71 @@ class SyncService(object):
         Polls for newly registered accounts and checks for start/stop commands.
 
         """
+        if not self.delete_handler.started:
+            self.delete_handler.start()
+        # Keep polling (and advertising this process) while ramping up.
+        if self.ramp_up_greenlet is None:
+            self.ramp_up_greenlet = gevent.spawn(self.ramp_up)
         while True:
             self.poll()
             gevent.sleep(self.poll_interval)
 
+    def ramp_up(self):
+        """
+        Starts syncing the accounts already assigned to this process (e.g.
+        when it restarts), at most STARTUP_RATE per second so as not to log
+        in to every account and hit the database for all of them at once.
+        Accounts whose heartbeats are oldest go first; ones without any
+        heartbeats (e.g. that never synced) go before all others. Runs in its
+        own greenlet, alongside the polling loop.
+
+        """
+        accounts = self.accounts_to_sync() - self.syncing_accounts
+        self.ramping_accounts = set(accounts)
+        started_at = time.time()
+        self.startup_progress = {'state': 'ramping', 'total': len(accounts),
+                                 'started': 0, 'skipped': 0, 'failed': 0,
+                                 'started_at': started_at}
+        self.log.info('Ramping up account syncs', count=len(accounts))
+        try:
+            if accounts:
+                prewarm_account_info(accounts)
+                heartbeats = HeartbeatStore.store().get_oldest_heartbeats(
+                    accounts)
+                accounts = sorted(
+                    accounts, key=lambda id_: (heartbeats.get(id_, 0), id_))
+
+            for account_id in accounts:
+                self.startup_throttle.acquire()
+                self.ramping_accounts.discard(account_id)
+                # The account may have been reassigned or started by poll()
+                # in the meantime.
+                if account_id in self.syncing_accounts or \
+                        self.queue_client.assigned([account_id]).get(
+                            account_id) != self.process_identifier:
+                    self.startup_progress['skipped'] += 1
+                    continue
+                try:
+                    self.start_sync(account_id)
+                except OperationalError:
+                    self.log.error('Database error starting account sync',
+                                   exc_info=True)
+                    log_uncaught_errors()
+                if account_id in self.syncing_accounts:
+                    self.startup_progress['started'] += 1
+                else:
+                    self.startup_progress['failed'] += 1
+        finally:
+            # poll() starts whatever is left.
+            self.ramping_accounts = set()
+
+        elapsed = time.time() - started_at
+        self.startup_progress.update(state='done', elapsed=elapsed)
+        self.log.info('Finished ramping up account syncs', elapsed=elapsed,
+                      **{k: self.startup_progress[k] for k in
+                         ('total', 'started', 'skipped', 'failed')})
+        statsd_client.timing('mailsync.startup', elapsed * 1000)
+
     def _compute_cpu_average(self):
         """
         Use our CPU data to compute the average CPU usage for this machine.
@@ -118,15 +212,26 @@ class SyncService(object):
 
         cpus_over_nominal = all([cpu_usage > NOMINAL_THRESHOLD for cpu_usage in cpu_averages])
 
+        load = self.current_load()
+        statsd_client.gauge(
+            'accounts.{}.mailsync-{}.load'.format(
+                self.host, self.process_number), load)
+
         # Conservatively, stop accepting accounts if the CPU usage is over
-        # NOMINAL_THRESHOLD for every core, or if the total # of accounts
-        # being synced by a single process exceeds the threshold. Excessive
-        # concurrency per process can result in lowered database throughput
-        # or availability problems, since many transactions may be held open
-        # at the same time.
-        if self.stealing_enabled and not cpus_over_nominal and \
-                len(self.syncing_accounts) < MAX_ACCOUNTS_PER_PROCESS:
-            r = self.queue_client.claim_next(self.process_identifier)
+        # NOMINAL_THRESHOLD for every core, if the accounts being synced by
+        # this process already use up its capacity, or if the total # of
+        # accounts being synced by a single process exceeds the threshold.
+        # Excessive concurrency per process can result in lowered database
+        # throughput or availability problems, since many transactions may
+        # be held open at the same time.
+        # Only accounts whose estimated cost fits into the remaining capacity
+        # are claimed, except by a process that isn't syncing anything yet.
+        claiming = self.stealing_enabled and not cpus_over_nominal and \
+            len(self.syncing_accounts) < MAX_ACCOUNTS_PER_PROCESS
+        if claiming and (load < self.capacity or not self.syncing_accounts):
+            r = self.queue_client.claim_next(
+                self.process_identifier, budget=self.capacity - load,
+                idle=not self.syncing_accounts)
             if r:
                 self.log.info('Claimed new account sync', account_id=r)
         else:
@@ -134,9 +239,19 @@ class SyncService(object):
                 reason = 'stealing disabled'
             elif cpus_over_nominal:
                 reason = 'CPU too high'
-            else:
+            elif not claiming:
                 reason = 'reached max accounts for process'
-            self.log.info('Not claiming new account sync', reason=reason)
+            else:
+                reason = 'reached capacity for process'
+            self.log.info('Not claiming new account sync', reason=reason,
+                          load=load, capacity=self.capacity)
+
+        # Let other processes know how much more they could hand us.
+        self.queue_client.advertise(self.process_identifier,
+                                    self.capacity if claiming else 0, load)
+        if self.stealing_enabled and (cpus_over_nominal or
+                                      load > self.capacity):
+            self.rebalance()
 
         # Determine which accounts to sync
         start_accounts = self.accounts_to_sync()
@@ -146,7 +261,8 @@ class SyncService(object):
 
         # Perform the appropriate action on each account
         for account_id in start_accounts:
-            if account_id not in self.syncing_accounts:
+            if account_id not in self.syncing_accounts and \
+                    account_id not in self.ramping_accounts:
                 try:
                     self.start_sync(account_id)
                 except OperationalError:
@@ -165,6 +281,50 @@ class SyncService(object):
                                exc_info=True)
                 log_uncaught_errors()
 
+    def current_load(self):
+        """ Total estimated cost of the accounts this process syncs. """
+        return sum(self.queue_client.costs(self.syncing_accounts).values())
+
+    def rebalance(self):
+        """
+        Stops syncing the costliest account that another process has room
+        for (at most once every REBALANCE_INTERVAL seconds), handing it off
+        to be claimed by that process. The handoff happens in the background,
+        since draining the account's sync can take a while.
+        """
+        if len(self.syncing_accounts) < 2 or (
+                self.last_rebalanced is not None and
+                time.time() - self.last_rebalanced < REBALANCE_INTERVAL):
+            return
+        spare = self.queue_client.spare_capacity(
+            exclude=self.process_identifier)
+        movable = {account_id: cost for account_id, cost in
+                   self.queue_client.costs(self.syncing_accounts).items()
+                   if cost <= spare}
+        if not movable:
+            return
+        account_id = max(movable, key=movable.get)
+        self.last_rebalanced = time.time()
+        self.handoff_greenlet = gevent.spawn(
+            self.hand_off, account_id, movable[account_id], spare)
+
+    def hand_off(self, account_id, cost, spare):
+        try:
+            if self.stop_sync(account_id, drain=True):
+                self.log.info('Handed off account to rebalance load',
+                              account_id=account_id, cost=cost,
+                              spare_capacity=spare)
+                statsd_client.incr('mailsync.rebalanced')
+        except OperationalError:
+            self.log.error('Database error handing off account sync',
+                           exc_info=True)
+            log_uncaught_errors()
+
+    def imap_namespace_ids(self):
+        return [monitor.namespace_id for monitor in
+                self.email_sync_monitors.values()
+                if isinstance(monitor, ImapSyncMonitor)]
+
     def accounts_to_sync(self):
         return {int(k) for k, v in self.queue_client.assigned().items()
                 if v == self.process_identifier}
@@ -188,6 +348,12 @@ class SyncService(object):
                     acc.sync_host = self.process_identifier
                     if acc.sync_email:
                         monitor = self.monitor_cls_for[acc.provider](acc)
+                        # Pick up where the account's previous sync process
+                        # left off, if it handed the account off.
+                        handoff = self.queue_client.take_handoff(acc.id)
+                        if handoff is not None and \
+                                hasattr(monitor, 'resume_from'):
+                            monitor.resume_from(handoff)
                         self.email_sync_monitors[acc.id] = monitor
                         monitor.start()
 
@@ -226,12 +392,27 @@ class SyncService(object):
             else:
                 self.log.info('sync already started', account_id=account_id)
 
-    def stop_sync(self, account_id):
+    def stop_sync(self, account_id, drain=False):
         """
         Stops the sync for the account with given account_id.
         If that account doesn't exist, does nothing.
 
+        If `drain` is True, the account's mail sync is first given up to
+        DRAIN_TIMEOUT seconds to finish what it's in the middle of, and the
+        state it has built up is handed off to the next process to sync the
+        account. If the account should still be synced, it's put back onto
+        the queue for another process to claim.
+
         """
+        monitor = self.email_sync_monitors.get(account_id)
+        if drain and monitor is not None and hasattr(monitor, 'drain'):
+            # Without holding the semaphore, so as not to hold up starting
+            # and stopping other accounts.
+            start = time.time()
+            state = monitor.drain(DRAIN_TIMEOUT)
+            self.queue_client.save_handoff(account_id, state)
+            self.log.info('Drained account sync', account_id=account_id,
+                          elapsed=time.time() - start)
 
         with self.semaphore:
             self.log.info('Stopping monitors', account_id=account_id)
@@ -254,10 +435,16 @@ class SyncService(object):
             # Update database/heartbeat state
             with session_scope(account_id) as db_session:
                 acc = db_session.query(Account).get(account_id)
-                if not acc.sync_should_run:
+                should_run = acc.sync_should_run
+                if not should_run:
                     clear_heartbeat_status(acc.id)
                 if acc.sync_stopped(self.process_identifier):
                     self.log.info('sync stopped', account_id=account_id)
 
-            r = self.queue_client.unassign(account_id, self.process_identifier)
+            if should_run:
+                r = self.queue_client.release(account_id,
+                                              self.process_identifier)
+            else:
+                r = self.queue_client.unassign(account_id,
+                                               self.process_identifier)
             return r
@@ -20,6 +20,10 @@ def schedule_action(func_name, record, namespace_id, db_session, **kwargs):
         namespace_id=namespace_id,
         extra_args=kwargs)
     db_session.add(log_entry)
+    if account.actionlog_cls is ActionLog:
+        # Let the syncback service know once the session commits (see
+        # inbox.transactions.action_notifier).
+        db_session.info.setdefault('new_actions', set()).add(namespace_id)
 
 
 class ActionLog(MailSyncBase, UpdatedAtMixin, DeletedAtMixin):
@@ -0,0 +1,234 @@
+"""
+Bulk deletion of all of a namespace's rows, for delete_namespace().
+
+The tables to delete from are ordered by a plan derived from the schema:
+tables are deleted from before the tables they reference, and tables whose
+rows are cascade-deleted into the same table aren't deleted from at the same
+time (which would make them contend for the same rows). Tables with no such
+dependencies are deleted from concurrently, by a bounded number of
+greenlets.
+
+Each table is deleted from in primary key ranges between the smallest and
+largest id of the namespace's rows, with a range size that adapts to how
+long deletes take. Since the ranges are recomputed from the remaining rows,
+an interrupted deletion can simply be run again; a DeletionProgress with a
+path also persists which tables are done, and how many rows were deleted.
+
+"""
+import os
+import json
+import time
+from collections import defaultdict
+
+import gevent
+from gevent.lock import BoundedSemaphore
+
+from inbox.config import config
+from nylas.logging import get_logger
+log = get_logger()
+
+DELETE_CONCURRENCY = config.get('DELETE_NAMESPACE_CONCURRENCY', 4)
+# How long a single DELETE should take; the size of the id ranges deleted is
+# adjusted to keep deletes around this long.
+BATCH_TARGET_SECONDS = config.get('DELETE_BATCH_TARGET_SECONDS', 0.5)
+INITIAL_BATCH_SIZE = 2000
+MIN_BATCH_SIZE = 100
+MAX_BATCH_SIZE = 1000000
+
+
+def plan_deletion(tables, metadata):
+    """
+    Work out which of `tables` have to be deleted from before which others.
+
+    Parameters
+    ----------
+    tables: list
+        Names of the tables to delete from, in order of preference.
+    metadata: MetaData
+        The schema.
+
+    Returns
+    -------
+    dict
+        Maps each table to the set of tables that have to be deleted from
+        before it.
+
+    """
+    tables = list(tables)
+    known = [metadata.tables[t] for t in tables if t in metadata.tables]
+
+    def references(table):
+        return {fk.column.table.name for fk in table.foreign_keys
+                if fk.column.table.name != table.name}
+
+    # Delete rows before the rows they reference.
+    dependencies = {table: set() for table in tables}
+    for table in known:
+        for referenced in references(table) & set(tables):
+            dependencies[referenced].add(table.name)
+    order = _toposort(tables, dependencies)
+
+    # Don't delete from two tables at once if rows in a third table are
+    # cascade-deleted along with the rows of both.
+    for table in metadata.tables.values():
+        if table.name in dependencies:
+            continue
+        shared = sorted(references(table) & set(tables), key=order.index)
+        for earlier, later in zip(shared, shared[1:]):
+            dependencies[later].add(earlier)
+    return dependencies
+
+
+def _toposort(tables, dependencies):
+    order = []
+    remaining = list(tables)
+    while remaining:
+        ready = [t for t in remaining if dependencies[t] <= set(order)]
+        if not ready:
+            raise ValueError('Circular dependency between tables: {}'.format(
+                ', '.join(remaining)))
+        order.append(ready[0])
+        remaining.remove(ready[0])
+    return order
+
+
+class AdaptiveBatchSize(object):
+    """
+    A batch size that doubles while batches take less than half of
+    `target` seconds, and halves while they take longer than `target`.
+
+    """
+    def __init__(self, target=BATCH_TARGET_SECONDS, size=INITIAL_BATCH_SIZE,
+                 minimum=MIN_BATCH_SIZE, maximum=MAX_BATCH_SIZE):
+        self.target = target
+        self.size = size
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def update(self, elapsed):
+        if elapsed < self.target / 2.:
+            self.size = min(self.size * 2, self.maximum)
+        elif elapsed > self.target:
+            self.size = max(self.size // 2, self.minimum)
+
+
+class DeletionProgress(object):
+    """
+    Per-table progress of a namespace deletion. If `path` is given, it's
+    saved there as JSON after every batch and loaded from there on creation,
+    so that a rerun skips the tables that are already done.
+
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.tables = defaultdict(lambda: {'deleted': 0, 'done': False})
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.tables.update(json.load(f))
+
+    def done(self, table):
+        return self.tables[table]['done']
+
+    def record(self, table, deleted, done=False):
+        self.tables[table]['deleted'] += deleted
+        self.tables[table]['done'] = done
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as f:
+            json.dump(self.tables, f)
+        os.rename(tmp_path, self.path)
+
+    def summary(self):
+        return {table: dict(state) for table, state in self.tables.items()}
+
+
+def delete_table(engine, table, column, id_, progress, throttle=None,
+                 dry_run=False):
+    """
+    Delete the rows of `table` whose `column` is `id_`, in adaptively
+    sized primary key ranges. If `throttle` (an AdaptiveRateLimiter) is
+    given, a token is taken from it for every row deleted.
+
+    """
+    if progress.done(table):
+        log.info('Skipping finished table', table=table)
+        return
+
+    log.info('Starting batch deletion', table=table)
+    start = time.time()
+    low, high = engine.execute(
+        'SELECT MIN(id), MAX(id) FROM {} WHERE {}={}'.format(
+            table, column, id_)).first()
+    # Messages reference the messages they reply to, so delete newest first
+    # (and in that order within each batch, see below).
+    descending = table == 'message'
+    batch_size = AdaptiveBatchSize()
+    count = deleted = 0
+    while low is not None and low <= high:
+        if throttle is not None:
+            # Pay for the previous batch.
+            throttle.acquire(deleted)
+        if descending:
+            range_ = (max(low, high - batch_size.size + 1), high)
+        else:
+            range_ = (low, min(high, low + batch_size.size - 1))
+        where = '{}={} AND id BETWEEN {} AND {}'.format(column, id_, *range_)
+
+        batch_start = time.time()
+        if dry_run is False:
+            query = 'DELETE FROM {} WHERE {}'.format(table, where)
+            if table == 'message':
+                # messages must be order by the foreign key `received_date`
+                # otherwise MySQL will raise an error when deleting
+                # from the message table
+                query += ' ORDER BY received_date desc'
+            deleted = engine.execute(query).rowcount
+        else:
+            deleted = engine.execute('SELECT COUNT(*) FROM {} WHERE {}'.format(
+                table, where)).scalar()
+        batch_size.update(time.time() - batch_start)
+
+        if descending:
+            high = range_[0] - 1
+        else:
+            low = range_[1] + 1
+        count += deleted
+        if dry_run is False:
+            progress.record(table, deleted)
+
+    if dry_run is False:
+        progress.record(table, 0, done=True)
+    log.info('Completed batch deletion', time=time.time() - start,
+             table=table, count=count)
+
+
+def delete_tables(engine, filters, metadata, progress, throttle=None,
+                  dry_run=False, concurrency=DELETE_CONCURRENCY):
+    """
+    Delete from the tables in `filters` (an ordered mapping of table name to
+    a (column, id) pair) in the order planned by plan_deletion(), at most
+    `concurrency` tables at a time.
+
+    """
+    dependencies = plan_deletion(filters.keys(), metadata)
+    slots = BoundedSemaphore(concurrency)
+    greenlets = {}
+
+    def run(table):
+        gevent.joinall([greenlets[t] for t in dependencies[table]],
+                       raise_error=True)
+        with slots:
+            column, id_ = filters[table]
+            delete_table(engine, table, column, id_, progress, throttle,
+                         dry_run)
+
+    for table in filters:
+        greenlets[table] = gevent.spawn(run, table)
+    try:
+        gevent.joinall(greenlets.values(), raise_error=True)
+    finally:
+        gevent.killall(greenlets.values())
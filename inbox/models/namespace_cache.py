@@ -0,0 +1,165 @@
+"""
+Cache for resolving API access tokens (namespace public ids) to the
+namespace, account and shard they belong to.
+
+Resolving a public id without knowing its shard requires a global query
+that fans out to every shard, which gets more expensive as shards are
+added. Since the mapping never changes for the lifetime of a namespace, we
+memoize it in a per-process LRU and, if configured, in Redis so that API
+processes can share lookups. Unknown tokens are cached too (for a shorter
+time) so that clients with bad credentials can't hammer every shard.
+
+Entries are invalidated by delete_namespace(), in Redis and in the local
+cache of the deleting process. Other processes may still hold a stale
+positive entry in their local cache for up to NAMESPACE_CACHE_TTL seconds,
+and without Redis, that TTL is the only bound on how long they do. The API
+handles that case by returning AccountDoesNotExistError when the namespace
+can't be loaded from its shard.
+
+"""
+from collections import namedtuple
+
+from redis import StrictRedis
+from sqlalchemy.orm.exc import NoResultFound
+
+from inbox.config import config
+from inbox.ignition import engine_manager
+from inbox.models import Namespace
+from inbox.models.session import global_session_scope
+from inbox.util.lru import TTLCache
+from inbox.util.stats import statsd_client
+from nylas.logging import get_logger
+log = get_logger()
+
+NAMESPACE_CACHE_SIZE = config.get('NAMESPACE_CACHE_SIZE', 100000)
+NAMESPACE_CACHE_TTL = config.get('NAMESPACE_CACHE_TTL', 300)
+NAMESPACE_CACHE_NEGATIVE_TTL = config.get('NAMESPACE_CACHE_NEGATIVE_TTL', 10)
+
+SOCKET_CONNECT_TIMEOUT = 1
+SOCKET_TIMEOUT = 1
+
+# Stored in place of a NamespaceRecord for public ids that don't exist.
+NOT_FOUND = object()
+
+
+NamespaceRecord = namedtuple('NamespaceRecord',
+                             ['namespace_id', 'account_id', 'shard_id'])
+
+
+class NamespaceCache(object):
+    """
+    Two-level public_id -> NamespaceRecord cache: a local TTLCache in front
+    of an optional shared Redis cache, in front of the database.
+
+    """
+    KEY_PREFIX = 'nsauth:'
+
+    def __init__(self, maxsize=NAMESPACE_CACHE_SIZE, ttl=NAMESPACE_CACHE_TTL,
+                 negative_ttl=NAMESPACE_CACHE_NEGATIVE_TTL, redis=None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.redis = redis
+
+    def get(self, public_id):
+        """
+        Returns the NamespaceRecord for `public_id`, or None if there's no
+        such namespace.
+
+        """
+        entry = self.local.get(public_id)
+        if entry is None:
+            entry = self._get_shared(public_id)
+            if entry is None:
+                statsd_client.incr('api.namespace_cache.miss')
+                entry = self._load(public_id)
+                self._set_shared(public_id, entry)
+            self._set_local(public_id, entry)
+        else:
+            statsd_client.incr('api.namespace_cache.hit')
+
+        if entry is NOT_FOUND:
+            return None
+        return entry
+
+    def invalidate(self, public_id):
+        self.local.invalidate(public_id)
+        if self.redis is None:
+            return
+        try:
+            self.redis.delete(self.KEY_PREFIX + public_id)
+        except Exception:
+            log.error('Error invalidating namespace cache entry',
+                      public_id=public_id, exc_info=True)
+
+    def clear(self):
+        self.local.clear()
+
+    def _load(self, public_id):
+        with global_session_scope() as db_session:
+            try:
+                namespace = db_session.query(Namespace). \
+                    filter(Namespace.public_id == public_id).one()
+            except NoResultFound:
+                return NOT_FOUND
+            return NamespaceRecord(
+                namespace.id, namespace.account.id,
+                engine_manager.shard_key_for_id(namespace.id))
+
+    def _set_local(self, public_id, entry):
+        ttl = self.negative_ttl if entry is NOT_FOUND else self.ttl
+        self.local.set(public_id, entry, ttl)
+
+    def _get_shared(self, public_id):
+        if self.redis is None:
+            return None
+        try:
+            value = self.redis.get(self.KEY_PREFIX + public_id)
+        except Exception:
+            log.error('Error reading namespace cache entry',
+                      public_id=public_id, exc_info=True)
+            return None
+        if value is None:
+            return None
+        if value == '':
+            return NOT_FOUND
+        namespace_id, account_id = map(int, value.split(':'))
+        return NamespaceRecord(namespace_id, account_id,
+                               engine_manager.shard_key_for_id(namespace_id))
+
+    def _set_shared(self, public_id, entry):
+        if self.redis is None:
+            return
+        if entry is NOT_FOUND:
+            value, ttl = '', self.negative_ttl
+        else:
+            value = '{}:{}'.format(entry.namespace_id, entry.account_id)
+            ttl = self.ttl
+        try:
+            self.redis.setex(self.KEY_PREFIX + public_id, ttl, value)
+        except Exception:
+            log.error('Error writing namespace cache entry',
+                      public_id=public_id, exc_info=True)
+
+
+def _shared_redis_client():
+    redis_host = config.get('NAMESPACE_CACHE_REDIS_HOSTNAME')
+    if not redis_host:
+        return None
+    return StrictRedis(host=redis_host,
+                       port=int(config.get('NAMESPACE_CACHE_REDIS_PORT',
+                                           6379)),
+                       db=int(config.get('NAMESPACE_CACHE_REDIS_DB', 0)),
+                       socket_connect_timeout=SOCKET_CONNECT_TIMEOUT,
+                       socket_timeout=SOCKET_TIMEOUT)
+
+
+namespace_cache = NamespaceCache(redis=_shared_redis_client())
+
+
+def resolve_namespace(public_id):
+    return namespace_cache.get(public_id)
+
+
+def invalidate_namespace(public_id):
+    namespace_cache.invalidate(public_id)
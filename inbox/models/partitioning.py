@@ -0,0 +1,191 @@
+"""
+Daily RANGE partitioning on created_at for append-only log tables (i.e. the
+transaction log), so that old rows can be purged by dropping whole
+partitions instead of with DELETEs.
+
+A partitioned table has one partition per day, named pYYYYMMDD, holding the
+rows created on that day (the first one also holds everything older),
+followed by a catch-all `pmax` partition. Partitions for upcoming days are
+split off pmax ahead of time by ensure_partitions(), so that pmax stays
+empty and splitting it is cheap.
+
+MySQL requires the partitioning column to be part of every unique key, so
+the primary key of a partitioned table is (id, created_at), and partitioned
+tables can't have foreign keys or be referenced by them.
+
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from inbox.config import config
+from nylas.logging import get_logger
+log = get_logger()
+
+# Whether the transaction table of every shard has been partitioned (by
+# migration 227), which lets purges drop partitions and delta queries skip
+# old partitions.
+TRANSACTION_LOG_PARTITIONED = config.get('TRANSACTION_LOG_PARTITIONED', False)
+
+CATCH_ALL = 'pmax'
+
+
+def to_days(day):
+    """ The value of MySQL's TO_DAYS() for the date `day`. """
+    return day.toordinal() + 365
+
+
+def partition_name(day):
+    return 'p{}'.format(day.strftime('%Y%m%d'))
+
+
+def _partition_definitions(days):
+    # The partition for `day` holds rows created before the end of that day.
+    definitions = ['PARTITION {} VALUES LESS THAN ({})'.format(
+        partition_name(day), to_days(day + timedelta(days=1)))
+        for day in days]
+    definitions.append('PARTITION {} VALUES LESS THAN MAXVALUE'.format(
+        CATCH_ALL))
+    return ', '.join(definitions)
+
+
+def list_partitions(conn, table):
+    """
+    Returns the partitions of `table` as a list of (name, end, rows)
+    tuples, in order. `end` is the date before which all the rows in the
+    partition were created (None for the catch-all partition), and `rows`
+    is InnoDB's row count estimate. Returns [] if `table` isn't partitioned.
+
+    """
+    query = text(
+        'SELECT partition_name, partition_description, table_rows '
+        'FROM information_schema.partitions '
+        'WHERE table_schema = DATABASE() AND table_name = :table '
+        'AND partition_name IS NOT NULL '
+        'ORDER BY partition_ordinal_position')
+    partitions = []
+    for name, description, rows in conn.execute(query, table=table):
+        if description == 'MAXVALUE':
+            end = None
+        else:
+            end = datetime.fromordinal(int(description) - 365).date()
+        partitions.append((name, end, rows))
+    return partitions
+
+
+def is_partitioned(conn, table):
+    return bool(list_partitions(conn, table))
+
+
+def partition_table(conn, table, today, days_ahead):
+    """
+    Partition the existing table `table` by day, with partitions from the
+    day of its oldest row up to `days_ahead` days after `today`. This
+    rebuilds the table. Any foreign keys on or referencing the table must
+    have been dropped beforehand.
+
+    """
+    oldest = conn.execute('SELECT MIN(created_at) FROM `{}`'.format(
+        table)).scalar()
+    first = oldest.date() if oldest is not None else today
+    days = [first + timedelta(days=i)
+            for i in range((today - first).days + days_ahead + 1)]
+    conn.execute(
+        'ALTER TABLE `{}` DROP PRIMARY KEY, ADD PRIMARY KEY (id, created_at) '
+        'PARTITION BY RANGE (TO_DAYS(created_at)) ({})'.format(
+            table, _partition_definitions(days)))
+
+
+def unpartition_table(conn, table):
+    """ Undo partition_table(). This rebuilds the table. """
+    conn.execute('ALTER TABLE `{}` REMOVE PARTITIONING'.format(table))
+    conn.execute('ALTER TABLE `{}` DROP PRIMARY KEY, ADD PRIMARY KEY (id)'.
+                 format(table))
+
+
+def ensure_partitions(conn, table, today, days_ahead):
+    """
+    Make sure `table` has daily partitions up to `days_ahead` days after
+    `today`, by splitting them off the catch-all partition. Returns the names
+    of the partitions created.
+
+    """
+    ends = [end for _, end, _ in list_partitions(conn, table)
+            if end is not None]
+    # The first day that doesn't have a partition yet. If the table only has
+    # the catch-all partition, start from today.
+    start = max(ends) if ends else today
+    days = [start + timedelta(days=i)
+            for i in range((today - start).days + days_ahead + 1)]
+    if not days:
+        return []
+    conn.execute('ALTER TABLE `{}` REORGANIZE PARTITION {} INTO ({})'.format(
+        table, CATCH_ALL, _partition_definitions(days)))
+    return [partition_name(day) for day in days]
+
+
+def drop_partitions_before(conn, table, cutoff, dry_run=False):
+    """
+    Drop the partitions of `table` that only hold rows created before the
+    datetime `cutoff`. The newest daily partition is always kept, so that
+    ensure_partitions() can tell where to continue from. Returns the
+    (name, end, rows) of the partitions dropped.
+
+    """
+    daily = [partition for partition in list_partitions(conn, table)
+             if partition[1] is not None]
+    expired = [partition for partition in daily[:-1]
+               if datetime.combine(partition[1], datetime.min.time()) <=
+               cutoff]
+    if expired and not dry_run:
+        conn.execute('ALTER TABLE `{}` DROP PARTITION {}'.format(
+            table, ', '.join(name for name, _, _ in expired)))
+    for name, end, rows in expired:
+        log.info('Dropped partition' if not dry_run else
+                 'Would drop partition', table=table, partition=name,
+                 end=end, rows=rows)
+    return expired
+
+
+def _foreign_keys(conn, table):
+    """
+    Returns the (table, constraint name) of the foreign keys on `table` and
+    of those referencing it.
+
+    """
+    query = text(
+        'SELECT DISTINCT table_name, constraint_name '
+        'FROM information_schema.key_column_usage '
+        'WHERE table_schema = DATABASE() AND '
+        '(table_name = :table AND referenced_table_name IS NOT NULL OR '
+        'referenced_table_name = :table)')
+    return list(conn.execute(query, table=table))
+
+
+def partition_transaction_log(conn, today, days_ahead):
+    """
+    Partition the transaction table, dropping the foreign keys MySQL doesn't
+    allow on partitioned tables first: the one on namespace_id (transactions
+    are deleted explicitly when their namespace is), and the one from
+    contactsearchindexcursor.
+
+    """
+    if is_partitioned(conn, 'transaction'):
+        return
+    for table, constraint in _foreign_keys(conn, 'transaction'):
+        conn.execute('ALTER TABLE `{}` DROP FOREIGN KEY `{}`'.format(
+            table, constraint))
+    partition_table(conn, 'transaction', today, days_ahead)
+
+
+def unpartition_transaction_log(conn):
+    """ Undo partition_transaction_log(). """
+    if not is_partitioned(conn, 'transaction'):
+        return
+    unpartition_table(conn, 'transaction')
+    conn.execute('ALTER TABLE transaction ADD CONSTRAINT transaction_ibfk_1 '
+                 'FOREIGN KEY (namespace_id) REFERENCES namespace (id) '
+                 'ON DELETE CASCADE')
+    conn.execute('ALTER TABLE contactsearchindexcursor ADD CONSTRAINT '
+                 'contactsearchindexcursor_ibfk_1 FOREIGN KEY '
+                 '(transaction_id) REFERENCES transaction (id)')
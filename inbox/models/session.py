@@ -1,5 +1,6 @@
 import sys
 import time
+import itertools
 from contextlib import contextmanager
 
 from sqlalchemy import event
@@ -8,13 +9,24 @@ from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.horizontal_shard import ShardedSession
 
 from inbox.config import config
-from inbox.ignition import engine_manager
+from inbox.ignition import engine_manager, DB_REPLICA_MAX_LAG
+from inbox.transactions.cache import transaction_cache
 from inbox.util.stats import statsd_client
 from nylas.logging import get_logger, find_first_app_frame_and_name
 log = get_logger()
 
 
 MAX_SANE_TRX_TIME_MS = 30000
+SESSION_METRICS_SAMPLE_RATE = config.get('SESSION_METRICS_SAMPLE_RATE') or 10
+_sessions = itertools.count()
+# Reads for a namespace go to the primary for this long after a write to it,
+# so that they can't miss the write on a lagging replica. (The extra second
+# covers the resolution of the transaction timestamps shared through Redis.)
+READ_YOUR_WRITES_WINDOW = DB_REPLICA_MAX_LAG + 1
+
+
+class ReadOnlySessionError(Exception):
+    pass
 
 
 def two_phase_session(engine_map, versioned=True):
@@ -36,22 +48,65 @@ def two_phase_session(engine_map, versioned=True):
     return session
 
 
-def new_session(engine, versioned=True):
-    """Returns a session bound to the given engine."""
+def engine_for_id(id_, read_only=False):
+    """
+    Returns the engine for a session on the shard of `id_` (a namespace id
+    or any other id on the shard).
+
+    Read-only sessions are routed to a replica of the shard if it has one
+    that is caught up, unless `id_` is a namespace that was written to in
+    the last READ_YOUR_WRITES_WINDOW seconds. Recent writes by other
+    processes can only be seen through the shared transaction cache, so
+    replicas aren't used unless it's configured.
+
+    """
+    if read_only and transaction_cache.shared and \
+            engine_manager.has_replicas(id_) and \
+            not transaction_cache.written_recently(id_,
+                                                   READ_YOUR_WRITES_WINDOW):
+        return engine_manager.get_for_id(id_, read_only=True)
+    return engine_manager.get_for_id(id_)
+
+
+def _caller_metric_name(engine):
+    frame, modname = find_first_app_frame_and_name(
+        ignores=['sqlalchemy', 'inbox.models.session', 'nylas.logging',
+                 'contextlib'])
+    funcname = frame.f_code.co_name
+    modname = modname.replace(".", "-")
+    return {'modname': modname,
+            'funcname': funcname,
+            'metric_name': 'db.{}.{}.{}'.format(engine.url.database, modname,
+                                                funcname)}
+
+
+def new_session(engine, versioned=True, read_only=False):
+    """
+    Returns a session bound to the given engine. Flushing changes from a
+    `read_only` session raises ReadOnlySessionError.
+
+    """
     session = Session(bind=engine, autoflush=True, autocommit=False)
 
+    if read_only:
+        session.info['read_only'] = True
+
+        @event.listens_for(session, 'before_flush')
+        def prevent_writes(session, flush_context, instances):
+            raise ReadOnlySessionError('Cannot write using a read-only '
+                                       'session')
+
     if versioned:
         configure_versioning(session)
 
-        # Make statsd calls for transaction times
+        # Make statsd calls for transaction times. Finding the caller means
+        # walking the stack, so only one in SESSION_METRICS_SAMPLE_RATE
+        # sessions is attributed and reported (with counts scaled up to
+        # compensate).
         transaction_start_map = {}
-        frame, modname = find_first_app_frame_and_name(
-            ignores=['sqlalchemy', 'inbox.models.session', 'nylas.logging',
-                     'contextlib'])
-        funcname = frame.f_code.co_name
-        modname = modname.replace(".", "-")
-        metric_name = 'db.{}.{}.{}'.format(engine.url.database, modname,
-                                           funcname)
+        caller = {}
+        if next(_sessions) % SESSION_METRICS_SAMPLE_RATE == 0:
+            caller.update(_caller_metric_name(engine))
 
         @event.listens_for(session, 'after_begin')
         def after_begin(session, transaction, connection):
@@ -72,18 +127,29 @@ def new_session(engine, versioned=True):
 
             t = time.time()
             latency = int((t - start_time) * 1000)
-            statsd_client.timing(metric_name, latency)
-            statsd_client.incr(metric_name)
+            if caller:
+                statsd_client.timing(caller['metric_name'], latency)
+                statsd_client.incr(caller['metric_name'],
+                                   SESSION_METRICS_SAMPLE_RATE)
             if latency > MAX_SANE_TRX_TIME_MS:
+                # The session is usually ended by the code that created it,
+                # so this finds the same caller.
+                if not caller:
+                    caller.update(_caller_metric_name(engine))
                 log.warning('Long transaction', latency=latency,
-                            modname=modname, funcname=funcname)
+                            modname=caller['modname'],
+                            funcname=caller['funcname'])
 
     return session
 
 
 def configure_versioning(session):
     from inbox.models.transaction import (create_revisions, propagate_changes,
-                                          increment_versions)
+                                          increment_versions,
+                                          publish_new_transactions,
+                                          discard_new_transactions)
+    from inbox.transactions.action_notifier import (publish_new_actions,
+                                                    discard_new_actions)
 
     @event.listens_for(session, 'before_flush')
     def before_flush(session, flush_context, instances):
@@ -99,11 +165,21 @@ def configure_versioning(session):
         """
         create_revisions(session)
 
+    @event.listens_for(session, 'after_commit')
+    def after_commit(session):
+        publish_new_transactions(session)
+        publish_new_actions(session)
+
+    @event.listens_for(session, 'after_rollback')
+    def after_rollback(session):
+        discard_new_transactions(session)
+        discard_new_actions(session)
+
     return session
 
 
 @contextmanager
-def session_scope(id_, versioned=True):
+def session_scope(id_, versioned=True, read_only=False):
     """
     Provide a transactional scope around a series of operations.
 
@@ -119,6 +195,9 @@ def session_scope(id_, versioned=True):
     ----------
     versioned : bool
         Do you want to enable the transaction log?
+    read_only : bool
+        Will the session only be used for reading? If so, it may be served
+        by a replica (see engine_for_id).
     debug : bool
         Do you want to turn on SQL echoing? Use with caution. Engine is not
         cached in this case!
@@ -129,8 +208,8 @@ def session_scope(id_, versioned=True):
         The created session.
 
     """
-    engine = engine_manager.get_for_id(id_)
-    session = new_session(engine, versioned)
+    engine = engine_for_id(id_, read_only)
+    session = new_session(engine, versioned, read_only)
 
     try:
         if config.get('LOG_DB_SESSIONS'):
@@ -161,10 +240,10 @@ def session_scope(id_, versioned=True):
 
 
 @contextmanager
-def session_scope_by_shard_id(shard_id, versioned=True):
+def session_scope_by_shard_id(shard_id, versioned=True, read_only=False):
     key = shard_id << 48
 
-    with session_scope(key, versioned) as db_session:
+    with session_scope(key, versioned, read_only) as db_session:
         yield db_session
 
 
@@ -1,10 +1,14 @@
+from datetime import datetime
+
 from sqlalchemy import (Column, BigInteger, String, ForeignKey, Index, Enum,
-                        inspect)
+                        inspect, select)
 from sqlalchemy.orm import relationship
 
 from inbox.models.base import MailSyncBase
 from inbox.models.mixins import HasPublicID, HasRevisions
 from inbox.models.namespace import Namespace
+from inbox.sqlalchemy_ext.util import generate_public_id
+from inbox.transactions.cache import transaction_cache, LatestTransaction
 
 
 class Transaction(MailSyncBase, HasPublicID):
@@ -43,8 +47,13 @@ Index('ix_accounttransaction_namespace_id_created_at',
       AccountTransaction.namespace_id, AccountTransaction.created_at)
 
 
-def is_dirty(session, obj):
-    if obj in session.dirty and obj.has_versioned_changes():
+def is_dirty(obj):
+    """
+    Whether a persistent object in session.dirty has changes that should be
+    versioned. Must be called with the pre-flush attribute history.
+
+    """
+    if obj.has_versioned_changes():
         return True
     if hasattr(obj, 'dirty') and getattr(obj, 'dirty'):
         return True
@@ -52,44 +61,116 @@ def is_dirty(session, obj):
 
 
 def create_revisions(session):
-    for obj in session:
-        if (not isinstance(obj, HasRevisions) or
-                obj.should_suppress_transaction_creation):
-            continue
-        if obj in session.new:
-            create_revision(obj, session, 'insert')
-        elif is_dirty(session, obj):
+    """
+    Write Transaction (and AccountTransaction) records for the versioned
+    objects in the flush that just happened. Must be called post-flush, so
+    that new objects have ids, but while session.new/dirty/deleted still
+    hold the pre-flush state.
+
+    Only the objects in the flush are inspected, and the records are written
+    with one executemany INSERT per table instead of being added to the
+    session, which would put them through another pass of the unit of work.
+
+    """
+    revisions = []
+    for obj in session.new:
+        if isinstance(obj, HasRevisions):
+            revisions.append((obj, 'insert'))
+    for obj in session.dirty:
+        if isinstance(obj, HasRevisions) and is_dirty(obj):
             # Need to unmark the object as 'dirty' to prevent an infinite loop
             # (the pre-flush hook may be called again before a commit
             # occurs). This emulates what happens to objects in session.dirty,
             # in that they are no longer present in the set during the next
             # invocation of the pre-flush hook.
             obj.dirty = False
-            create_revision(obj, session, 'update')
-        elif obj in session.deleted:
-            create_revision(obj, session, 'delete')
-
-
-def create_revision(obj, session, revision_type):
-    assert revision_type in ('insert', 'update', 'delete')
+            revisions.append((obj, 'update'))
+    for obj in session.deleted:
+        if isinstance(obj, HasRevisions):
+            revisions.append((obj, 'delete'))
+
+    rows = []
+    account_rows = []
+    created_at = datetime.utcnow()
+    for obj, revision_type in revisions:
+        if obj.should_suppress_transaction_creation:
+            continue
+        row = dict(command=revision_type, record_id=obj.id,
+                   object_type=obj.API_OBJECT_NAME,
+                   object_public_id=obj.public_id,
+                   namespace_id=_namespace_id(obj),
+                   created_at=created_at)
+        # Always create a Transaction record -- this maintains a total
+        # ordering over all events for an account.
+        rows.append(dict(row, public_id=generate_public_id()))
+        # Additionally, record account-level events in the
+        # AccountTransaction -- this is an optimization needed so these
+        # sparse events can be still be retrieved efficiently for webhooks
+        # etc.
+        if obj.API_OBJECT_NAME == 'account':
+            account_rows.append(dict(row, public_id=generate_public_id()))
+
+    if not rows:
+        return
+    session.execute(Transaction.__table__.insert(), rows, mapper=Transaction)
+    if account_rows:
+        session.execute(AccountTransaction.__table__.insert(), account_rows,
+                        mapper=AccountTransaction)
+    track_new_transactions(session, rows)
+
+
+def _namespace_id(obj):
+    # Use the foreign key where there is one rather than loading the
+    # namespace relationship.
+    namespace_id = getattr(obj, 'namespace_id', None)
+    if namespace_id is None:
+        namespace_id = obj.namespace.id
+    return namespace_id
+
+
+def track_new_transactions(session, rows):
+    """
+    Remember the newest Transaction written for each namespace, so that the
+    latest-transaction cache can be updated once the session commits.
 
-    # Always create a Transaction record -- this maintains a total ordering over
-    # all events for an account.
-    revision = Transaction(command=revision_type, record_id=obj.id,
-                           object_type=obj.API_OBJECT_NAME,
-                           object_public_id=obj.public_id,
-                           namespace_id=obj.namespace.id)
-    session.add(revision)
+    Parameters
+    ----------
+    session: Session
+    rows: list of dict
+        The rows just inserted into the transaction table, in insertion
+        order.
 
-    # Additionally, record account-level events in the AccountTransaction --
-    # this is an optimization needed so these sparse events can be still be
-    # retrieved efficiently for webhooks etc.
-    if obj.API_OBJECT_NAME == 'account':
-        revision = AccountTransaction(command=revision_type, record_id=obj.id,
-                                      object_type=obj.API_OBJECT_NAME,
-                                      object_public_id=obj.public_id,
-                                      namespace_id=obj.namespace.id)
-        session.add(revision)
+    """
+    newest = {}
+    for row in rows:
+        newest[row['namespace_id']] = row['public_id']
+
+    # An executemany doesn't report the ids it generated, so look up the last
+    # row for each namespace by its (indexed) public id.
+    table = Transaction.__table__
+    query = select([table.c.id, table.c.namespace_id, table.c.public_id,
+                    table.c.created_at]). \
+        where(table.c.public_id.in_(newest.values()))
+    pending = session.info.setdefault('new_transactions', {})
+    for id_, namespace_id, public_id, created_at in session.execute(
+            query, mapper=Transaction):
+        current = pending.get(namespace_id)
+        if current is None or current.id < id_:
+            pending[namespace_id] = LatestTransaction(id_, public_id,
+                                                      created_at)
+
+
+def publish_new_transactions(session):
+    pending = session.info.pop('new_transactions', None)
+    if not pending:
+        return
+    for namespace_id, latest in pending.iteritems():
+        transaction_cache.set_latest(namespace_id, latest)
+        transaction_cache.mark_written(namespace_id)
+
+
+def discard_new_transactions(session):
+    session.info.pop('new_transactions', None)
 
 
 def propagate_changes(session):
@@ -101,21 +182,27 @@ def propagate_changes(session):
     changes, the message.thread is marked as dirty.
     """
     from inbox.models.message import Message
+    propagated = set()
     for obj in session.dirty:
         if isinstance(obj, Message):
             obj_state = inspect(obj)
             for attr in obj.propagated_attributes:
                 if getattr(obj_state.attrs, attr).history.has_changes():
                     obj.thread.dirty = True
+                    propagated.add(obj.thread)
+                    break
+    session.info['propagated_changes'] = propagated
 
 
 def increment_versions(session):
     from inbox.models.thread import Thread
     from inbox.models.metadata import Metadata
-    for obj in session:
-        if isinstance(obj, Thread) and is_dirty(session, obj):
+    candidates = set(session.dirty)
+    candidates.update(session.info.pop('propagated_changes', ()))
+    for obj in candidates:
+        if isinstance(obj, Thread) and is_dirty(obj):
             # This issues SQL for an atomic increment.
             obj.version = Thread.version + 1
-        if isinstance(obj, Metadata) and is_dirty(session, obj):
+        if isinstance(obj, Metadata) and is_dirty(obj):
             # This issues SQL for an atomic increment.
             obj.version = Metadata.version + 1  # TODO what's going on here?
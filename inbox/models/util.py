@@ -1,7 +1,4 @@
 import time
-import math
-import gevent
-import requests
 import datetime
 from collections import OrderedDict
 
@@ -12,10 +9,20 @@ from inbox.models.session import session_scope
 from nylas.logging.sentry import log_uncaught_errors
 from inbox.heartbeat.status import clear_heartbeat_status
 from inbox.models.session import session_scope_by_shard_id
+from inbox.models.base import MailSyncBase
+from inbox.models.namespace_cache import invalidate_namespace
+from inbox.models.deletion import (DELETE_CONCURRENCY, DeletionProgress,
+                                   delete_tables)
+from inbox.util.throttle import get_throttle
+from inbox.models.partitioning import (TRANSACTION_LOG_PARTITIONED,
+                                       is_partitioned, ensure_partitions,
+                                       drop_partitions_before)
 
 from nylas.logging import get_logger
 
-CHUNK_SIZE = 1000
+# Number of days ahead of time to create transaction log partitions for.
+TRANSACTION_LOG_PARTITIONS_AHEAD = config.get(
+    'TRANSACTION_LOG_PARTITIONS_AHEAD', 7)
 
 log = get_logger()
 
@@ -147,7 +154,15 @@ def delete_marked_accounts(shard_id, ids_to_delete, throttle=False,
              time=end - start, count=deleted_count)
 
 
-def delete_namespace(account_id, namespace_id, throttle=False, dry_run=False):
+# Functions called with the public id of each namespace whose data
+# delete_namespace() deleted, e.g. so that caches of it can be invalidated.
+# The namespace cache is always invalidated, so that the API stops
+# authenticating requests for deleted namespaces.
+namespace_deletion_hooks = [invalidate_namespace]
+
+
+def delete_namespace(account_id, namespace_id, throttle=False, dry_run=False,
+                     concurrency=DELETE_CONCURRENCY, progress=None):
     """
     Delete all the data associated with a namespace from the database.
     USE WITH CAUTION.
@@ -155,6 +170,10 @@ def delete_namespace(account_id, namespace_id, throttle=False, dry_run=False):
     NOTE: This function is only called from bin/delete-account-data.
     It prints to stdout.
 
+    Large tables are deleted from concurrently (up to `concurrency` at a
+    time) where the schema allows, see inbox.models.deletion. Pass a
+    DeletionProgress to track progress, or to resume a previous run.
+
     """
     from inbox.ignition import engine_manager
 
@@ -176,6 +195,7 @@ def delete_namespace(account_id, namespace_id, throttle=False, dry_run=False):
 
     with session_scope(namespace_id) as db_session:
         account = db_session.query(Account).get(account_id)
+        namespace_public_id = account.namespace.public_id
         if account.discriminator != 'easaccount':
             filters['imapuid'] = ('account_id', account_id)
             filters['imapfoldersyncstatus'] = ('account_id', account_id)
@@ -184,9 +204,14 @@ def delete_namespace(account_id, namespace_id, throttle=False, dry_run=False):
             filters['easuid'] = ('easaccount_id', account_id)
             filters['easfoldersyncstatus'] = ('account_id', account_id)
 
-    for cls in filters:
-        _batch_delete(engine, cls, filters[cls], throttle=throttle,
-                      dry_run=dry_run)
+    progress = progress or DeletionProgress()
+    if throttle:
+        throttle = get_throttle('delete_namespace',
+                                engine_manager.shard_key_for_id(namespace_id))
+    else:
+        throttle = None
+    delete_tables(engine, filters, MailSyncBase.metadata, progress,
+                  throttle=throttle, dry_run=dry_run, concurrency=concurrency)
 
     # Use a single delete for the other tables. Rows from tables which contain
     # cascade-deleted foreign keys to other tables deleted here (or above)
@@ -208,9 +233,8 @@ def delete_namespace(account_id, namespace_id, throttle=False, dry_run=False):
         log.info('Performing bulk deletion', table=table)
         start = time.time()
 
-        if throttle and check_throttle():
-            log.info("Throttling deletion")
-            gevent.sleep(60)
+        if throttle is not None:
+            throttle.acquire(0)
 
         if not dry_run:
             engine.execute(query.format(table, column, id_))
@@ -228,105 +252,66 @@ def delete_namespace(account_id, namespace_id, throttle=False, dry_run=False):
             db_session.delete(account)
             db_session.commit()
 
+    if dry_run is False:
+        for hook in namespace_deletion_hooks:
+            hook(namespace_public_id)
 
-def _batch_delete(engine, table, xxx_todo_changeme, throttle=False,
-                  dry_run=False):
-    (column, id_) = xxx_todo_changeme
-    count = engine.execute(
-        'SELECT COUNT(*) FROM {} WHERE {}={};'.format(table, column, id_)).\
-        scalar()
-
-    if count == 0:
-        log.info('Completed batch deletion', table=table)
-        return
-
-    batches = int(math.ceil(float(count) / CHUNK_SIZE))
-
-    log.info('Starting batch deletion', table=table, count=count,
-             batches=batches)
-    start = time.time()
-
-    query = 'DELETE FROM {} WHERE {}={} LIMIT 2000;'.format(table, column, id_)
-
-    for i in range(0, batches):
-        if throttle and check_throttle():
-            log.info("Throttling deletion")
-            gevent.sleep(60)
-        if dry_run is False:
-            if table == "message":
-                # messages must be order by the foreign key `received_date`
-                # otherwise MySQL will raise an error when deleting
-                # from the message table
-                query = ('DELETE FROM message WHERE {}={} '
-                         'ORDER BY received_date desc LIMIT 2000;'
-                         .format(column, id_))
-            engine.execute(query)
-        else:
-            log.debug(query)
 
-    end = time.time()
-    log.info('Completed batch deletion', time=end - start, table=table)
+def _purge_transaction_partitions(shard_id, days_ago, throttle, dry_run,
+                                  now):
+    now = now or datetime.datetime.utcnow()
+    try:
+        if throttle:
+            get_throttle('purge_transactions', shard_id).acquire(0)
+        with session_scope_by_shard_id(shard_id, versioned=False) as \
+                db_session:
+            conn = db_session.connection()
+            if not is_partitioned(conn, 'transaction'):
+                log.warning("Transaction table isn't partitioned, "
+                            "purging with deletes", shard_id=shard_id)
+                return False
+            if not dry_run:
+                created = ensure_partitions(conn, 'transaction', now.date(),
+                                            TRANSACTION_LOG_PARTITIONS_AHEAD)
+                if created:
+                    log.info("Created transaction table partitions",
+                             shard_id=shard_id, partitions=created)
+            dropped = drop_partitions_before(
+                conn, 'transaction',
+                now - datetime.timedelta(days=days_ago), dry_run)
+        log.info("Finished purging transaction table for shard",
+                 shard_id=shard_id, date_delta=days_ago,
+                 partitions_dropped=len(dropped))
+        return True
+    except Exception as e:
+        log.critical("Exception encountered while dropping partitions, "
+                     "purging with deletes", shard_id=shard_id, exception=e)
+        return False
 
 
-def check_throttle():
+def purge_transactions(shard_id, days_ago=60, limit=1000, throttle=False,
+                       dry_run=False, now=None, partitioned=None):
     """
-    Returns True if deletions should be throttled and False otherwise.
+    Delete the transactions on shard `shard_id` that are older than
+    `days_ago` days. If the transaction log is partitioned (see
+    inbox.models.partitioning), this is done by dropping the partitions that
+    only hold such transactions, and partitions for the coming
+    TRANSACTION_LOG_PARTITIONS_AHEAD days are created. Otherwise, the
+    transactions are deleted in batches of `limit` rows.
 
-    The current logic throttles deletions if any production sync-mysql-node
-    slaves are over 10 seconds behind their master, or if the average CPU load
-    across the production sync-mysql-node fleet is above 70%.
-
-    check_throttle is ignored entirely if the separate `throttle` flag is False
-    (meaning that throttling is not done at all), but if throttling is enabled,
-    this method determines when.
+    `partitioned` defaults to the TRANSACTION_LOG_PARTITIONED setting. Shards
+    whose transaction table turns out not to be partitioned, or whose
+    partitions can't be dropped, fall back to batched deletes.
 
     """
-    # Ensure replica lag is not spiking
-    base_url = config["UMPIRE_BASE_URL"]
-    replica_lag_url = ("https://{}/check?metric=maxSeries(servers.prod."
-                       "sync-mysql-node.*.mysql.Seconds_Behind_Master)"
-                       "&max=10&min=0&range=300".format(base_url))
-
-    cpu_url = ('https://{}/check?metric=maxSeries(offset(scale(groupByNode('
-               'servers.prod.sync-mysql-node.*.cpu.cpu*.idle,3,'
-               '"averageSeries"),-1),100))&max=70&min=0&range=300'.
-               format(base_url))
-
-    replica_lag_status_code = requests.get(replica_lag_url).status_code
-    cpu_status_code = requests.get(cpu_url).status_code
-    if replica_lag_status_code != 200 or cpu_status_code != 200:
-        return True
-
-    # Stop deletion before backups are scheduled to start and resume
-    # when backups complete (~8.5 hours later but allow 9h just in case)
-    #
-    # Unifying this with the actual backup timing is tracked in
-    # https://phab.nylas.com/T6786
-    backup_start_hour_utc = 8  # CHANGE THIS if backups get rescheduled
-    backup_duration_hours = 9  # CHANGE THIS if backup length changes much
-    backup_end_hour_utc = (backup_start_hour_utc + backup_duration_hours) % 24
-    now = datetime.datetime.utcnow()
-    # We are trying to throttle during a specific backup window of
-    # <backup_duration_hours> hours, but the window may wrap around from one
-    # day to the next, making it difficult to do a naive hour comparison.
-    #
-    # Therefore we have to compare the current hour to the backup window in
-    # multiple chunks. First we compare to the part of the window in the same
-    # day as when the backup started, and then we compare to the part of the
-    # window in the next day.
-    if (now.hour >= backup_start_hour_utc and
-            now.hour < min(backup_start_hour_utc + backup_duration_hours, 24)):
-        return True
-    elif (backup_end_hour_utc <= backup_start_hour_utc and
-          now.hour < backup_end_hour_utc and
-          now.hour >= (backup_end_hour_utc - backup_duration_hours)):
-        return True
-    else:
-        return False
-
+    if partitioned is None:
+        partitioned = TRANSACTION_LOG_PARTITIONED
+    if partitioned and _purge_transaction_partitions(shard_id, days_ago,
+                                                     throttle, dry_run, now):
+        return
+    throttle = get_throttle('purge_transactions', shard_id) if throttle \
+        else None
 
-def purge_transactions(shard_id, days_ago=60, limit=1000, throttle=False,
-                       dry_run=False, now=None):
     start = 'now()'
     if now is not None:
         start = "'{}'".format(now.strftime('%Y-%m-%d %H:%M:%S'))
@@ -345,9 +330,9 @@ def purge_transactions(shard_id, days_ago=60, limit=1000, throttle=False,
         # delete from rows until there are no more rows affected
         rowcount = 1
         while rowcount > 0:
-            while throttle and check_throttle():
-                log.info("Throttling deletion")
-                gevent.sleep(60)
+            if throttle is not None:
+                # Pay for the previous batch.
+                throttle.acquire(rowcount)
             with session_scope_by_shard_id(shard_id, versioned=False) as \
                     db_session:
                 if dry_run:
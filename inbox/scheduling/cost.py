@@ -0,0 +1,72 @@
+"""
+Estimates of how much sync work each account is, for placing accounts on
+sync processes.
+
+Costs are in units of an idle account: an account that's done with its
+initial sync and has a handful of small folders costs about 1. On top of
+that, every folder and every remote UID adds a little, and folders that are
+still in their initial sync weigh INITIAL_SYNC_FACTOR times as much, since
+downloading messages is far more work than polling for changes. Accounts
+that have never been synced (and so have no folder statuses yet) are
+assumed to cost NEW_ACCOUNT_COST.
+
+"""
+from inbox.config import config
+from inbox.models import Account
+from inbox.models.backends.imap import ImapFolderSyncStatus
+
+ACCOUNT_BASE_COST = config.get('SYNC_ACCOUNT_BASE_COST', 1.0)
+FOLDER_COST = config.get('SYNC_FOLDER_COST', 0.05)
+# Cost per remote UID, i.e. 1 per 100k messages.
+UID_COST = config.get('SYNC_UID_COST', 0.00001)
+INITIAL_SYNC_FACTOR = config.get('SYNC_INITIAL_SYNC_FACTOR', 5.0)
+NEW_ACCOUNT_COST = config.get('SYNC_NEW_ACCOUNT_COST', 10.0)
+
+INITIAL_STATES = ('initial', 'initial uidinvalid')
+# How many accounts to estimate the cost of per query.
+CHUNK_SIZE = 1000
+
+
+def account_cost(sync_state, folders):
+    """
+    Parameters
+    ----------
+    sync_state: string or None
+        The account's sync_state.
+    folders: list of (string, dict) tuples
+        The state and metrics of each of the account's ImapFolderSyncStatus.
+
+    """
+    if not folders:
+        return NEW_ACCOUNT_COST if sync_state is None else ACCOUNT_BASE_COST
+    cost = ACCOUNT_BASE_COST
+    for state, metrics in folders:
+        folder_cost = FOLDER_COST + \
+            UID_COST * ((metrics or {}).get('remote_uid_count') or 0)
+        if state in INITIAL_STATES:
+            folder_cost *= INITIAL_SYNC_FACTOR
+        cost += folder_cost
+    return round(cost, 2)
+
+
+def estimate_costs(db_session, account_ids):
+    """
+    Returns a dict mapping each of `account_ids` (which must all be on the
+    shard of `db_session`) that exists to its estimated cost.
+
+    """
+    account_ids = sorted(account_ids)
+    costs = {}
+    for i in range(0, len(account_ids), CHUNK_SIZE):
+        chunk = account_ids[i:i + CHUNK_SIZE]
+        sync_states = dict(db_session.query(
+            Account.id, Account.sync_state).filter(Account.id.in_(chunk)))
+        folders = {account_id: [] for account_id in sync_states}
+        for account_id, state, metrics in db_session.query(
+                ImapFolderSyncStatus.account_id, ImapFolderSyncStatus.state,
+                ImapFolderSyncStatus._metrics).filter(
+                    ImapFolderSyncStatus.account_id.in_(chunk)):
+            folders[account_id].append((state, metrics))
+        for account_id, sync_state in sync_states.iteritems():
+            costs[account_id] = account_cost(sync_state, folders[account_id])
+    return costs
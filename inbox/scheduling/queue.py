@@ -1,38 +1,65 @@
 """This module contains code for managing Redis-backed account sync allocation.
 Structurally, that works like this:
 
-                                Redis list                Redis hash
-                             (acct ids to be        (acct ids -> proc ids)
-                                 synced)            +---------+---------+
-  +------------+             +----+----+----+       |    33   |   42    |
-  |  mysql db  | -------- -> | 44 | 37 | 22 | ----> +---------+---------+
-  +------------+     |       +----+----+----+   |   | hostA:3 | hostB:7 |
-                     |                          |   +---------+---------+
-                QueuePopulator             SyncService
+                             Redis sorted set             Redis hash
+                            (acct ids to be         (acct ids -> proc ids)
+                           synced, by cost)         +---------+---------+
+  +------------+          +------+------+           |    33   |   42    |
+  |  mysql db  | ------>  | 44:1 | 37:9 | -------> +---------+---------+
+  +------------+    |     +------+------+     |     | hostA:3 | hostB:7 |
+                    |                         |     +---------+---------+
+               QueuePopulator            SyncService
 
 
 The QueuePopulator is responsible for pulling all syncable account ids from the
 core mailsync MySQL database. It populates a Redis queue with any account ids
-not currently being synced. Individual sync processes pull account ids off of
-this queue, and claim ownership by updating a Redis hash that maps account
+not currently being synced, along with an estimate of how costly each is to
+sync (see inbox.scheduling.cost). Individual sync processes claim account ids
+from this queue, and claim ownership by updating a Redis hash that maps account
 ids to process identifiers. We use a bit of Redis Lua scripting to ensure that
 this happens atomically.
+
+Each sync process has a capacity, in the same units as account costs, and
+only claims accounts that fit into what's left of it. Processes also
+advertise their capacity and load, so that a process that has become
+overloaded (say, because an account it syncs turned out to be huge) can hand
+its hottest account back to the queue when another process has room for it.
 """
+import json
+import time
+import itertools
+from datetime import timedelta
 
 import gevent
-import itertools
 from inbox.config import config
 from inbox.ignition import engine_manager
 from inbox.models.session import session_scope_by_shard_id
 from inbox.models import Account
+from inbox.scheduling.cost import NEW_ACCOUNT_COST, estimate_costs
 from inbox.util.concurrency import retry_with_logging
 from inbox.util.stats import statsd_client
 from nylas.logging import get_logger
 from redis import StrictRedis
+from sqlalchemy import func
 log = get_logger()
 
 SOCKET_CONNECT_TIMEOUT = 5
 SOCKET_TIMEOUT = 5
+# Advertisements of process capacity older than this are ignored (so that
+# processes that are gone aren't handed accounts).
+ADVERTISEMENT_MAX_AGE = 60
+# How long sync state handed off by a process that stopped syncing an account
+# is kept for the next process to claim it.
+HANDOFF_TTL = config.get('SYNC_HANDOFF_TTL', 600)
+# How often the QueuePopulator re-estimates the costs of assigned accounts.
+COST_REFRESH_INTERVAL = config.get('SYNC_COST_REFRESH_INTERVAL', 300)
+# How often the QueuePopulator compares all runnable accounts against Redis,
+# rather than just the accounts that changed.
+RECONCILIATION_INTERVAL = config.get('SYNC_QUEUE_RECONCILIATION_INTERVAL', 600)
+# How far before the high-water mark to look for changed accounts, since
+# updated_at is set when a change is flushed, not when it's committed.
+HIGH_WATER_MARK_OVERLAP = timedelta(
+    seconds=config.get('SYNC_QUEUE_CHANGE_OVERLAP', 60))
 
 
 class QueueClient(object):
@@ -40,12 +67,21 @@ class QueueClient(object):
     allocation.
     """
 
-    # Lua scripts for atomic assignment and conflict-free unassignment.
+    # Lua scripts for atomic assignment, conflict-free unassignment, and
+    # handing an account back to the queue. Assignment takes the costliest
+    # account that fits the budget; the queue can hold every account of the
+    # zone (e.g. after a restart), so only the one needed is fetched.
     ASSIGN = '''
-    local k = redis.call('RPOP', KEYS[1])
+    local k = redis.call('ZREVRANGEBYSCORE', KEYS[1], ARGV[2], '-inf',
+                         'LIMIT', 0, 1)[1]
+    if not k and ARGV[3] == '1' then
+        k = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', '+inf',
+                       'LIMIT', 0, 1)[1]
+    end
     if k then
-        local s = redis.call('HSETNX', KEYS[2], k, ARGV[1])
-        if s then
+        redis.call('ZREM', KEYS[1], k)
+        if not redis.call('HGET', KEYS[2], k) then
+            redis.call('HSET', KEYS[2], k, ARGV[1])
             return k
         end
     end'''
@@ -58,6 +94,16 @@ class QueueClient(object):
     end
     '''
 
+    RELEASE = '''
+    if redis.call('HGET', KEYS[1], KEYS[3]) == ARGV[1] then
+        redis.call('HDEL', KEYS[1], KEYS[3])
+        redis.call('ZADD', KEYS[2], ARGV[2], KEYS[3])
+        return 1
+    else
+        return 0
+    end
+    '''
+
     def __init__(self, zone):
         self.zone = zone
         redis_host = config['ACCOUNT_QUEUE_REDIS_HOSTNAME']
@@ -73,31 +119,61 @@ class QueueClient(object):
         """
         p = self.redis.pipeline(transaction=True)
         p.hgetall(self._hash)
-        p.lrange(self._queue, 0, -1)
+        p.zrange(self._queue, 0, -1)
         unassigned, assigned = p.execute()
         return {int(k) for k in itertools.chain(unassigned, assigned)}
 
-    def assigned(self):
+    def assigned(self, keys=None):
         """
         Returns a dictionary of all currently assigned key/value pairs (keys
-        are coerced to integers).
+        are coerced to integers), or only of those for `keys` if given.
+        """
+        if keys is None:
+            return {int(k): v for k, v in
+                    self.redis.hgetall(self._hash).items()}
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self.redis.hmget(self._hash, keys)
+        return {int(k): v for k, v in zip(keys, values) if v is not None}
+
+    def tracked(self, keys):
+        """
+        Returns the subset of `keys` that are being tracked (either pending
+        in the queue, or already assigned).
         """
-        return {int(k): v for k, v in self.redis.hgetall(self._hash).items()}
+        keys = list(keys)
+        p = self.redis.pipeline(transaction=True)
+        for key in keys:
+            p.hexists(self._hash, key)
+            p.zscore(self._queue, key)
+        results = p.execute()
+        return {key for key, assigned, score in
+                zip(keys, results[::2], results[1::2])
+                if assigned or score is not None}
 
-    def enqueue(self, key):
+    def enqueue(self, key, cost=NEW_ACCOUNT_COST):
         """
-        Adds a new key onto the pending queue.
+        Adds a new key onto the pending queue, with its estimated cost.
         """
-        self.redis.lpush(self._queue, key)
+        p = self.redis.pipeline(transaction=True)
+        p.zadd(self._queue, **{str(key): cost})
+        p.hset(self._costs, key, cost)
+        p.execute()
 
-    def claim_next(self, value):
+    def claim_next(self, value, budget=None, idle=False):
         """
-        Pulls the next key off of the pending queue (if any exists), and sets
-        it to `value` in the hash. Returns None if the queue is empty or if the
-        key is already present in the hash; otherwise returns the key.
+        Takes the costliest key that costs at most `budget` (if given) off of
+        the pending queue, and sets it to `value` in the hash. If `idle`
+        is True and no key fits the budget, takes the cheapest key instead, so
+        that accounts costlier than any process's capacity still get synced.
+        Returns None if there's no such key or if the key is already present
+        in the hash; otherwise returns the key.
         """
         s = self.redis.register_script(self.ASSIGN)
-        return s(keys=[self._queue, self._hash], args=[value])
+        return s(keys=[self._queue, self._hash],
+                 args=[value, '+inf' if budget is None else budget,
+                       1 if idle else 0])
 
     def unassign(self, key, value):
         """
@@ -107,30 +183,125 @@ class QueueClient(object):
         s = self.redis.register_script(self.UNASSIGN)
         return s(keys=[self._hash, key], args=[value])
 
+    def release(self, key, value):
+        """
+        Like unassign(), but also puts `key` back onto the pending queue for
+        another process to claim.
+        """
+        s = self.redis.register_script(self.RELEASE)
+        return s(keys=[self._hash, self._queue, key],
+                 args=[value, self.costs([key])[key]])
+
+    def costs(self, keys):
+        """
+        Returns a dictionary mapping each of `keys` to its estimated cost.
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self.redis.hmget(self._costs, keys)
+        return {key: float(value) if value is not None else NEW_ACCOUNT_COST
+                for key, value in zip(keys, values)}
+
+    def set_costs(self, costs):
+        """
+        Updates the estimated costs of accounts (a dictionary mapping keys to
+        costs), and forgets those of keys mapped to None.
+        """
+        p = self.redis.pipeline(transaction=False)
+        updated = {k: v for k, v in costs.items() if v is not None}
+        if updated:
+            p.hmset(self._costs, updated)
+        removed = [k for k, v in costs.items() if v is None]
+        if removed:
+            p.hdel(self._costs, *removed)
+        p.execute()
+
+    def advertise(self, value, capacity, load):
+        """
+        Publishes the capacity and current load of the process `value`.
+        """
+        self.redis.hset(self._processes, value, json.dumps(
+            {'capacity': capacity, 'load': load, 'at': time.time()}))
+
+    def spare_capacity(self, exclude=None, max_age=ADVERTISEMENT_MAX_AGE):
+        """
+        Returns the most spare capacity any process other than `exclude`
+        advertised in the last `max_age` seconds.
+        """
+        spare = 0
+        for value, ad in self.redis.hgetall(self._processes).items():
+            ad = json.loads(ad)
+            if value == exclude or ad['at'] < time.time() - max_age:
+                continue
+            spare = max(spare, ad['capacity'] - ad['load'])
+        return spare
+
+    def save_handoff(self, key, state, ttl=HANDOFF_TTL):
+        """
+        Stores the sync state `state` (anything that can be serialized as
+        JSON) for the next process to claim `key`, for up to `ttl` seconds.
+        """
+        self.redis.set(self._handoff(key), json.dumps(state), ex=ttl)
+
+    def take_handoff(self, key):
+        """
+        Returns and removes the sync state stored for `key`, or None.
+        """
+        p = self.redis.pipeline(transaction=True)
+        p.get(self._handoff(key))
+        p.delete(self._handoff(key))
+        state, _ = p.execute()
+        return json.loads(state) if state is not None else None
+
     def qsize(self):
         """
         Returns current length of the queue.
         """
-        return self.redis.llen(self._queue)
+        return self.redis.zcard(self._queue)
 
     @property
     def _queue(self):
-        return 'unassigned_{}'.format(self.zone)
+        return 'pending_{}'.format(self.zone)
 
     @property
     def _hash(self):
         return 'assigned_{}'.format(self.zone)
 
+    @property
+    def _costs(self):
+        return 'costs_{}'.format(self.zone)
+
+    @property
+    def _processes(self):
+        return 'processes_{}'.format(self.zone)
+
+    def _handoff(self, key):
+        return 'handoff_{}_{}'.format(self.zone, key)
+
 
 class QueuePopulator(object):
     """
     Polls the database for account ids to sync and queues them. Run one of
     these per zone.
+
+    Every `reconciliation_interval` seconds, all runnable accounts are
+    compared against what's in Redis. In between, only the accounts updated
+    since the last poll (going by Account.updated_at, with some overlap to
+    make up for transactions that commit late) are looked at.
     """
 
-    def __init__(self, zone, poll_interval=1):
+    def __init__(self, zone, poll_interval=1,
+                 cost_refresh_interval=COST_REFRESH_INTERVAL,
+                 reconciliation_interval=RECONCILIATION_INTERVAL):
         self.zone = zone
         self.poll_interval = poll_interval
+        self.cost_refresh_interval = cost_refresh_interval
+        self.costs_refreshed_at = None
+        self.reconciliation_interval = reconciliation_interval
+        self.reconciled_at = None
+        # Per shard, the latest updated_at of the accounts looked at.
+        self.high_water_marks = {}
         self.queue_client = QueueClient(zone)
         self.shards = []
         for database in config['DATABASE_HOSTS']:
@@ -145,35 +316,135 @@ class QueuePopulator(object):
     def _run_impl(self):
         log.info('Queueing accounts', zone=self.zone, shards=self.shards)
         while True:
-            self.enqueue_new_accounts()
-            self.unassign_disabled_accounts()
+            if self.reconciled_at is None or time.time() - \
+                    self.reconciled_at > self.reconciliation_interval:
+                self.reconcile()
+            else:
+                self.apply_changes()
+            if self.costs_refreshed_at is None or time.time() - \
+                    self.costs_refreshed_at > self.cost_refresh_interval:
+                self.update_costs()
             statsd_client.gauge('syncqueue.queue.{}.length'.format(self.zone),
                                 self.queue_client.qsize())
             statsd_client.incr('syncqueue.service.{}.heartbeat'.
                                format(self.zone))
             gevent.sleep(self.poll_interval)
 
-    def enqueue_new_accounts(self):
+    def reconcile(self):
+        """
+        Brings Redis in line with the runnable accounts in the database, and
+        resets the high-water marks that apply_changes() starts from.
+        """
+        start = time.time()
+        # Anything updated from here on is picked up by apply_changes() again.
+        high_water_marks = self.latest_updates()
+        runnable_accounts = self.runnable_accounts()
+        self.enqueue_new_accounts(runnable_accounts)
+        self.unassign_disabled_accounts(runnable_accounts)
+        self.high_water_marks = high_water_marks
+        self.reconciled_at = time.time()
+        statsd_client.timing('syncqueue.reconciliation.{}'.format(self.zone),
+                             (self.reconciled_at - start) * 1000)
+
+    def apply_changes(self):
+        """
+        Enqueues accounts that were enabled, and unassigns accounts that were
+        disabled, since the last time this (or reconcile()) ran.
+        """
+        enabled, disabled = set(), set()
+        for key in self.shards:
+            since = self.high_water_marks.get(key)
+            with session_scope_by_shard_id(key) as db_session:
+                q = db_session.query(Account.id, Account.sync_should_run,
+                                     Account.updated_at)
+                if since is not None:
+                    q = q.filter(Account.updated_at >=
+                                 since - HIGH_WATER_MARK_OVERLAP)
+                for id_, sync_should_run, updated_at in q:
+                    (enabled if sync_should_run else disabled).add(id_)
+                    if since is None or updated_at > since:
+                        since = updated_at
+            if since is not None:
+                self.high_water_marks[key] = since
+
+        if enabled:
+            self.enqueue_new_accounts(enabled, check_all=False)
+        if disabled:
+            self.unassign_disabled_accounts(enabled, disabled)
+
+    def enqueue_new_accounts(self, runnable_accounts=None, check_all=True):
         """
         Finds any account ids that should sync, but are not currently being
         tracked by the QueueClient. Enqueue them. (Note: it's okay to enqueue
         the same id twice. QueueClient.claim_next will identify and discard
-        duplicates.)
+        duplicates.) If `check_all` is False, only `runnable_accounts` are
+        looked up in Redis, instead of fetching everything tracked there.
         """
-        new_accounts = self.runnable_accounts() - self.queue_client.all()
+        if runnable_accounts is None:
+            runnable_accounts = self.runnable_accounts()
+        if check_all:
+            new_accounts = runnable_accounts - self.queue_client.all()
+        else:
+            new_accounts = runnable_accounts - \
+                self.queue_client.tracked(runnable_accounts)
+        costs = self.estimate_costs(new_accounts)
         for account_id in new_accounts:
-            log.info('Enqueuing new account', account_id=account_id)
-            self.queue_client.enqueue(account_id)
+            cost = costs.get(account_id, NEW_ACCOUNT_COST)
+            log.info('Enqueuing new account', account_id=account_id,
+                     cost=cost)
+            self.queue_client.enqueue(account_id, cost)
 
-    def unassign_disabled_accounts(self):
-        runnable_accounts = self.runnable_accounts()
+    def unassign_disabled_accounts(self, runnable_accounts=None,
+                                   candidates=None):
+        """
+        Unassigns any assigned account ids that aren't in
+        `runnable_accounts`. If `candidates` is given, only those are looked
+        up in Redis, instead of fetching all assignments.
+        """
+        if runnable_accounts is None:
+            runnable_accounts = self.runnable_accounts()
         disabled_accounts = {
-            k: v for k, v in self.queue_client.assigned().items()
+            k: v for k, v in self.queue_client.assigned(candidates).items()
             if k not in runnable_accounts
         }
         for account_id, sync_host in disabled_accounts.items():
             log.info('Removing disabled account', account_id=account_id)
             self.queue_client.unassign(account_id, sync_host)
+        if disabled_accounts:
+            self.queue_client.set_costs(
+                {account_id: None for account_id in disabled_accounts})
+
+    def update_costs(self):
+        """
+        Re-estimates the costs of assigned accounts, which change as their
+        initial sync progresses and their mailboxes grow.
+        """
+        costs = self.estimate_costs(self.queue_client.assigned())
+        if costs:
+            self.queue_client.set_costs(costs)
+        self.costs_refreshed_at = time.time()
+
+    def estimate_costs(self, account_ids):
+        by_shard = {}
+        for account_id in account_ids:
+            by_shard.setdefault(engine_manager.shard_key_for_id(account_id),
+                                []).append(account_id)
+        costs = {}
+        for key, shard_account_ids in by_shard.items():
+            if key not in self.shards:
+                continue
+            with session_scope_by_shard_id(key) as db_session:
+                costs.update(estimate_costs(db_session, shard_account_ids))
+        return costs
+
+    def latest_updates(self):
+        """ Returns the latest Account.updated_at on each shard. """
+        latest = {}
+        for key in self.shards:
+            with session_scope_by_shard_id(key) as db_session:
+                latest[key] = db_session.query(
+                    func.max(Account.updated_at)).scalar()
+        return latest
 
     def runnable_accounts(self):
         accounts = set()
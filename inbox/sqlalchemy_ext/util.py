@@ -8,7 +8,8 @@ from bson import json_util, EPOCH_NAIVE
 # Kind of a ridiculous solution, but works.
 json_util.EPOCH_AWARE = EPOCH_NAIVE
 
-from sqlalchemy import String, Text, event
+from sqlalchemy import (String, Text, Table, Column, MetaData, event, exists,
+                        and_)
 from sqlalchemy.types import TypeDecorator, BINARY
 from sqlalchemy.interfaces import PoolListener
 from sqlalchemy.engine import Engine
@@ -17,6 +18,7 @@ from sqlalchemy.ext.mutable import Mutable
 from sqlalchemy.ext.declarative import DeclarativeMeta
 
 from inbox.util.encoding import base36encode, base36decode
+from inbox.util.itert import chunk
 
 from nylas.logging import get_logger
 log = get_logger()
@@ -261,6 +263,70 @@ def maybe_refine_query(query, subquery):
     return query.join(subquery.subquery())
 
 
+def keyset_windows(query, id_field, window=1000, after_id=None,
+                   descending=False):
+    """
+    Iterate over the results of a query in windows of at most `window`
+    results, ordered by `id_field`. Each window is fetched with a keyset
+    predicate on the last id seen (`id_field > last_id`), rather than an
+    OFFSET or a server-side cursor, so every window is an index range scan
+    however far into the table it is, only one window is held in memory at
+    a time, and no transaction or connection needs to stay open between
+    windows: the caller may commit or roll back the session after each one.
+
+    The query may select whole entities or just columns. Column-only
+    queries skip the ORM (and its identity map) entirely, and are by far
+    the cheapest way to scan large tables. They must include `id_field`
+    (under its own name).
+
+    Parameters
+    ----------
+    query: sqlalchemy.Query
+        The query to iterate over. It must not be ordered or limited.
+    id_field: A SQLAlchemy attribute or column with unique values to use for
+        windowing. E.g., `Message.id`.
+    window: int
+        The number of results to fetch at a time.
+    after_id: optional
+        Only return results with id_field greater than (or, if
+        `descending`, less than) this value.
+    descending: bool
+        Iterate in decreasing order of id_field.
+
+    Yields
+    ------
+    list
+        Non-empty lists of results.
+
+    """
+    order = id_field.desc() if descending else id_field
+    last_id = after_id
+    while True:
+        windowed = query
+        if last_id is not None:
+            windowed = windowed.filter(id_field < last_id if descending else
+                                       id_field > last_id)
+        results = windowed.order_by(order).limit(window).all()
+        if not results:
+            return
+        yield results
+        if len(results) < window:
+            return
+        last_id = getattr(results[-1], id_field.key)
+
+
+def keyset_scan(query, id_field, window=1000, after_id=None,
+                descending=False):
+    """
+    Like keyset_windows, but yields individual results.
+
+    """
+    for results in keyset_windows(query, id_field, window, after_id,
+                                  descending):
+        for result in results:
+            yield result
+
+
 def safer_yield_per(query, id_field, start_id, count):
     """Incautious execution of 'for result in query.yield_per(N):' may cause
     slowness or OOMing over large tables. This is a less general but less
@@ -276,12 +342,118 @@ def safer_yield_per(query, id_field, start_id, count):
     count: int
         The number of results to fetch at a time.
     """
-    cur_id = start_id
-    while True:
-        results = query.filter(id_field >= cur_id).order_by(id_field).\
-            limit(count).all()
-        if not results:
-            return
-        for result in results:
-            yield result
-        cur_id = results[-1].id + 1
+    return keyset_scan(query, id_field, count, after_id=start_id - 1)
+
+
+class ValueSet(object):
+    """
+    A set of values to compare against the values of a column in the
+    database, without loading the whole column into Python and without
+    sending unboundedly large `IN (...)` lists (which can get deadly slow in
+    MySQL).
+
+    Sets of up to TEMP_TABLE_THRESHOLD values are sent inline in IN lists
+    of at most IN_CHUNK_SIZE values. Larger sets are loaded once into a
+    temporary table on the session's connection, and joined against. Use
+    a ValueSet as a context manager so that the temporary table is dropped,
+    and don't commit the session inside the block (the temporary table only
+    exists on the connection the session holds for its transaction).
+
+    Parameters
+    ----------
+    session: Session
+    values: iterable
+        The values in the set.
+    type_: sqlalchemy type
+        The type of the values, usually the `type` of the column they'll be
+        compared with. E.g. `Message.g_msgid.type`.
+
+    """
+    IN_CHUNK_SIZE = 1000
+    TEMP_TABLE_THRESHOLD = 20000
+    INSERT_CHUNK_SIZE = 10000
+
+    def __init__(self, session, values, type_):
+        self.session = session
+        self.values = set(values)
+        self.type_ = type_
+        self.table = None
+
+    def __enter__(self):
+        if len(self.values) > self.TEMP_TABLE_THRESHOLD:
+            self._create_table()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.table is not None:
+            self.session.execute('DROP TEMPORARY TABLE IF EXISTS {}'.format(
+                self.table.name))
+            self.table = None
+
+    def _create_table(self):
+        self.table = Table(
+            'tmp_values_{}'.format(uuid.uuid4().hex),
+            MetaData(),
+            Column('value', self.type_, primary_key=True, autoincrement=False),
+            prefixes=['TEMPORARY'])
+        self.table.create(bind=self.session.connection())
+        insert = self.table.insert().prefix_with('IGNORE')
+        for values in chunk(self.values, self.INSERT_CHUNK_SIZE):
+            self.session.execute(insert, [{'value': v} for v in values])
+
+    def existing(self, column, *criteria):
+        """
+        Returns the values in the set that occur in `column`, among the rows
+        matching `criteria`.
+
+        """
+        if not self.values:
+            return set()
+        if self.table is not None:
+            query = self.session.query(column).filter(
+                column == self.table.c.value, *criteria).distinct()
+            return {value for value, in query}
+        found = set()
+        for values in chunk(self.values, self.IN_CHUNK_SIZE):
+            query = self.session.query(column).filter(column.in_(values),
+                                                      *criteria)
+            found.update(value for value, in query)
+        return found
+
+    def missing(self, column, *criteria):
+        """
+        Returns the values in the set that don't occur in `column` among the
+        rows matching `criteria`.
+
+        """
+        if self.table is not None:
+            query = self.session.query(self.table.c.value).filter(
+                ~exists().where(and_(column == self.table.c.value,
+                                     *criteria)))
+            return {value for value, in query}
+        return self.values - self.existing(column, *criteria)
+
+    def extra(self, column, *criteria):
+        """
+        Returns the values of `column` among the rows matching `criteria`
+        that aren't in the set.
+
+        """
+        query = self.session.query(column).filter(*criteria)
+        if self.table is not None:
+            query = query.filter(
+                ~exists().where(self.table.c.value == column))
+            return {value for value, in query}
+        return {value for value, in query} - self.values
+
+
+def existing_values(session, column, values, *criteria):
+    """
+    Returns the subset of `values` that occur in `column` among the rows
+    matching `criteria`, i.e. the result of
+    `SELECT column ... WHERE column IN (values) AND criteria`, but fast for
+    large `values` too (see ValueSet).
+
+    """
+    with ValueSet(session, values, column.type) as value_set:
+        return value_set.existing(column, *criteria)
@@ -0,0 +1,144 @@
+"""
+Notifications that let the syncback service pick up new actions as soon as
+they're scheduled, instead of finding them by scanning the action log.
+
+When a session that scheduled actions commits, the namespaces it scheduled
+them for are published on a per-shard channel. If
+SYNCBACK_NOTIFICATION_REDIS_HOSTNAME is configured, the channels are Redis
+lists, which the syncback process responsible for each shard pops from.
+Otherwise they're kept in-process, which only reaches a syncback service
+running in the same process as the API (e.g. in development).
+
+Notifications are best-effort: one that's lost (e.g. because Redis is
+unavailable) is made up for by the syncback service's periodic scan.
+
+"""
+from collections import defaultdict
+
+import gevent
+from gevent.event import Event
+from redis import StrictRedis
+
+from inbox.config import config
+from inbox.util.stats import statsd_client
+from nylas.logging import get_logger
+log = get_logger()
+
+SOCKET_CONNECT_TIMEOUT = 1
+# Must be longer than the longest wait in ActionNotifier.receive().
+SOCKET_TIMEOUT = 10
+
+
+def _shard_id(namespace_id):
+    from inbox.ignition import engine_manager
+    return engine_manager.shard_key_for_id(namespace_id)
+
+
+class ActionNotifier(object):
+    KEY_PREFIX = 'syncback:pending:'
+
+    def __init__(self, redis=None):
+        self.redis = redis
+        self.local = defaultdict(set)
+        self.local_event = Event()
+
+    @property
+    def shared(self):
+        """ Whether notifications reach other processes. """
+        return self.redis is not None
+
+    def _key(self, shard_id):
+        return '{}{}'.format(self.KEY_PREFIX, shard_id)
+
+    def notify(self, namespace_ids):
+        """ Publish that actions were scheduled for `namespace_ids`. """
+        by_shard = defaultdict(set)
+        for namespace_id in namespace_ids:
+            by_shard[_shard_id(namespace_id)].add(namespace_id)
+
+        if self.redis is None:
+            for shard_id, ids in by_shard.iteritems():
+                self.local[shard_id].update(ids)
+            self.local_event.set()
+            return
+
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for shard_id, ids in by_shard.iteritems():
+                pipe.rpush(self._key(shard_id), *ids)
+            pipe.execute()
+        except Exception:
+            log.warning('Error publishing action notifications',
+                        namespace_ids=namespace_ids, exc_info=True)
+            statsd_client.incr('syncback.notifications.errors')
+
+    def receive(self, shard_ids, timeout):
+        """
+        Wait up to `timeout` seconds for actions to be scheduled on any of
+        the shards `shard_ids`. Returns a dict mapping each of those shards
+        that had any to the set of namespace ids they were scheduled for.
+
+        """
+        if not shard_ids:
+            gevent.sleep(timeout)
+            return {}
+
+        if self.redis is None:
+            if not any(shard_id in self.local for shard_id in shard_ids):
+                self.local_event.clear()
+                self.local_event.wait(timeout)
+            return {shard_id: self.local.pop(shard_id)
+                    for shard_id in shard_ids if shard_id in self.local}
+
+        keys = [self._key(shard_id) for shard_id in shard_ids]
+        received = defaultdict(set)
+        try:
+            first = self.redis.blpop(keys, timeout=max(1, int(timeout)))
+            if first is None:
+                return {}
+            key, namespace_id = first
+            received[key].add(int(namespace_id))
+            # Drain whatever else is queued up, atomically so that nothing
+            # pushed in between is lost.
+            pipe = self.redis.pipeline(transaction=True)
+            for key in keys:
+                pipe.lrange(key, 0, -1)
+                pipe.delete(key)
+            results = pipe.execute()
+        except Exception:
+            log.warning('Error receiving action notifications',
+                        exc_info=True)
+            statsd_client.incr('syncback.notifications.errors')
+            # Don't retry straight away: callers loop on this, and Redis may
+            # be refusing connections.
+            gevent.sleep(timeout)
+            return {}
+        for key, namespace_ids in zip(keys, results[::2]):
+            received[key].update(int(id_) for id_ in namespace_ids)
+        return {int(key[len(self.KEY_PREFIX):]): ids
+                for key, ids in received.iteritems() if ids}
+
+
+def _shared_redis_client():
+    redis_host = config.get('SYNCBACK_NOTIFICATION_REDIS_HOSTNAME')
+    if not redis_host:
+        return None
+    return StrictRedis(
+        host=redis_host,
+        port=int(config.get('SYNCBACK_NOTIFICATION_REDIS_PORT', 6379)),
+        db=int(config.get('SYNCBACK_NOTIFICATION_REDIS_DB', 0)),
+        socket_connect_timeout=SOCKET_CONNECT_TIMEOUT,
+        socket_timeout=SOCKET_TIMEOUT)
+
+
+action_notifier = ActionNotifier(redis=_shared_redis_client())
+
+
+def publish_new_actions(session):
+    namespace_ids = session.info.pop('new_actions', None)
+    if namespace_ids:
+        action_notifier.notify(namespace_ids)
+
+
+def discard_new_actions(session):
+    session.info.pop('new_actions', None)
@@ -2,11 +2,30 @@
 Monitor the action log for changes that should be synced back to the remote
 backend.
 
+New actions are picked up as soon as they're scheduled, from the
+notifications published by schedule_action() (see
+inbox.transactions.action_notifier). The action log itself is only scanned
+every SYNCBACK_RECONCILIATION_INTERVAL seconds, to pick up actions whose
+notifications were lost.
+
+Actions on the same object are executed in the order they were scheduled;
+unrelated actions for the same account are executed concurrently, up to one
+per writable IMAP connection the account is allowed
+(SYNCBACK_CONNECTIONS_PER_ACCOUNT).
+
+A failed action isn't retried in place: it's deferred, with exponential
+backoff and jitter, and the worker moves on. Each provider (each IMAP server,
+for generic IMAP accounts) also has a circuit breaker, which pauses syncback
+for all of its accounts while most of its actions fail to reach it (see
+inbox.util.circuit_breaker).
+
 TODO(emfree):
 * Make this more robust across multiple machines. If you started two instances
 talking to the same database backend things could go really badly.
 
 """
+import json
+import time
 from collections import defaultdict
 from datetime import datetime
 
@@ -21,11 +40,18 @@ from nylas.logging import get_logger
 from nylas.logging.sentry import log_uncaught_errors
 logger = get_logger()
 from inbox.ignition import engine_manager
+from inbox.basicauth import ConnectionError
+from inbox.crispin import (WRITABLE_CONNECTIONS_PER_ACCOUNT,
+                           CONN_UNUSABLE_EXC_CLASSES)
 from inbox.util.concurrency import retry_with_logging
+from inbox.util.circuit_breaker import CircuitBreaker, CLOSED
 from inbox.models.session import session_scope, session_scope_by_shard_id
 from inbox.models import ActionLog
 from inbox.util.stats import statsd_client
+from inbox.transactions.action_notifier import action_notifier
 from inbox.actions.base import (mark_unread, mark_starred, move, change_labels,
+                                mark_unread_multiple, mark_starred_multiple,
+                                move_multiple, change_labels_multiple,
                                 save_draft, update_draft, delete_draft,
                                 save_sent_email, create_folder, create_label,
                                 update_folder, update_label, delete_folder,
@@ -55,32 +81,92 @@ ACTION_FUNCTION_MAP = {
     'delete_label': delete_label
 }
 
+# Actions that affect an account's other actions (e.g. a move into a folder
+# has to wait for the folder to be created). They wait for all earlier
+# actions for the account to finish, and all later ones wait for them.
+ACCOUNT_WIDE_ACTIONS = {'create_folder', 'update_folder', 'delete_folder',
+                        'create_label', 'update_label', 'delete_label'}
+
+# Actions that can be applied to several messages at once. Pending actions of
+# the same type and with the same arguments are merged into a single call,
+# which issues one command per folder for all their messages.
+COALESCED_ACTION_FUNCTION_MAP = {
+    'mark_unread': mark_unread_multiple,
+    'mark_starred': mark_starred_multiple,
+    'move': move_multiple,
+    'change_labels': change_labels_multiple,
+}
+
 
 ACTION_MAX_NR_OF_RETRIES = 20
+# A failed action is retried after about ACTION_RETRY_BASE_DELAY * 2**retries
+# seconds, up to ACTION_RETRY_MAX_DELAY.
+ACTION_RETRY_BASE_DELAY = config.get('SYNCBACK_RETRY_BASE_DELAY', 5)
+ACTION_RETRY_MAX_DELAY = config.get('SYNCBACK_RETRY_MAX_DELAY', 600)
+# Settings for the per-provider circuit breakers, see CircuitBreaker.
+SYNCBACK_BREAKER_SETTINGS = config.get('SYNCBACK_BREAKER_SETTINGS', {})
+# Failures that count towards opening a circuit breaker: only those that say
+# the server can't be reached or used, not errors specific to an action.
+BREAKER_EXC_CLASSES = CONN_UNUSABLE_EXC_CLASSES + (ConnectionError,)
 NUM_PARALLEL_ACCOUNTS = 500
+# How many of an account's pending actions are claimed at once (and so can be
+# coalesced).
+SYNCBACK_BATCH_SIZE = config.get('SYNCBACK_BATCH_SIZE', 100)
 INVALID_ACCOUNT_GRACE_PERIOD = 60 * 60 * 2  # 2 hours
+# How often the whole action log is scanned for pending actions, if action
+# notifications are shared between processes. (Otherwise it's scanned every
+# poll_interval.)
+SYNCBACK_RECONCILIATION_INTERVAL = config.get(
+    'SYNCBACK_RECONCILIATION_INTERVAL', 60)
+
+
+def breaker_key(account):
+    """
+    Which circuit breaker the account's actions count towards: its provider's,
+    or for generic IMAP accounts, which don't share a server, its server's.
+
+    """
+    if account.provider == 'custom':
+        host, _ = account.imap_endpoint
+        # Dots would split the breaker's metrics.
+        return '{}.{}'.format(account.verbose_provider,
+                              host.lower().replace('.', '_'))
+    return account.verbose_provider
+
+
+def record_outcome(breaker, exc):
+    """ Record a failed action on `breaker`, if it was the server's fault. """
+    if isinstance(exc, BREAKER_EXC_CLASSES):
+        breaker.record_failure()
+    else:
+        # The server was reached and responded.
+        breaker.record_success()
 
 
 class SyncbackService(gevent.Greenlet):
     """Asynchronously consumes the action log and executes syncback actions."""
 
     def __init__(self, syncback_id, process_number, total_processes, poll_interval=1,
-                 retry_interval=30, num_workers=NUM_PARALLEL_ACCOUNTS,
-                 batch_size=10):
+                 retry_interval=ACTION_RETRY_BASE_DELAY, num_workers=NUM_PARALLEL_ACCOUNTS,
+                 batch_size=SYNCBACK_BATCH_SIZE,
+                 reconciliation_interval=None):
         self.process_number = process_number
         self.total_processes = total_processes
         self.poll_interval = poll_interval
+        if reconciliation_interval is None:
+            reconciliation_interval = (SYNCBACK_RECONCILIATION_INTERVAL
+                                       if action_notifier.shared else
+                                       poll_interval)
+        self.reconciliation_interval = reconciliation_interval
         self.retry_interval = retry_interval
         self.batch_size = batch_size
         self.keep_running = True
         self.workers = gevent.pool.Group()
-        # Dictionary account_id -> semaphore to serialize action syncback for
-        # any particular account.
-        # TODO(emfree): We really only need to serialize actions that operate
-        # on any given object. But IMAP actions are already effectively
-        # serialized by using an IMAP connection pool of size 1, so it doesn't
-        # matter too much.
-        self.account_semaphores = defaultdict(lambda: BoundedSemaphore(1))
+        # Dictionary account_id -> semaphore to limit how many actions are
+        # executed concurrently for any particular account (to the number of
+        # writable connections it has).
+        self.account_semaphores = defaultdict(
+            lambda: BoundedSemaphore(WRITABLE_CONNECTIONS_PER_ACCOUNT))
         # This SyncbackService performs syncback for only and all the accounts
         # on shards it is reponsible for; shards are divided up between
         # running SyncbackServices.
@@ -98,27 +184,69 @@ class SyncbackService(gevent.Greenlet):
         self.log = logger.new(component='syncback')
         self.num_workers = num_workers
         self.num_idle_workers = 0
-        self.worker_did_finish = Event()
-        self.worker_did_finish.clear()
+        # Set when there may be new actions to run: a notification came in
+        # or a worker finished.
+        self.work_available = Event()
         self.task_queue = Queue()
         self.running_action_ids = set()
+        # Dictionary shard id -> ids of namespaces that may have new actions.
+        self.pending_namespaces = defaultdict(set)
+        self.listener = None
+        # Dictionary action log id -> when a deferred action is due.
+        self.retry_at = {}
+        # Dictionary namespace id -> when it's due to be revisited.
+        self.revisits = {}
+        # Dictionary provider -> CircuitBreaker.
+        self.breakers = {}
         gevent.Greenlet.__init__(self)
 
     def _batch_log_entries(self, db_session, log_entries):
+        """
+        Turn an account's pending actions, in the order they were scheduled,
+        into batches that can run concurrently. Actions on an object that has
+        an earlier action still running (or held back) are held back until a
+        later pass, so that actions on any given object are executed in
+        order.
+
+        """
         tasks = []
         semaphore = None
+        namespace_id = None
+        # Objects with an earlier action that's running or held back.
+        blocked = set()
         for log_entry in log_entries:
             if log_entry is None:
                 self.log.error('Got no action, skipping')
                 continue
 
+            account_wide = log_entry.action in ACCOUNT_WIDE_ACTIONS
+            object_key = (log_entry.table_name, log_entry.record_id)
             if log_entry.id in self.running_action_ids:
-                self.log.info('Skipping already running action',
-                              action_id=log_entry.id)
-                # We're already running an action for this account, so don't
-                # queue up any additional actions for this account until the
-                # previous batch has finished.
-                return None
+                if account_wide:
+                    # Nothing after it may run until it's done.
+                    break
+                blocked.add(object_key)
+                continue
+            retry_at = self.retry_at.get(log_entry.id)
+            if retry_at is not None:
+                if retry_at > time.time():
+                    # Deferred after failing; treat it like a running
+                    # action until it's due.
+                    if account_wide:
+                        break
+                    blocked.add(object_key)
+                    continue
+                del self.retry_at[log_entry.id]
+            if account_wide and (blocked or tasks):
+                # It has to wait for the actions before it.
+                break
+            if object_key in blocked:
+                self.log.info('Holding back action until earlier actions on '
+                              'the same object are done',
+                              action_id=log_entry.id,
+                              table_name=log_entry.table_name,
+                              record_id=log_entry.record_id)
+                continue
 
             namespace = log_entry.namespace
             if namespace.account.sync_state == 'invalid':
@@ -145,9 +273,19 @@ class SyncbackService(gevent.Greenlet):
                 continue
 
             if semaphore is None:
+                breaker_name = breaker_key(namespace.account)
+                breaker = self.breaker(breaker_name)
+                # Tasks take the half-open breaker's probe when they execute
+                # (see SyncbackTask.execute_with_lock), so only check here.
+                if breaker.retry_in() > 0:
+                    statsd_client.incr('syncback.breakers.{}.paused'.format(
+                        breaker_name))
+                    self._revisit_later(namespace.id, breaker.retry_in())
+                    return []
                 semaphore = self.account_semaphores[namespace.account_id]
             else:
                 assert semaphore is self.account_semaphores[namespace.account_id]
+            namespace_id = namespace.id
             tasks.append(
                 SyncbackTask(action_name=log_entry.action,
                              semaphore=semaphore,
@@ -156,11 +294,15 @@ class SyncbackService(gevent.Greenlet):
                              account_id=namespace.account_id,
                              provider=namespace.account.
                              verbose_provider,
+                             breaker_key=breaker_name,
                              service=self,
                              retry_interval=self.retry_interval,
-                             extra_args=log_entry.extra_args))
-        if len(tasks) == 0:
-            return None
+                             extra_args=log_entry.extra_args,
+                             table_name=log_entry.table_name,
+                             namespace_id=namespace.id))
+            if account_wide:
+                # It has to finish before the actions after it.
+                break
 
         for task in tasks:
             self.running_action_ids.add(task.action_log_id)
@@ -169,7 +311,8 @@ class SyncbackService(gevent.Greenlet):
                           action_id=task.action_log_id,
                           msg=task.action_name,
                           task_count=self.task_queue.qsize())
-        return SyncbackBatchTask(semaphore, tasks)
+        return [SyncbackBatchTask(semaphore, batch, namespace_id)
+                for batch in independent_batches(tasks)]
 
     def _process_log(self):
         before = datetime.utcnow()
@@ -196,16 +339,7 @@ class SyncbackService(gevent.Greenlet):
                               num_namespace_ids=len(namespace_ids))
 
                 for ns_id in namespaces_to_process:
-                    # The discriminator filter restricts actions to IMAP. EAS
-                    # uses a different system.
-                    query = db_session.query(ActionLog).filter(
-                        ActionLog.discriminator == 'actionlog',
-                        ActionLog.status == 'pending',
-                        ActionLog.namespace_id == ns_id).order_by(ActionLog.id).\
-                        limit(self.batch_size)
-                    task = self._batch_log_entries(db_session, query.all())
-                    if task is not None:
-                        self.task_queue.put(task)
+                    self._process_namespace(db_session, ns_id)
 
         after = datetime.utcnow()
         self.log.info('Syncback completed one iteration',
@@ -213,6 +347,69 @@ class SyncbackService(gevent.Greenlet):
                       duration=(after - before).total_seconds(),
                       idle_workers=self.num_idle_workers)
 
+    def _process_namespace(self, db_session, namespace_id):
+        # The discriminator filter restricts actions to IMAP. EAS uses a
+        # different system.
+        query = db_session.query(ActionLog).filter(
+            ActionLog.discriminator == 'actionlog',
+            ActionLog.status == 'pending',
+            ActionLog.namespace_id == namespace_id).order_by(ActionLog.id).\
+            limit(self.batch_size)
+        for task in self._batch_log_entries(db_session, query.all()):
+            self.task_queue.put(task)
+
+    def _process_pending_namespaces(self):
+        """ Queue up the actions of the namespaces we were notified about. """
+        pending, self.pending_namespaces = (self.pending_namespaces,
+                                            defaultdict(set))
+        for key, namespace_ids in pending.iteritems():
+            if key not in self.keys:
+                continue
+            with session_scope_by_shard_id(key) as db_session:
+                for namespace_id in namespace_ids:
+                    self._process_namespace(db_session, namespace_id)
+
+    def _add_pending_namespaces(self, key, namespace_ids):
+        self.pending_namespaces[key].update(namespace_ids)
+        self.work_available.set()
+
+    def breaker(self, key):
+        """ Returns the circuit breaker for `key` (see breaker_key()). """
+        if key not in self.breakers:
+            self.breakers[key] = CircuitBreaker(
+                'syncback.breakers.{}'.format(key),
+                **SYNCBACK_BREAKER_SETTINGS)
+        return self.breakers[key]
+
+    def defer(self, task, delay):
+        """ Retry the action of `task` in `delay` seconds. """
+        self.retry_at[task.action_log_id] = time.time() + delay
+        statsd_client.incr('syncback.deferred.{}'.format(task.provider))
+        statsd_client.gauge('syncback.deferred', len(self.retry_at))
+        self._revisit_later(task.namespace_id, delay)
+
+    def _revisit_later(self, namespace_id, delay):
+        """ Look for actions to run for `namespace_id` in `delay` seconds. """
+        due = time.time() + delay
+        if self.revisits.get(namespace_id, float('inf')) <= due:
+            return
+        self.revisits[namespace_id] = due
+
+        def revisit():
+            if self.revisits.get(namespace_id) == due:
+                del self.revisits[namespace_id]
+            self._add_pending_namespaces(
+                engine_manager.shard_key_for_id(namespace_id), [namespace_id])
+        gevent.spawn_later(delay, revisit)
+
+    def _listen(self):
+        while self.keep_running:
+            received = action_notifier.receive(self.keys, self.poll_interval)
+            for key, namespace_ids in received.iteritems():
+                statsd_client.incr('syncback.notifications.received',
+                                   len(namespace_ids))
+                self._add_pending_namespaces(key, namespace_ids)
+
     def _restart_workers(self):
         while len(self.workers) < self.num_workers:
             worker = SyncbackWorker(self)
@@ -225,20 +422,31 @@ class SyncbackService(gevent.Greenlet):
                       process_num=self.process_number,
                       total_processes=self.total_processes,
                       keys=self.keys)
+        self.listener = gevent.spawn(retry_with_logging, self._listen,
+                                     self.log)
+        last_sweep = None
         while self.keep_running:
             self._restart_workers()
-            self._process_log()
-            # Wait for a worker to finish or for the fixed poll_interval,
-            # whichever happens first.
-            timeout = self.poll_interval
+            self.work_available.clear()
+            if last_sweep is None or (time.time() - last_sweep >=
+                                      self.reconciliation_interval):
+                last_sweep = time.time()
+                self._process_log()
+            else:
+                self._process_pending_namespaces()
+            # Wait for a notification, for a worker to finish or for the
+            # next sweep, whichever happens first.
+            timeout = max(0, last_sweep + self.reconciliation_interval -
+                          time.time())
             if self.num_idle_workers == 0:
                 timeout = None
-            self.worker_did_finish.clear()
-            self.worker_did_finish.wait(timeout=timeout)
+            self.work_available.wait(timeout=timeout)
 
     def stop(self):
         self.keep_running = False
         self.workers.kill()
+        if self.listener is not None:
+            self.listener.kill()
 
     def _run(self):
         retry_with_logging(self._run_impl, self.log)
@@ -246,29 +454,165 @@ class SyncbackService(gevent.Greenlet):
     def notify_worker_active(self):
         self.num_idle_workers -= 1
 
-    def notify_worker_finished(self, action_ids):
+    def notify_worker_finished(self, action_ids, namespace_id=None):
         self.num_idle_workers += 1
-        self.worker_did_finish.set()
         for action_id in action_ids:
             self.running_action_ids.remove(action_id)
+        # The namespace may have actions that were held back or didn't fit
+        # in the batch.
+        if namespace_id is not None:
+            self._add_pending_namespaces(
+                engine_manager.shard_key_for_id(namespace_id), [namespace_id])
+        self.work_available.set()
 
     def __del__(self):
         if self.keep_running:
             self.stop()
 
 
+def coalesce_tasks(tasks):
+    """
+    Split `tasks` (in the order their actions were scheduled) into groups to
+    execute in order. Tasks for actions in COALESCED_ACTION_FUNCTION_MAP join
+    the latest earlier group with the same action and arguments, unless a
+    group in between acts on the same record, so that the actions on any
+    given record still run in the order they were scheduled.
+
+    """
+    groups = []
+    for task in tasks:
+        key = task.coalesce_key()
+        target = None
+        if key is not None:
+            for group in reversed(groups):
+                if group[0].coalesce_key() == key:
+                    target = group
+                    break
+                if any(t.object_key == task.object_key for t in group):
+                    break
+        if target is not None:
+            target.append(task)
+        else:
+            groups.append([task])
+    return groups
+
+
+def independent_batches(tasks):
+    """
+    Split `tasks` (in the order their actions were scheduled) into batches
+    that don't act on any of the same objects and so can be executed
+    concurrently. Tasks that coalesce_tasks() merges stay in the same batch.
+
+    """
+    groups = coalesce_tasks(tasks)
+    # Union-find over the groups, joining groups that share an object.
+    parents = range(len(groups))
+
+    def find(i):
+        while parents[i] != i:
+            i = parents[i]
+        return i
+
+    owners = {}
+    for i, group in enumerate(groups):
+        for task in group:
+            if task.object_key in owners:
+                parents[find(i)] = find(owners[task.object_key])
+            else:
+                owners[task.object_key] = i
+
+    batches = defaultdict(list)
+    for i, group in enumerate(groups):
+        batches[find(i)].extend(group)
+    return [sorted(batch, key=lambda task: task.action_log_id)
+            for _, batch in sorted(batches.items())]
+
+
 class SyncbackBatchTask(object):
-    def __init__(self, semaphore, tasks):
+    def __init__(self, semaphore, tasks, namespace_id=None):
         self.semaphore = semaphore
         self.tasks = tasks
+        self.namespace_id = namespace_id
 
     def execute(self):
         log = logger.new()
         with self.semaphore:
+            groups = coalesce_tasks(self.tasks)
             log.info("Syncback running batch of actions",
-                     num_actions=len(self.tasks))
-            for task in self.tasks:
-                task.execute_with_lock()
+                     num_actions=len(self.tasks), num_groups=len(groups))
+            # Objects whose actions were deferred; later actions on them have
+            # to wait for them, so they're left for a later batch.
+            blocked = set()
+            for group in groups:
+                if any(task.object_key in blocked for task in group):
+                    blocked.update(task.object_key for task in group)
+                elif len(group) == 1:
+                    if group[0].execute_with_lock():
+                        blocked.add(group[0].object_key)
+                else:
+                    blocked.update(self._execute_coalesced(group))
+
+    def _execute_individually(self, group):
+        blocked = set()
+        for task in group:
+            if task.object_key in blocked or task.execute_with_lock():
+                blocked.add(task.object_key)
+        return blocked
+
+    def _execute_coalesced(self, group):
+        """
+        Execute the actions of `group` together. Returns the objects whose
+        actions were deferred.
+
+        """
+        first = group[0]
+        service = first.parent_service()
+        breaker = service.breaker(first.breaker_key)
+        if breaker.state != CLOSED:
+            # Only one action may probe the provider; the others are
+            # deferred unless it succeeds.
+            return self._execute_individually(group)
+        action_log_ids = [task.action_log_id for task in group]
+        log = logger.new(action=first.action_name,
+                         account_id=first.account_id,
+                         extra_args=first.extra_args,
+                         num_actions=len(group))
+        func = COALESCED_ACTION_FUNCTION_MAP[first.action_name]
+        record_ids = []
+        for task in group:
+            if task.record_id not in record_ids:
+                record_ids.append(task.record_id)
+        try:
+            before_func = datetime.utcnow()
+            func(first.account_id, record_ids, first.extra_args)
+            after_func = datetime.utcnow()
+        except Exception as e:
+            # Fall back to executing the actions one by one, so that each
+            # one is retried, and succeeds or fails, on its own.
+            log_uncaught_errors(log, account_id=first.account_id,
+                                provider=first.provider)
+            record_outcome(breaker, e)
+            log.warning('Coalesced syncback actions failed, executing '
+                        'them individually')
+            return self._execute_individually(group)
+        breaker.record_success()
+
+        func_latency = round((after_func - before_func).total_seconds(), 2)
+        with session_scope(first.account_id) as db_session:
+            entries = db_session.query(ActionLog).filter(
+                ActionLog.id.in_(action_log_ids))
+            tasks_by_id = {task.action_log_id: task for task in group}
+            for action_log_entry in entries:
+                action_log_entry.status = 'successful'
+                latency = round((datetime.utcnow() -
+                                 action_log_entry.created_at).
+                                total_seconds(), 2)
+                tasks_by_id[action_log_entry.id]._log_to_statsd(
+                    action_log_entry.status, latency)
+            db_session.commit()
+        log.info('syncback actions completed', action_ids=action_log_ids,
+                 func_latency=func_latency)
+        return set()
 
     def timeout(self, per_task_timeout):
         return len(self.tasks) * per_task_timeout
@@ -280,23 +624,19 @@ class SyncbackBatchTask(object):
 
 class SyncbackTask(object):
     """
-    Task responsible for executing a single syncback action. We can retry the
-    action up to ACTION_MAX_NR_OF_RETRIES times before we mark it as failed.
-    Note: Each task holds an account-level lock, in order to ensure that
-    actions are executed in the order they were first scheduled. This means
-    that in the worst case, a misbehaving action can block other actions for
-    the account from executing, for up to about
-    retry_interval * ACTION_MAX_NR_OF_RETRIES = 600 seconds
-
-    TODO(emfree): Fix this with more granular locking (or a better strategy
-    altogether). We only really need ordering guarantees for actions on any
-    given object, not on the whole account.
+    Task responsible for executing a single syncback action. If the action
+    fails, it's deferred (see SyncbackService.defer) to be retried after an
+    exponentially increasing delay, up to ACTION_MAX_NR_OF_RETRIES times
+    before we mark it as failed. Later actions on the same object wait for
+    it, but the task doesn't keep holding its account's semaphore, or a
+    worker, in the meantime.
 
     """
 
     def __init__(self, action_name, semaphore, action_log_id, record_id,
-                 account_id, provider, service, retry_interval=30,
-                 extra_args=None):
+                 account_id, provider, service,
+                 retry_interval=ACTION_RETRY_BASE_DELAY, extra_args=None,
+                 table_name=None, namespace_id=None, breaker_key=None):
         self.parent_service = weakref.ref(service)
         self.action_name = action_name
         self.semaphore = semaphore
@@ -305,8 +645,15 @@ class SyncbackTask(object):
         self.record_id = record_id
         self.account_id = account_id
         self.provider = provider
+        self.breaker_key = breaker_key or provider
         self.extra_args = extra_args
         self.retry_interval = retry_interval
+        self.table_name = table_name
+        self.namespace_id = namespace_id
+
+    @property
+    def object_key(self):
+        return (self.table_name, self.record_id)
 
     def _log_to_statsd(self, action_log_status, latency=None):
         metric_names = [
@@ -319,65 +666,99 @@ class SyncbackTask(object):
             if latency:
                 statsd_client.timing(metric, latency * 1000)
 
+    def retry_delay(self, retries):
+        """
+        How long to wait before the next attempt after `retries` failed
+        ones: exponential backoff, with jitter so that actions that failed
+        at the same time (e.g. during a provider outage) aren't all retried
+        at the same time.
+
+        """
+        delay = min(ACTION_RETRY_MAX_DELAY,
+                    self.retry_interval * 2 ** (retries - 1))
+        return delay / 2. + random.uniform(0, delay / 2.)
+
     def execute_with_lock(self):
+        """
+        Execute the action once. Returns True if it was deferred, to be
+        retried later.
+
+        """
         log = logger.new(
             record_id=self.record_id, action_log_id=self.action_log_id,
             action=self.action_name, account_id=self.account_id,
             extra_args=self.extra_args)
-
-        for _ in range(ACTION_MAX_NR_OF_RETRIES):
-            try:
-                before_func = datetime.utcnow()
-                if self.extra_args:
-                    self.func(self.account_id, self.record_id,
-                              self.extra_args)
-                else:
-                    self.func(self.account_id, self.record_id)
-                after_func = datetime.utcnow()
-
-                with session_scope(self.account_id) as db_session:
-                    action_log_entry = db_session.query(ActionLog).get(
-                        self.action_log_id)
-                    action_log_entry.status = 'successful'
-                    db_session.commit()
-                    latency = round((datetime.utcnow() -
-                                     action_log_entry.created_at).
-                                    total_seconds(), 2)
-                    func_latency = round((after_func - before_func).
-                                         total_seconds(), 2)
-                    log.info('syncback action completed',
-                             action_id=self.action_log_id,
-                             latency=latency,
-                             process=self.parent_service().process_number,
-                             func_latency=func_latency)
-                    self._log_to_statsd(action_log_entry.status, latency)
-                    return
-            except Exception:
-                log_uncaught_errors(log, account_id=self.account_id,
-                                    provider=self.provider)
-                with session_scope(self.account_id) as db_session:
-                    action_log_entry = db_session.query(ActionLog).get(
-                        self.action_log_id)
-                    action_log_entry.retries += 1
-                    if (action_log_entry.retries ==
-                            ACTION_MAX_NR_OF_RETRIES):
-                        log.critical('Max retries reached, giving up.',
-                                     exc_info=True)
-                        action_log_entry.status = 'failed'
-                        self._log_to_statsd(action_log_entry.status)
-                        db_session.commit()
-                        return
+        service = self.parent_service()
+        breaker = service.breaker(self.breaker_key)
+
+        if not breaker.allow():
+            delay = breaker.retry_in()
+            log.info('Syncback task deferring action while provider is '
+                     'failing', duration=delay)
+            service.defer(self, delay)
+            return True
+
+        try:
+            before_func = datetime.utcnow()
+            if self.extra_args:
+                self.func(self.account_id, self.record_id,
+                          self.extra_args)
+            else:
+                self.func(self.account_id, self.record_id)
+            after_func = datetime.utcnow()
+            breaker.record_success()
+
+            with session_scope(self.account_id) as db_session:
+                action_log_entry = db_session.query(ActionLog).get(
+                    self.action_log_id)
+                action_log_entry.status = 'successful'
+                db_session.commit()
+                latency = round((datetime.utcnow() -
+                                 action_log_entry.created_at).
+                                total_seconds(), 2)
+                func_latency = round((after_func - before_func).
+                                     total_seconds(), 2)
+                log.info('syncback action completed',
+                         action_id=self.action_log_id,
+                         latency=latency,
+                         process=service.process_number,
+                         func_latency=func_latency)
+                self._log_to_statsd(action_log_entry.status, latency)
+                return False
+        except Exception as e:
+            log_uncaught_errors(log, account_id=self.account_id,
+                                provider=self.provider)
+            record_outcome(breaker, e)
+            with session_scope(self.account_id) as db_session:
+                action_log_entry = db_session.query(ActionLog).get(
+                    self.action_log_id)
+                action_log_entry.retries += 1
+                retries = action_log_entry.retries
+                if retries >= ACTION_MAX_NR_OF_RETRIES:
+                    log.critical('Max retries reached, giving up.',
+                                 exc_info=True)
+                    action_log_entry.status = 'failed'
+                    self._log_to_statsd(action_log_entry.status)
                     db_session.commit()
-
-            # Wait before retrying
-            log.info("Syncback task retrying action after sleeping",
-                     duration=self.retry_interval)
-
-            # TODO(T6974): We might want to do some kind of exponential
-            # backoff with jitter to avoid the thundering herd problem if a
-            # provider suddenly starts having issues for a short period of
-            # time.
-            gevent.sleep(self.retry_interval)
+                    return False
+                db_session.commit()
+
+        delay = self.retry_delay(retries)
+        log.info("Syncback task deferring action", duration=delay,
+                 retries=retries)
+        service.defer(self, delay)
+        return True
+
+    def coalesce_key(self):
+        """
+        Actions with the same (non-None) key can be executed together by
+        COALESCED_ACTION_FUNCTION_MAP[action_name].
+
+        """
+        if self.action_name not in COALESCED_ACTION_FUNCTION_MAP:
+            return None
+        return (self.account_id, self.action_name,
+                json.dumps(self.extra_args, sort_keys=True))
 
     def action_log_ids(self):
         return [self.action_log_id]
@@ -387,7 +768,7 @@ class SyncbackTask(object):
 
     def execute(self):
         with self.semaphore:
-            self.execute_with_lock()
+            return self.execute_with_lock()
 
 
 class SyncbackWorker(gevent.Greenlet):
@@ -405,4 +786,4 @@ class SyncbackWorker(gevent.Greenlet):
                 gevent.with_timeout(task.timeout(self.task_timeout), task.execute)
             finally:
                 self.parent_service().notify_worker_finished(
-                    task.action_log_ids())
+                    task.action_log_ids(), task.namespace_id)
@@ -0,0 +1,191 @@
+"""
+Caches that let the delta endpoints avoid the database in the common case.
+
+* Cursors (Transaction public ids) never change meaning, so resolving a
+  cursor to its namespace and transaction id is memoized in-process.
+* The id of the most recent transaction for each namespace is maintained by
+  the session hooks in inbox.models.session as transactions are committed.
+  If TRANSACTION_CACHE_REDIS_HOSTNAME is configured, it's shared through
+  Redis so that API processes see transactions committed by sync processes.
+  Otherwise it's kept in-process, with a short TTL so that changes made by
+  other processes show up quickly.
+* Namespaces this process recently committed transactions for are
+  remembered for a while, so that reads which must see those writes aren't
+  routed to a lagging replica (see inbox.models.session.engine_for_id).
+  Without Redis, other processes' writes aren't visible this way, so reads
+  aren't routed to replicas at all.
+
+"""
+import time
+import calendar
+from collections import namedtuple
+from datetime import datetime
+
+from redis import StrictRedis
+
+from inbox.config import config
+from inbox.util.lru import TTLCache
+from nylas.logging import get_logger
+log = get_logger()
+
+CURSOR_CACHE_SIZE = config.get('CURSOR_CACHE_SIZE', 100000)
+CURSOR_CACHE_TTL = config.get('CURSOR_CACHE_TTL', 3600)
+LATEST_TRANSACTION_CACHE_SIZE = config.get('LATEST_TRANSACTION_CACHE_SIZE',
+                                           100000)
+# Used without Redis: bounds how long another process's writes can go
+# unnoticed.
+LATEST_TRANSACTION_LOCAL_TTL = config.get('LATEST_TRANSACTION_LOCAL_TTL', 1)
+# Used with Redis: entries are kept up to date by writers, but one whose
+# update fails (or that runs without Redis configured) leaves a stale entry
+# that hides its transactions from the delta endpoints until it expires, so
+# this must stay short.
+LATEST_TRANSACTION_SHARED_TTL = config.get('LATEST_TRANSACTION_SHARED_TTL',
+                                           5)
+# Only needs to outlast the largest read-your-writes window. Writes are
+# recorded in Redis separately from the latest transaction, whose shared TTL
+# can be shorter than that.
+RECENT_WRITES_TTL = 60
+
+SOCKET_CONNECT_TIMEOUT = 1
+SOCKET_TIMEOUT = 1
+
+
+LatestTransaction = namedtuple('LatestTransaction',
+                               ['id', 'public_id', 'created_at'])
+
+
+class TransactionCache(object):
+    KEY_PREFIX = 'trxlatest:'
+    WRITTEN_KEY_PREFIX = 'trxwritten:'
+
+    # Atomically replace the stored latest transaction unless the stored one
+    # is newer. Ids are zero-padded so they can be compared as strings (Lua
+    # numbers are doubles and can't represent all 64-bit ids).
+    SET_IF_NEWER = '''
+    local current = redis.call('GET', KEYS[1])
+    if current and string.sub(current, 1, 20) >= string.sub(ARGV[1], 1, 20) then
+        return 0
+    end
+    redis.call('SETEX', KEYS[1], ARGV[2], ARGV[1])
+    return 1
+    '''
+
+    def __init__(self, redis=None):
+        self.cursors = TTLCache(maxsize=CURSOR_CACHE_SIZE,
+                                ttl=CURSOR_CACHE_TTL)
+        self.latest = TTLCache(maxsize=LATEST_TRANSACTION_CACHE_SIZE,
+                               ttl=LATEST_TRANSACTION_LOCAL_TTL)
+        self.recent_writes = TTLCache(maxsize=LATEST_TRANSACTION_CACHE_SIZE,
+                                      ttl=RECENT_WRITES_TTL)
+        self.redis = redis
+        # Whether writes by other processes are visible.
+        self.shared = redis is not None
+        self._set_if_newer = None
+        if redis is not None:
+            self._set_if_newer = redis.register_script(self.SET_IF_NEWER)
+
+    def get_cursor(self, cursor):
+        """
+        Returns a (namespace_id, transaction_id) pair for the given cursor,
+        or None if it isn't cached.
+
+        """
+        return self.cursors.get(cursor)
+
+    def set_cursor(self, cursor, namespace_id, transaction_id):
+        self.cursors.set(cursor, (namespace_id, transaction_id))
+
+    def get_latest(self, namespace_id):
+        """
+        Returns the LatestTransaction for the namespace, or None if it isn't
+        cached.
+
+        """
+        if self.redis is None:
+            return self.latest.get(namespace_id)
+        try:
+            value = self.redis.get(self.KEY_PREFIX + str(namespace_id))
+        except Exception:
+            log.error('Error reading latest transaction',
+                      namespace_id=namespace_id, exc_info=True)
+            return None
+        if value is None:
+            return None
+        id_, public_id, created_at = value.split(':')
+        return LatestTransaction(int(id_), public_id,
+                                 datetime.utcfromtimestamp(int(created_at)))
+
+    def set_latest(self, namespace_id, latest):
+        """
+        Records `latest` as the newest transaction for the namespace, unless
+        a newer one is already known.
+
+        """
+        if self.redis is None:
+            current = self.latest.get(namespace_id)
+            if current is None or current.id < latest.id:
+                self.latest.set(namespace_id, latest)
+            return
+        value = '{:020d}:{}:{}'.format(
+            latest.id, latest.public_id,
+            calendar.timegm(latest.created_at.utctimetuple()))
+        try:
+            self._set_if_newer(keys=[self.KEY_PREFIX + str(namespace_id)],
+                               args=[value, LATEST_TRANSACTION_SHARED_TTL])
+        except Exception:
+            log.error('Error writing latest transaction',
+                      namespace_id=namespace_id, exc_info=True)
+
+    def mark_written(self, namespace_id):
+        now = time.time()
+        self.recent_writes.set(namespace_id, now)
+        if self.redis is None:
+            return
+        try:
+            self.redis.set(self.WRITTEN_KEY_PREFIX + str(namespace_id), now,
+                           ex=RECENT_WRITES_TTL)
+        except Exception:
+            log.error('Error recording write', namespace_id=namespace_id,
+                      exc_info=True)
+
+    def written_recently(self, namespace_id, window):
+        """
+        Whether transactions were committed for the namespace in the last
+        `window` seconds, by this process or (if Redis is configured) by any
+        process. Errs on the side of True if Redis can't be reached.
+
+        """
+        written_at = self.recent_writes.get(namespace_id)
+        if written_at is not None and time.time() - written_at < window:
+            return True
+        if self.redis is None:
+            return False
+        try:
+            written_at = self.redis.get(
+                self.WRITTEN_KEY_PREFIX + str(namespace_id))
+        except Exception:
+            log.error('Error reading recent writes',
+                      namespace_id=namespace_id, exc_info=True)
+            return True
+        return written_at is not None and \
+            time.time() - float(written_at) < window
+
+    def clear(self):
+        self.cursors.clear()
+        self.latest.clear()
+        self.recent_writes.clear()
+
+
+def _shared_redis_client():
+    redis_host = config.get('TRANSACTION_CACHE_REDIS_HOSTNAME')
+    if not redis_host:
+        return None
+    return StrictRedis(host=redis_host,
+                       port=int(config.get('TRANSACTION_CACHE_REDIS_PORT',
+                                           6379)),
+                       db=int(config.get('TRANSACTION_CACHE_REDIS_DB', 0)),
+                       socket_connect_timeout=SOCKET_CONNECT_TIMEOUT,
+                       socket_timeout=SOCKET_TIMEOUT)
+
+
+transaction_cache = TransactionCache(redis=_shared_redis_client())
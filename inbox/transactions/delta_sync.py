@@ -1,16 +1,37 @@
 import time
 import gevent
 import collections
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from sqlalchemy import asc, desc, bindparam
+from sqlalchemy import asc, desc, bindparam, and_, or_, func
 from inbox.api.kellogs import APIEncoder, encode
 from inbox.models import Transaction, Message, Thread, Account, Namespace
 from inbox.models.session import session_scope
+from inbox.models.partitioning import TRANSACTION_LOG_PARTITIONED
 from inbox.models.util import transaction_objects
 from inbox.sqlalchemy_ext.util import bakery
+from inbox.transactions.cache import transaction_cache, LatestTransaction
+from inbox.config import config
+from inbox.util.itert import chunk
+from inbox.util.stats import statsd_client
 
 
+# Clients more than this many transactions behind the head of the log get
+# coalesced deltas (see format_transactions_after_pointer).
+CATCHUP_THRESHOLD = config.get('DELTA_CATCHUP_THRESHOLD', 10000)
+CATCHUP_BATCH_SIZE = 10000
+CATCHUP_MAX_SCAN = config.get('DELTA_CATCHUP_MAX_SCAN', 500000)
+
+# Transactions get their created_at on the application host when they're
+# flushed, and their id when they're inserted, so created_at isn't strictly
+# ordered by id. This bounds by how much it can be out of order.
+TRANSACTION_LOG_MAX_CLOCK_SKEW = timedelta(
+    seconds=config.get('TRANSACTION_LOG_MAX_CLOCK_SKEW', 3600))
+
+# Number of namespaces checked for new transactions per query when fetching
+# deltas for many namespaces at once.
+MULTI_NAMESPACE_CHUNK_SIZE = 500
+
 EVENT_NAME_FOR_COMMAND = {
     'insert': 'create',
     'update': 'modify',
@@ -42,6 +63,12 @@ def get_transaction_cursor_near_timestamp(namespace_id, timestamp, db_session):
     """
     dt = datetime.utcfromtimestamp(timestamp)
 
+    # Usually the timestamp is "now", so the answer is simply the latest
+    # transaction.
+    latest = transaction_cache.get_latest(namespace_id)
+    if latest is not None and latest.created_at < dt:
+        return latest.public_id
+
     # We want this guarantee: if you pass a timestamp for, say,
     # '2015-03-20 12:22:20', and you have multiple transactions immediately
     # prior, e.g.:
@@ -73,20 +100,282 @@ def get_transaction_cursor_near_timestamp(namespace_id, timestamp, db_session):
     return latest_transaction.public_id
 
 
-def _get_last_trx_id_for_namespace(namespace_id, db_session):
+def get_transaction_id_for_cursor(namespace_id, cursor, db_session):
+    """
+    Exchange a cursor (the public_id of a transaction) for the id of that
+    transaction. Returns None if there's no such transaction in the given
+    namespace.
+
+    """
+    cached = transaction_cache.get_cursor(cursor)
+    if cached is not None:
+        cached_namespace_id, transaction_id = cached
+        if cached_namespace_id != namespace_id:
+            return None
+        return transaction_id
+
     q = bakery(lambda session: session.query(Transaction.id))
+    q += lambda q: q.filter(
+        Transaction.namespace_id == bindparam('namespace_id'),
+        Transaction.public_id == bindparam('cursor'))
+    result = q(db_session).params(namespace_id=namespace_id,
+                                  cursor=cursor).first()
+    if result is None:
+        return None
+    transaction_cache.set_cursor(cursor, namespace_id, result[0])
+    return result[0]
+
+
+def _get_last_trx_id_for_namespace(namespace_id, db_session):
+    latest = transaction_cache.get_latest(namespace_id)
+    if latest is not None:
+        return latest.id
+
+    q = bakery(lambda session: session.query(Transaction.id,
+                                             Transaction.public_id,
+                                             Transaction.created_at))
     q += lambda q: q.filter(
         Transaction.namespace_id == bindparam('namespace_id'))
     q += lambda q: q.order_by(desc(Transaction.created_at)).\
         order_by(desc(Transaction.id)).limit(1)
-    return q(db_session).params(namespace_id=namespace_id).one()[0]
+    latest = LatestTransaction(
+        *q(db_session).params(namespace_id=namespace_id).one())
+    transaction_cache.set_latest(namespace_id, latest)
+    return latest.id
+
+
+def _filter_types(query, exclude_types, include_types):
+    if exclude_types is not None:
+        query = query.filter(~Transaction.object_type.in_(exclude_types))
+    if include_types is not None:
+        query = query.filter(Transaction.object_type.in_(include_types))
+    return query
+
+
+def _resolve_types(exclude_types, include_types, exclude_folders,
+                   exclude_metadata, exclude_account):
+    exclude_types = set(exclude_types) if exclude_types else set()
+    # Begin backwards-compatibility shim -- suppress new object types for now,
+    # because clients may not be able to deal with them.
+    if exclude_folders is True:
+        exclude_types.update(('folder', 'label'))
+    if exclude_account is True:
+        exclude_types.add('account')
+    # End backwards-compatibility shim.
+
+    # Metadata is excluded by default, and can only be included by setting the
+    # exclude_metadata flag to False. If listed in include_types, remove it.
+    if exclude_metadata is True:
+        exclude_types.add('metadata')
+    if include_types is not None and 'metadata' in include_types:
+        include_types.remove('metadata')
+    return exclude_types, include_types
+
+
+def _format_deltas(namespace, trxs_with_commands, db_session, expand, is_n1):
+    """
+    Load and encode the objects referenced by the given (transaction,
+    command) pairs. Returns a list of (transaction id, delta) pairs, skipping
+    objects that no longer exist.
+
+    """
+    results = []
+
+    # Group deltas by object type.
+    trxs_by_obj_type = collections.defaultdict(list)
+    for trx, command in trxs_with_commands:
+        trxs_by_obj_type[trx.object_type].append((trx, command))
+
+    for obj_type, trxs in trxs_by_obj_type.items():
+        # Load all referenced not-deleted objects.
+        ids_to_query = [trx.record_id for trx, command in trxs
+                        if command != 'delete']
+
+        object_cls = transaction_objects()[obj_type]
+
+        if object_cls == Account:
+            # The base query for Account queries the /Namespace/ table
+            # since the API-returned "`account`" is a `namespace`
+            # under-the-hood.
+            query = db_session.query(Namespace).join(Account).filter(
+                Account.id.in_(ids_to_query),
+                Namespace.id == namespace.id)
+
+            # Key by /namespace.account_id/ --
+            # namespace.id may not be equal to account.id
+            # and trx.record_id == account.id for `account` trxs.
+            objects = {obj.account_id: obj for obj in query}
+        else:
+            query = db_session.query(object_cls).filter(
+                object_cls.id.in_(ids_to_query),
+                object_cls.namespace_id == namespace.id)
+
+            if object_cls == Thread:
+                query = query.options(*Thread.api_loading_options(expand))
+            elif object_cls == Message:
+                query = query.options(*Message.api_loading_options(expand))
+
+            objects = {obj.id: obj for obj in query}
+
+        for trx, command in trxs:
+            delta = {
+                'object': trx.object_type,
+                'event': EVENT_NAME_FOR_COMMAND[command],
+                'id': trx.object_public_id,
+                'cursor': trx.public_id
+            }
+            if command != 'delete':
+                obj = objects.get(trx.record_id)
+                if obj is None:
+                    continue
+                repr_ = encode(
+                    obj, namespace_public_id=namespace.public_id,
+                    expand=expand, is_n1=is_n1)
+                delta['attributes'] = repr_
+
+            results.append((trx.id, delta))
+
+    return results
+
+
+def _created_at_floor(pointer, db_session):
+    """
+    If the transaction log is partitioned by created_at, return a lower
+    bound on the created_at of the transactions after `pointer`, so that
+    queries for them only read the partitions that can hold them rather than
+    every partition back to the purge horizon. Returns None otherwise, or if
+    the pointer transaction is gone.
+
+    """
+    if not TRANSACTION_LOG_PARTITIONED or not pointer:
+        return None
+    created_at = db_session.query(Transaction.created_at). \
+        filter(Transaction.id == pointer).scalar()
+    if created_at is None:
+        return None
+    return created_at - TRANSACTION_LOG_MAX_CLOCK_SKEW
+
+
+def _after_pointer(pointer, floor):
+    criteria = [Transaction.id > pointer]
+    if floor is not None:
+        criteria.append(Transaction.created_at >= floor)
+    return criteria
+
+
+def _is_far_behind(namespace_id, pointer, db_session, floor=None):
+    """
+    Returns True if there are more than CATCHUP_THRESHOLD transactions after
+    `pointer`. This only walks the namespace_id index.
+
+    """
+    return db_session.query(Transaction.id). \
+        filter(Transaction.namespace_id == namespace_id,
+               *_after_pointer(pointer, floor)). \
+        order_by(asc(Transaction.id)). \
+        offset(CATCHUP_THRESHOLD).limit(1).first() is not None
+
+
+def _coalesce_transactions_after_pointer(namespace_id, pointer, db_session,
+                                         exclude_types, include_types,
+                                         max_objects, floor=None):
+    """
+    Scan the transactions after `pointer`, selecting only the columns
+    needed, until `max_objects` distinct objects have changed (or
+    CATCHUP_MAX_SCAN transactions have been scanned), and coalesce them to a
+    single event per object, reflecting its final state over the scanned
+    range: a delete if the last transaction is a delete, a create if the
+    object was inserted in the range, and a modify otherwise.
+
+    Returns a tuple (coalesced, end, scanned), where coalesced is a list of
+    (transaction, command) pairs, with transaction the last transaction for
+    the object, ordered by transaction id; end is the id of the last
+    transaction coalesced, where the next scan should continue from; and
+    scanned is how many rows were read.
+
+    """
+    first_command = {}
+    last_trx = {}
+    end = pointer
+    scanned = 0
+    full = False
+    while not full and scanned < CATCHUP_MAX_SCAN:
+        # Start with small batches, so that a scan that's done after a few
+        # objects doesn't read much more than it uses.
+        batch_size = min(CATCHUP_BATCH_SIZE, max(max_objects, scanned))
+        query = db_session.query(Transaction.id, Transaction.public_id,
+                                 Transaction.object_type,
+                                 Transaction.record_id,
+                                 Transaction.object_public_id,
+                                 Transaction.command). \
+            filter(Transaction.namespace_id == namespace_id,
+                   *_after_pointer(end, floor))
+        query = _filter_types(query, exclude_types, include_types)
+        rows = query.order_by(asc(Transaction.id)).limit(batch_size).all()
+        scanned += len(rows)
+
+        for row in rows:
+            key = (row.object_type, row.record_id)
+            if key not in last_trx and len(last_trx) >= max_objects:
+                full = True
+                break
+            first_command.setdefault(key, row.command)
+            last_trx[key] = row
+            end = row.id
+
+        if len(rows) < batch_size:
+            break
+
+    coalesced = []
+    for key, trx in last_trx.iteritems():
+        if trx.command == 'delete':
+            command = 'delete'
+        elif first_command[key] == 'insert':
+            command = 'insert'
+        else:
+            command = 'update'
+        coalesced.append((trx, command))
+    coalesced.sort(key=lambda pair: pair[0].id)
+    return coalesced, end, scanned
+
+
+def _catch_up(namespace, pointer, db_session, result_limit, exclude_types,
+              include_types, floor, expand, is_n1):
+    """
+    Coalesced changes for a client that's far behind. Each call only scans
+    as far as it needs to for `result_limit` objects, and returns the end of
+    the scan as the new pointer, so that paging through a long backlog reads
+    each transaction about once. Objects changed again after the end of the
+    scan are reported again by a later call.
+
+    """
+    statsd_client.incr('api.delta.catch_up')
+    scanned = 0
+    while scanned < CATCHUP_MAX_SCAN:
+        coalesced, end, rows = _coalesce_transactions_after_pointer(
+            namespace.id, pointer, db_session, exclude_types, include_types,
+            result_limit, floor)
+        scanned += rows
+        if not coalesced:
+            break
+        results = _format_deltas(namespace, coalesced, db_session, expand,
+                                 is_n1)
+        pointer = end
+        if results:
+            # The last transaction scanned is the last one of some object,
+            # so the last delta's cursor is the end of the scan, unless that
+            # object no longer exists.
+            deltas, _ = _deltas_and_pointer(namespace, results)
+            return (deltas, pointer)
+    return ([], pointer)
 
 
 def format_transactions_after_pointer(namespace, pointer, db_session,
                                       result_limit, exclude_types=None,
                                       include_types=None, exclude_folders=True,
                                       exclude_metadata=True, exclude_account=True,
-                                      expand=False, is_n1=False):
+                                      expand=False, is_n1=False,
+                                      catch_up=True):
     """
     Return a pair (deltas, new_pointer), where deltas is a list of change
     events, represented as dictionaries:
@@ -114,41 +403,34 @@ def format_transactions_after_pointer(namespace, pointer, db_session,
         Function that defines how to format the transactions.
     exclude_types: list, optional
         If given, don't include transactions for these types of objects.
+    catch_up: bool, optional
+        If the first page of results is full and the pointer is more than
+        CATCHUP_THRESHOLD transactions behind, coalesce all the changes to
+        the next `result_limit` objects changed, however many transactions
+        that spans (see _catch_up), so that clients that have been offline
+        for a long time don't replay every intermediate change to
+        frequently-modified objects.
 
     """
-    exclude_types = set(exclude_types) if exclude_types else set()
-    # Begin backwards-compatibility shim -- suppress new object types for now,
-    # because clients may not be able to deal with them.
-    if exclude_folders is True:
-        exclude_types.update(('folder', 'label'))
-    if exclude_account is True:
-        exclude_types.add('account')
-    # End backwards-compatibility shim.
-
-    # Metadata is excluded by default, and can only be included by setting the
-    # exclude_metadata flag to False. If listed in include_types, remove it.
-    if exclude_metadata is True:
-        exclude_types.add('metadata')
-    if include_types is not None and 'metadata' in include_types:
-        include_types.remove('metadata')
+    exclude_types, include_types = _resolve_types(
+        exclude_types, include_types, exclude_folders, exclude_metadata,
+        exclude_account)
 
     last_trx = _get_last_trx_id_for_namespace(namespace.id, db_session)
     if last_trx == pointer:
         return ([], pointer)
 
+    # The floor stays valid as the pointer advances below.
+    floor = _created_at_floor(pointer, db_session)
+    first_page = True
     while True:
         transactions = db_session.query(Transaction). \
             filter(
-                Transaction.id > pointer,
-                Transaction.namespace_id == namespace.id)
-
-        if exclude_types is not None:
-            transactions = transactions.filter(
-                ~Transaction.object_type.in_(exclude_types))
+                Transaction.namespace_id == namespace.id,
+                *_after_pointer(pointer, floor))
 
-        if include_types is not None:
-            transactions = transactions.filter(
-                Transaction.object_type.in_(include_types))
+        transactions = _filter_types(transactions, exclude_types,
+                                     include_types)
 
         transactions = transactions. \
             order_by(asc(Transaction.id)).limit(result_limit).all()
@@ -156,73 +438,26 @@ def format_transactions_after_pointer(namespace, pointer, db_session,
         if not transactions:
             return ([], pointer)
 
-        results = []
-
-        # Group deltas by object type.
-        trxs_by_obj_type = collections.defaultdict(list)
-        for trx in transactions:
-            trxs_by_obj_type[trx.object_type].append(trx)
-
-        for obj_type, trxs in trxs_by_obj_type.items():
-            # Build a dictionary mapping pairs (record_id, command) to
-            # transaction. If successive modifies for a given record id appear
-            # in the list of transactions, this will only keep the latest
-            # one (which is what we want).
-            latest_trxs = {(trx.record_id, trx.command): trx for trx in
-                           sorted(trxs, key=lambda t: t.id)}.values()
-            # Load all referenced not-deleted objects.
-            ids_to_query = [trx.record_id for trx in latest_trxs
-                            if trx.command != 'delete']
-
-            object_cls = transaction_objects()[obj_type]
-
-            if object_cls == Account:
-                # The base query for Account queries the /Namespace/ table
-                # since the API-returned "`account`" is a `namespace`
-                # under-the-hood.
-                query = db_session.query(Namespace).join(Account).filter(
-                    Account.id.in_(ids_to_query),
-                    Namespace.id == namespace.id)
-
-                # Key by /namespace.account_id/ --
-                # namespace.id may not be equal to account.id
-                # and trx.record_id == account.id for `account` trxs.
-                objects = {obj.account_id: obj for obj in query}
-            else:
-                query = db_session.query(object_cls).filter(
-                    object_cls.id.in_(ids_to_query),
-                    object_cls.namespace_id == namespace.id)
-
-                if object_cls == Thread:
-                    query = query.options(*Thread.api_loading_options(expand))
-                elif object_cls == Message:
-                    query = query.options(*Message.api_loading_options(expand))
-
-                objects = {obj.id: obj for obj in query}
-
-            for trx in latest_trxs:
-                delta = {
-                    'object': trx.object_type,
-                    'event': EVENT_NAME_FOR_COMMAND[trx.command],
-                    'id': trx.object_public_id,
-                    'cursor': trx.public_id
-                }
-                if trx.command != 'delete':
-                    obj = objects.get(trx.record_id)
-                    if obj is None:
-                        continue
-                    repr_ = encode(
-                        obj, namespace_public_id=namespace.public_id,
-                        expand=expand, is_n1=is_n1)
-                    delta['attributes'] = repr_
-
-                results.append((trx.id, delta))
+        # Only clients whose first page is full can be far behind.
+        if first_page and catch_up and len(transactions) == result_limit and \
+                _is_far_behind(namespace.id, pointer, db_session, floor):
+            return _catch_up(namespace, pointer, db_session, result_limit,
+                             exclude_types, include_types, floor, expand,
+                             is_n1)
+        first_page = False
+
+        # Build a dictionary mapping pairs (object_type, record_id, command)
+        # to transaction. If successive modifies for a given record id appear
+        # in the list of transactions, this will only keep the latest one
+        # (which is what we want).
+        latest_trxs = {(trx.object_type, trx.record_id, trx.command): trx
+                       for trx in transactions}.values()
+        results = _format_deltas(
+            namespace, [(trx, trx.command) for trx in latest_trxs],
+            db_session, expand, is_n1)
 
         if results:
-            # Sort deltas by id of the underlying transactions.
-            results.sort()
-            deltas = [d for _, d in results]
-            return (deltas, results[-1][0])
+            return _deltas_and_pointer(namespace, results)
         else:
             # It's possible that none of the referenced objects exist any more,
             # meaning the result list is empty. In that case, keep traversing
@@ -230,6 +465,16 @@ def format_transactions_after_pointer(namespace, pointer, db_session,
             pointer = transactions[-1].id
 
 
+def _deltas_and_pointer(namespace, results):
+    # Sort deltas by id of the underlying transactions.
+    results.sort()
+    deltas = [d for _, d in results]
+    # Clients will most likely come back with the last cursor.
+    transaction_cache.set_cursor(deltas[-1]['cursor'], namespace.id,
+                                 results[-1][0])
+    return (deltas, results[-1][0])
+
+
 def streaming_change_generator(namespace, poll_interval, timeout,
                                transaction_pointer, exclude_types=None,
                                include_types=None, exclude_folders=True,
@@ -254,7 +499,7 @@ def streaming_change_generator(namespace, poll_interval, timeout,
     encoder = APIEncoder(is_n1=is_n1)
     start_time = time.time()
     while time.time() - start_time < timeout:
-        with session_scope(namespace.id) as db_session:
+        with session_scope(namespace.id, read_only=True) as db_session:
             deltas, new_pointer = format_transactions_after_pointer(
                 namespace, transaction_pointer, db_session, 100,
                 exclude_types, include_types, exclude_folders,
@@ -267,3 +512,117 @@ def streaming_change_generator(namespace, poll_interval, timeout,
         else:
             yield '\n'
             gevent.sleep(poll_interval)
+
+
+def _namespaces_with_changes(pointers, db_session, exclude_types=None,
+                             include_types=None):
+    """
+    Return the set of namespace ids from `pointers` (a dict mapping
+    namespace id -> transaction pointer) that have transactions of the
+    requested types after their pointer. This issues one range query per
+    MULTI_NAMESPACE_CHUNK_SIZE namespaces, rather than one query per
+    namespace.
+
+    """
+    changed = set()
+    for chnk in chunk(pointers.items(), MULTI_NAMESPACE_CHUNK_SIZE):
+        ranges = [and_(Transaction.namespace_id == namespace_id,
+                       Transaction.id > pointer)
+                  for namespace_id, pointer in chnk]
+        query = db_session.query(Transaction.namespace_id,
+                                 func.max(Transaction.id)). \
+            filter(or_(*ranges))
+        query = _filter_types(query, exclude_types, include_types). \
+            group_by(Transaction.namespace_id)
+        changed.update(namespace_id for namespace_id, _ in query)
+    return changed
+
+
+def format_transactions_for_namespaces(namespaces, pointers, db_session,
+                                       result_limit, exclude_types=None,
+                                       include_types=None,
+                                       exclude_folders=True,
+                                       exclude_metadata=True,
+                                       exclude_account=True, expand=False,
+                                       is_n1=False):
+    """
+    Batched version of format_transactions_after_pointer for consumers that
+    follow many namespaces at once. All namespaces must live on the shard
+    `db_session` is bound to.
+
+    Arguments
+    ---------
+    namespaces: dict
+        Mapping of namespace id -> Namespace.
+    pointers: dict
+        Mapping of namespace id -> transaction pointer.
+
+    Returns
+    -------
+    dict
+        Mapping of namespace id -> (deltas, new_pointer), only for the
+        namespaces whose pointer advanced. The deltas can be empty, if all
+        the new transactions refer to objects that no longer exist.
+
+    """
+    exclude_types, include_types = _resolve_types(
+        exclude_types, include_types, exclude_folders, exclude_metadata,
+        exclude_account)
+    results = {}
+    for namespace_id in _namespaces_with_changes(pointers, db_session,
+                                                 exclude_types, include_types):
+        pointer = pointers[namespace_id]
+        deltas, new_pointer = format_transactions_after_pointer(
+            namespaces[namespace_id], pointer, db_session, result_limit,
+            exclude_types, include_types, exclude_folders, exclude_metadata,
+            exclude_account, expand=expand, is_n1=is_n1)
+        if new_pointer is not None and new_pointer != pointer:
+            results[namespace_id] = (deltas, new_pointer)
+    return results
+
+
+def multi_namespace_streaming_change_generator(namespaces, poll_interval,
+                                               timeout, transaction_pointers,
+                                               exclude_types=None,
+                                               include_types=None,
+                                               exclude_folders=True,
+                                               exclude_metadata=True,
+                                               exclude_account=True,
+                                               expand=False, is_n1=False):
+    """
+    Like streaming_change_generator, but for many namespaces on the same
+    shard: each poll checks all of them for new transactions at once, and
+    deltas are multiplexed onto a single stream. Every delta carries the
+    public id of its namespace in its `namespace_id` field.
+
+    Arguments
+    ---------
+    namespaces: list
+        Detached Namespace objects, all on the same shard.
+    transaction_pointers: dict
+        Mapping of namespace id -> transaction pointer to start after.
+
+    """
+    encoder = APIEncoder(is_n1=is_n1)
+    namespaces = {namespace.id: namespace for namespace in namespaces}
+    pointers = dict(transaction_pointers)
+    shard_key = next(iter(namespaces))
+    start_time = time.time()
+    while time.time() - start_time < timeout:
+        with session_scope(shard_key, read_only=True) as db_session:
+            results = format_transactions_for_namespaces(
+                namespaces, pointers, db_session, 100, exclude_types,
+                include_types, exclude_folders, exclude_metadata,
+                exclude_account, expand=expand, is_n1=is_n1)
+
+        yielded = False
+        for namespace_id, (deltas, new_pointer) in results.iteritems():
+            pointers[namespace_id] = new_pointer
+            public_id = namespaces[namespace_id].public_id
+            for delta in deltas:
+                delta['namespace_id'] = public_id
+                yield encoder.cereal(delta) + '\n'
+                yielded = True
+        if not yielded:
+            yield '\n'
+            gevent.sleep(poll_interval)
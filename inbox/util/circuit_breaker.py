@@ -0,0 +1,121 @@
+"""
+A circuit breaker, for pausing calls to a remote service (e.g. a mail
+provider) while most of them are failing.
+
+The breaker is *closed* while calls succeed. Once at least `min_calls`
+calls were made in the last `window` seconds and at least `failure_ratio` of
+them failed, it *opens*, and allow() refuses calls for `reset_timeout`
+seconds. After that it's *half-open*: allow() lets a single probe call
+through, whose outcome closes the breaker again or reopens it.
+
+"""
+import time
+from collections import deque
+
+from inbox.util.stats import statsd_client
+from nylas.logging import get_logger
+log = get_logger()
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+    """
+    Parameters
+    ----------
+    name: string
+        For logging, and the metrics `<name>.open` (a gauge that's 1 while
+        the breaker isn't closed) and `<name>.opened`.
+    window: float
+        How many seconds of calls the failure ratio is computed over.
+    min_calls: int
+        The breaker doesn't open with fewer calls than this in the window.
+    failure_ratio: float
+    reset_timeout: float
+        How long the breaker stays open before a probe is let through. A
+        probe that hasn't reported back after this long is given up on.
+    clock: callable, optional
+        Returns the current time, for testing.
+
+    """
+
+    def __init__(self, name, window=60, min_calls=20, failure_ratio=0.5,
+                 reset_timeout=30, clock=time.time):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = CLOSED
+        # (time, succeeded) for the calls in the window.
+        self.calls = deque()
+        self.opened_at = None
+        self.probe_started_at = None
+
+    def allow(self):
+        """
+        Whether a call may be made now. In the half-open state, only one
+        caller gets True, and should report the outcome of its call.
+
+        """
+        now = self.clock()
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            self.state = HALF_OPEN
+        elif now - self.probe_started_at < self.reset_timeout:
+            # Another probe is in flight.
+            return False
+        self.probe_started_at = now
+        log.info('Probing circuit breaker', breaker=self.name)
+        return True
+
+    def retry_in(self):
+        """ How many seconds until allow() may return True again. """
+        if self.state == CLOSED:
+            return 0
+        started_at = (self.opened_at if self.state == OPEN else
+                      self.probe_started_at)
+        return max(0, started_at + self.reset_timeout - self.clock())
+
+    def record_success(self):
+        if self.state == HALF_OPEN:
+            self._close()
+        else:
+            self._record(True)
+
+    def record_failure(self):
+        if self.state == HALF_OPEN:
+            self._open()
+            return
+        self._record(False)
+        if self.state != CLOSED or len(self.calls) < self.min_calls:
+            return
+        failures = sum(1 for _, succeeded in self.calls if not succeeded)
+        if failures >= self.failure_ratio * len(self.calls):
+            self._open()
+
+    def _record(self, succeeded):
+        now = self.clock()
+        self.calls.append((now, succeeded))
+        while self.calls and self.calls[0][0] < now - self.window:
+            self.calls.popleft()
+
+    def _open(self):
+        log.warning('Opening circuit breaker', breaker=self.name,
+                    calls=len(self.calls))
+        self.state = OPEN
+        self.opened_at = self.clock()
+        statsd_client.incr('{}.opened'.format(self.name))
+        statsd_client.gauge('{}.open'.format(self.name), 1)
+
+    def _close(self):
+        log.info('Closing circuit breaker', breaker=self.name)
+        self.state = CLOSED
+        self.calls.clear()
+        statsd_client.gauge('{}.open'.format(self.name), 0)
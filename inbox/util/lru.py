@@ -0,0 +1,61 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """
+    A bounded, in-process LRU mapping whose entries expire after a fixed
+    number of seconds.
+
+    Used to memoize small, hot lookups (e.g. API token -> namespace) so we
+    don't have to go to the database on every request. This is not
+    thread-safe, but it never yields, so it is safe to share between
+    greenlets.
+
+    Parameters
+    ----------
+    maxsize: int
+        Maximum number of entries; the least recently used entry is evicted
+        once this is exceeded.
+    ttl: float
+        Default lifetime of an entry, in seconds.
+
+    """
+
+    def __init__(self, maxsize=10000, ttl=60):
+        assert maxsize > 0
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            expires_at, value = self._data.pop(key)
+        except KeyError:
+            return default
+        if expires_at <= time.time():
+            return default
+        # Re-insert to mark as most recently used.
+        self._data[key] = (expires_at, value)
+        return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        self._data.pop(key, None)
+        self._data[key] = (time.time() + ttl, value)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        entry = self._data.get(key)
+        return entry is not None and entry[0] > time.time()
+
+    def __len__(self):
+        return len(self._data)
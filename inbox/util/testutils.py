@@ -39,3 +39,9 @@ def setup_test_db():
             key = shard['ID']
             engine = engine_manager.engines[key]
             init_db(engine, key)
+
+    # In-process caches refer to rows in the databases we just dropped.
+    from inbox.transactions.cache import transaction_cache
+    from inbox.models.namespace_cache import namespace_cache
+    transaction_cache.clear()
+    namespace_cache.clear()
@@ -0,0 +1,299 @@
+"""
+Throttling for background maintenance jobs (transaction log purges, account
+deletion, message garbage collection).
+
+Load is measured by pluggable signals. Each reports a *pressure*: 0 when the
+resource it watches is idle, 1 or more when jobs should stop altogether.
+Jobs draw tokens (e.g. one per row deleted) from an AdaptiveRateLimiter, a
+token bucket whose refill rate is scaled down as the highest pressure rises
+past THROTTLE_SOFT_PRESSURE, and drops to zero at a pressure of 1.
+
+The signals used are configured with THROTTLE_SIGNALS (see SIGNALS for the
+names), or per job with THROTTLE_JOB_SIGNALS, and each job's full rate in
+tokens per second with THROTTLE_RATES.
+A signal that can't be checked keeps its last known pressure, so a missing
+privilege or an unreachable service doesn't stop every job. The default
+signals need no database privileges; the database ones (replica_lag,
+history_length, which needs PROCESS) have to be enabled explicitly.
+
+"""
+import os
+import time
+import datetime
+import multiprocessing
+
+import gevent
+import requests
+from gevent.lock import Semaphore
+
+from inbox.config import config
+from inbox.util.stats import statsd_client
+from nylas.logging import get_logger
+log = get_logger()
+
+THROTTLE_MAX_REPLICA_LAG = config.get('THROTTLE_MAX_REPLICA_LAG', 10)
+THROTTLE_MAX_HISTORY_LENGTH = config.get('THROTTLE_MAX_HISTORY_LENGTH',
+                                         1000000)
+THROTTLE_MAX_LOAD = config.get('THROTTLE_MAX_LOAD',
+                               multiprocessing.cpu_count())
+# Daily windows, as [start hour (UTC), duration in hours] pairs, during which
+# jobs don't run at all (e.g. while backups are taken).
+THROTTLE_SCHEDULE = config.get('THROTTLE_SCHEDULE', [])
+# Pressure up to which jobs run at their full rate.
+THROTTLE_SOFT_PRESSURE = config.get('THROTTLE_SOFT_PRESSURE', 0.5)
+# How often signals are sampled.
+THROTTLE_CHECK_INTERVAL = config.get('THROTTLE_CHECK_INTERVAL', 30)
+
+DEFAULT_RATES = {
+    'purge_transactions': 20000,
+    'delete_namespace': 20000,
+    'message_gc': 1000,
+}
+THROTTLE_RATES = dict(DEFAULT_RATES, **config.get('THROTTLE_RATES', {}))
+
+
+class Signal(object):
+    """ Base class for throttle signals. """
+    name = None
+
+    def pressure(self):
+        raise NotImplementedError
+
+
+class ReplicaLagSignal(Signal):
+    """ Replication lag of the shard's read replicas (SHOW SLAVE STATUS). """
+    name = 'replica_lag'
+
+    def __init__(self, shard_id, max_lag=THROTTLE_MAX_REPLICA_LAG):
+        self.shard_id = shard_id
+        self.max_lag = max_lag
+
+    def pressure(self):
+        from inbox.ignition import engine_manager
+        pressure = 0.
+        for replica in engine_manager.replica_engines.get(self.shard_id, []):
+            lag = engine_manager.replica_lag(replica)
+            # A replica that isn't replicating is as bad as it gets.
+            pressure = max(pressure, 1. if lag is None else
+                           float(lag) / self.max_lag)
+        return pressure
+
+
+class HistoryLengthSignal(Signal):
+    """
+    Length of InnoDB's history list on the shard's primary, i.e. how many
+    undo log entries are waiting to be purged. Bulk deletes add to it, and a
+    long history list slows down every read.
+
+    """
+    name = 'history_length'
+    QUERY = ("SELECT `count` FROM information_schema.innodb_metrics "
+             "WHERE name = 'trx_rseg_history_len'")
+
+    def __init__(self, shard_id, max_length=THROTTLE_MAX_HISTORY_LENGTH):
+        self.shard_id = shard_id
+        self.max_length = max_length
+
+    def pressure(self):
+        from inbox.ignition import engine_manager
+        engine = engine_manager.engines[self.shard_id]
+        length = engine.execute(self.QUERY).scalar()
+        return float(length or 0) / self.max_length
+
+
+class LoadAverageSignal(Signal):
+    """ One-minute load average of the host the job runs on. """
+    name = 'load_average'
+
+    def __init__(self, max_load=THROTTLE_MAX_LOAD):
+        self.max_load = max_load
+
+    def pressure(self):
+        return os.getloadavg()[0] / self.max_load
+
+
+class ScheduleSignal(Signal):
+    """ Full pressure during the daily windows in THROTTLE_SCHEDULE. """
+    name = 'schedule'
+
+    def __init__(self, windows=THROTTLE_SCHEDULE):
+        self.windows = windows
+
+    def pressure(self, now=None):
+        hour = (now or datetime.datetime.utcnow()).hour
+        for start_hour, duration_hours in self.windows:
+            # Windows may wrap around midnight.
+            if (hour - start_hour) % 24 < duration_hours:
+                return 1.
+        return 0.
+
+
+class MetricsServiceSignal(Signal):
+    """
+    Checks against an external metrics service (UMPIRE_BASE_URL): full
+    pressure if any sync-mysql-node replica is more than 10 seconds behind,
+    or if their average CPU use is over 70%.
+
+    """
+    name = 'metrics_service'
+    CHECKS = [
+        "maxSeries(servers.prod.sync-mysql-node.*.mysql.Seconds_Behind_Master)"
+        "&max=10&min=0&range=300",
+        'maxSeries(offset(scale(groupByNode('
+        'servers.prod.sync-mysql-node.*.cpu.cpu*.idle,3,"averageSeries"),-1),'
+        '100))&max=70&min=0&range=300'
+    ]
+
+    def __init__(self, base_url=None):
+        self.base_url = base_url or config['UMPIRE_BASE_URL']
+
+    def pressure(self):
+        for check in self.CHECKS:
+            url = 'https://{}/check?metric={}'.format(self.base_url, check)
+            if requests.get(url).status_code != 200:
+                return 1.
+        return 0.
+
+
+SIGNALS = {
+    'replica_lag': ReplicaLagSignal,
+    'history_length': HistoryLengthSignal,
+    'load_average': lambda shard_id: LoadAverageSignal(),
+    'schedule': lambda shard_id: ScheduleSignal(),
+    'metrics_service': lambda shard_id: MetricsServiceSignal(),
+}
+THROTTLE_SIGNALS = config.get(
+    'THROTTLE_SIGNALS',
+    ['schedule', 'load_average'] +
+    (['metrics_service'] if config.get('UMPIRE_BASE_URL') else []))
+# Per-job overrides of THROTTLE_SIGNALS. Message GC runs inside the sync
+# processes, so their own load would keep it from ever running; it ignores
+# the host's load average by default.
+DEFAULT_JOB_SIGNALS = {
+    'message_gc': [name for name in THROTTLE_SIGNALS
+                   if name != 'load_average'],
+}
+THROTTLE_JOB_SIGNALS = dict(DEFAULT_JOB_SIGNALS,
+                            **config.get('THROTTLE_JOB_SIGNALS', {}))
+
+
+class AdaptiveRateLimiter(object):
+    """
+    Token bucket whose rate adapts to the pressure reported by `signals`.
+
+    Parameters
+    ----------
+    name: string
+        Name of the job, for logging and metrics.
+    signals: list of Signal
+    rate: float
+        Tokens added per second when there's no pressure.
+    burst: float, optional
+        Size of the bucket. Defaults to one second's worth of tokens.
+    check_interval: float
+        How many seconds a sample of the signals is used for.
+
+    """
+
+    def __init__(self, name, signals, rate, burst=None,
+                 check_interval=THROTTLE_CHECK_INTERVAL,
+                 soft_pressure=THROTTLE_SOFT_PRESSURE):
+        self.name = name
+        self.signals = signals
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.check_interval = check_interval
+        self.soft_pressure = soft_pressure
+        self.tokens = self.burst
+        self.refilled_at = time.time()
+        self.checked_at = None
+        self.current_rate = self.rate
+        self.last_pressures = {}
+        self.lock = Semaphore()
+
+    def sample(self):
+        """
+        Returns the highest pressure reported by the signals. Signals that
+        fail count with their last known pressure (0 if they never worked).
+
+        """
+        pressure = 0.
+        for signal in self.signals:
+            try:
+                value = signal.pressure()
+            except Exception:
+                log.warning('Error checking throttle signal',
+                            signal=signal.name, exc_info=True)
+                statsd_client.incr('throttle.{}.{}.errors'.format(
+                    self.name, signal.name))
+                value = self.last_pressures.get(signal, 0.)
+            self.last_pressures[signal] = value
+            statsd_client.gauge('throttle.{}.{}'.format(self.name,
+                                                        signal.name), value)
+            pressure = max(pressure, value)
+        return pressure
+
+    def _update_rate(self):
+        now = time.time()
+        if self.checked_at is not None and \
+                now - self.checked_at < self.check_interval:
+            return
+        self.checked_at = now
+        pressure = self.sample()
+        if pressure >= 1:
+            factor = 0.
+        elif pressure <= self.soft_pressure:
+            factor = 1.
+        else:
+            factor = (1 - pressure) / (1 - self.soft_pressure)
+        self.current_rate = self.rate * factor
+        statsd_client.gauge('throttle.{}.rate'.format(self.name),
+                            self.current_rate)
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens +
+                          (now - self.refilled_at) * self.current_rate)
+        self.refilled_at = now
+
+    def acquire(self, tokens=1):
+        """
+        Block until `tokens` tokens are available and take them. Requests
+        larger than the bucket only wait for a full bucket, and take the rest
+        out of future refills. Blocks while the rate is zero, even for zero
+        tokens.
+
+        """
+        with self.lock:
+            while True:
+                self._update_rate()
+                self._refill()
+                needed = min(tokens, self.burst)
+                if self.current_rate > 0 and self.tokens >= needed:
+                    self.tokens -= tokens
+                    return
+                if self.current_rate <= 0:
+                    log.info('Throttling', job=self.name)
+                    gevent.sleep(self.check_interval)
+                else:
+                    gevent.sleep(min(self.check_interval,
+                                     (needed - self.tokens) /
+                                     self.current_rate))
+
+
+_limiters = {}
+
+
+def get_throttle(job, shard_id):
+    """
+    Returns the process-wide rate limiter for the maintenance job `job`
+    (e.g. 'delete_namespace') on shard `shard_id`.
+
+    """
+    key = (job, shard_id)
+    if key not in _limiters:
+        names = THROTTLE_JOB_SIGNALS.get(job, THROTTLE_SIGNALS)
+        signals = [SIGNALS[name](shard_id) for name in names]
+        _limiters[key] = AdaptiveRateLimiter(
+            '{}.{}'.format(job, shard_id), signals, THROTTLE_RATES[job])
+    return _limiters[key]
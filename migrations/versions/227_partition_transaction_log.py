@@ -0,0 +1,40 @@
+"""Partition the transaction log by created_at
+
+Only applies if TRANSACTION_LOG_PARTITIONED is set, because it rebuilds the
+transaction table, which takes a while on large shards. To switch an
+existing deployment over later, set it and run
+`bin/purge-transaction-log --partition`.
+
+Revision ID: 4e4bd8d2d3f1
+Revises: 2dbf6da0775b
+Create Date: 2016-08-02 18:12:41.209713
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4e4bd8d2d3f1'
+down_revision = '2dbf6da0775b'
+
+from alembic import op
+
+
+def upgrade():
+    import datetime
+    from inbox.models.partitioning import (TRANSACTION_LOG_PARTITIONED,
+                                           partition_transaction_log)
+    from inbox.models.util import TRANSACTION_LOG_PARTITIONS_AHEAD
+
+    if not TRANSACTION_LOG_PARTITIONED:
+        return
+    conn = op.get_bind()
+    conn.execute("set @@lock_wait_timeout = 20;")
+    partition_transaction_log(conn, datetime.datetime.utcnow().date(),
+                              TRANSACTION_LOG_PARTITIONS_AHEAD)
+
+
+def downgrade():
+    from inbox.models.partitioning import unpartition_transaction_log
+
+    conn = op.get_bind()
+    conn.execute("set @@lock_wait_timeout = 20;")
+    unpartition_transaction_log(conn)
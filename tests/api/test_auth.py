@@ -58,3 +58,56 @@ def test_invalid_bearer_token_auth(db, generic_account):  # noqa
 
     response = api_client.get_raw('/account')
     assert response.status_code == 401
+
+
+def test_auth_uses_namespace_cache(db, generic_account, monkeypatch):  # noqa
+    from inbox.models.namespace_cache import namespace_cache
+    namespace_cache.clear()
+    api_client = new_api_client(db, generic_account.namespace)
+
+    response = api_client.get_raw('/account')
+    assert response.status_code == 200
+
+    def fail(*args, **kwargs):
+        raise AssertionError('Namespace should have been served from cache')
+    monkeypatch.setattr('inbox.models.namespace_cache.global_session_scope',
+                        fail)
+
+    response = api_client.get_raw('/account')
+    assert response.status_code == 200
+
+
+def test_invalid_tokens_are_cached(db, generic_account, monkeypatch):  # noqa
+    from inbox.models.namespace_cache import namespace_cache
+    namespace_cache.clear()
+    api_client = new_api_client(db, generic_account.namespace)
+    api_client.auth_header = {
+        'Authorization': 'Bearer {}'.format(BAD_TOKEN)}
+
+    response = api_client.get_raw('/account')
+    assert response.status_code == 401
+
+    def fail(*args, **kwargs):
+        raise AssertionError('Invalid token should have been cached')
+    monkeypatch.setattr('inbox.models.namespace_cache.global_session_scope',
+                        fail)
+
+    response = api_client.get_raw('/account')
+    assert response.status_code == 401
+
+
+def test_namespace_cache_invalidation(db, generic_account):  # noqa
+    from inbox.models.namespace_cache import (namespace_cache,
+                                              resolve_namespace,
+                                              invalidate_namespace)
+    namespace_cache.clear()
+    public_id = generic_account.namespace.public_id
+
+    record = resolve_namespace(public_id)
+    assert record.namespace_id == generic_account.namespace.id
+    assert record.account_id == generic_account.id
+    assert record.shard_id == generic_account.namespace.id >> 48
+    assert public_id in namespace_cache.local
+
+    invalidate_namespace(public_id)
+    assert public_id not in namespace_cache.local
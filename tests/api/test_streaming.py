@@ -3,7 +3,7 @@ import time
 from gevent import Greenlet
 
 import pytest
-from tests.util.base import add_fake_message
+from tests.util.base import add_fake_message, add_fake_thread
 from inbox.util.url import url_concat
 from tests.api.base import api_client
 
@@ -166,3 +166,45 @@ def test_longpoll_delta_timeout(db, api_client,
     assert type(parsed_responses['deltas']) == list
     assert parsed_responses['cursor_start'] == cursor
     assert parsed_responses['cursor_end'] == cursor
+
+
+def test_multi_namespace_streaming(db, streaming_test_client, config,
+                                   default_namespace, generic_account,
+                                   thread, monkeypatch):
+    monkeypatch.setitem(config, 'ADMIN_API_KEY', 'secret')
+    other_namespace = generic_account.namespace
+    add_fake_message(db.session, default_namespace.id, thread)
+    add_fake_message(db.session, other_namespace.id,
+                     add_fake_thread(db.session, other_namespace.id))
+
+    body = {'cursors': {default_namespace.public_id: '0',
+                        other_namespace.public_id: '0'},
+            'timeout': .1}
+    r = streaming_test_client.post(
+        '/admin/delta/streaming', data=json.dumps(body),
+        headers={'Authorization': 'Bearer secret'})
+    assert r.status_code == 200
+    deltas = [json.loads(line) for line in r.data.split('\n') if line]
+    for delta in deltas:
+        validate_response_format(json.dumps(delta))
+    assert {d['namespace_id'] for d in deltas} == \
+        {default_namespace.public_id, other_namespace.public_id}
+
+    # The body must be an object.
+    r = streaming_test_client.post(
+        '/admin/delta/streaming', data=json.dumps([body]),
+        headers={'Authorization': 'Bearer secret'})
+    assert r.status_code == 400
+
+    # Bad credentials
+    r = streaming_test_client.post(
+        '/admin/delta/streaming', data=json.dumps(body),
+        headers={'Authorization': 'Bearer nope'})
+    assert r.status_code == 401
+
+    # Namespace access tokens aren't admin credentials.
+    r = streaming_test_client.post(
+        '/admin/delta/streaming', data=json.dumps(body),
+        headers={'Authorization': 'Bearer {}'.format(
+            default_namespace.public_id)})
+    assert r.status_code == 401
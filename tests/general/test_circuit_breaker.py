@@ -0,0 +1,49 @@
+from inbox.util.circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.
+
+    def __call__(self):
+        return self.now
+
+
+def test_circuit_breaker():
+    clock = Clock()
+    breaker = CircuitBreaker('test', window=60, min_calls=4,
+                             failure_ratio=0.5, reset_timeout=30, clock=clock)
+
+    # Too few calls to tell.
+    for _ in range(3):
+        breaker.record_failure()
+    assert breaker.state == CLOSED and breaker.allow()
+
+    # Old failures drop out of the window.
+    clock.now += 61
+    breaker.record_success()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert breaker.retry_in() == 30
+
+    # A single probe is let through after the reset timeout; if it fails,
+    # the breaker opens again.
+    clock.now += 30
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN and not breaker.allow()
+
+    # A probe that never reports back is given up on.
+    clock.now += 30
+    assert breaker.allow()
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED and breaker.allow()
+    assert breaker.retry_in() == 0
@@ -0,0 +1,63 @@
+import pytest
+
+from inbox.models.base import MailSyncBase
+from inbox.models.deletion import (plan_deletion, AdaptiveBatchSize,
+                                   DeletionProgress, delete_table)
+
+TABLES = ['message', 'block', 'thread', 'transaction', 'actionlog',
+          'contact', 'event', 'dataprocessingcache', 'imapuid',
+          'imapfoldersyncstatus', 'imapfolderinfo']
+
+
+def test_plan_deletion():
+    plan = plan_deletion(TABLES, MailSyncBase.metadata)
+    # Referencing rows go first.
+    assert {'imapuid', 'event'} <= plan['message']
+    assert 'message' in plan['thread']
+    # Tables whose rows cascade into the same table (part,
+    # messagecontactassociation) aren't deleted from at the same time.
+    assert {'block', 'contact'} <= plan['message']
+    for table in ('transaction', 'actionlog', 'imapfolderinfo'):
+        assert plan[table] == set()
+
+
+def test_plan_deletion_rejects_cycles():
+    from inbox.models import deletion
+    with pytest.raises(ValueError):
+        deletion._toposort(['a', 'b'], {'a': {'b'}, 'b': {'a'}})
+
+
+def test_adaptive_batch_size():
+    batch_size = AdaptiveBatchSize(target=1, size=100, minimum=50,
+                                   maximum=300)
+    batch_size.update(0.1)
+    assert batch_size.size == 200
+    batch_size.update(0.1)
+    assert batch_size.size == 300
+    batch_size.update(0.7)
+    assert batch_size.size == 300
+    for _ in range(3):
+        batch_size.update(2)
+    assert batch_size.size == 50
+
+
+def test_resumable_table_deletion(db, default_namespace, thread, tmpdir):
+    from tests.util.base import add_fake_message
+    for i in range(5):
+        add_fake_message(db.session, default_namespace.id, thread)
+    db.session.commit()
+    path = str(tmpdir.join('progress.json'))
+
+    progress = DeletionProgress(path)
+    delete_table(db, 'message', 'namespace_id', default_namespace.id,
+                 progress, dry_run=True)
+    assert not progress.done('message')
+
+    delete_table(db, 'message', 'namespace_id', default_namespace.id,
+                 progress)
+    assert db.execute('SELECT COUNT(*) FROM message WHERE namespace_id={}'.
+                      format(default_namespace.id)).scalar() == 0
+
+    resumed = DeletionProgress(path)
+    assert resumed.done('message')
+    assert resumed.summary()['message']['deleted'] >= 5
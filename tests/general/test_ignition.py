@@ -60,3 +60,44 @@ def test_reset_autoincrements(base_db):
 
     assert len(reset_tables) > 0
     verify_db(engines[key], shard_schemas[key], key)
+
+
+def test_long_held_connections(db):
+    from inbox.ignition import engine_manager, long_held_connections
+    engine = engine_manager.engines[0]
+    conn = engine.connect()
+    try:
+        held = [c for c in long_held_connections()
+                if c['database'] == engine.url.database]
+        assert held
+        assert all(c['age'] >= 0 for c in held)
+        assert not [c for c in long_held_connections(min_age=3600)
+                    if c['database'] == engine.url.database]
+    finally:
+        conn.close()
+
+
+def test_pool_metrics_report_peak(monkeypatch):
+    from inbox.ignition import PoolMetrics
+    gauges = {}
+    monkeypatch.setattr('inbox.ignition.statsd_client.gauge',
+                        lambda name, value: gauges.__setitem__(name, value))
+
+    class FakePool(object):
+        def checkedout(self):
+            return 1
+
+        def overflow(self):
+            return 0
+
+    metrics = PoolMetrics()
+    metrics._reporter = object()  # Don't start the reporting greenlet.
+    metrics.register('dbconn.test', FakePool())
+    metrics.record_checkout('dbconn.test', 5)
+    metrics.record_checkout('dbconn.test', 3)
+    metrics.report()
+    assert gauges == {'dbconn.test.checkedout': 1,
+                      'dbconn.test.checkedout_peak': 5,
+                      'dbconn.test.overflow': 0}
+    metrics.report()
+    assert gauges['dbconn.test.checkedout_peak'] == 1
@@ -0,0 +1,26 @@
+from inbox.models import Message
+from inbox.sqlalchemy_ext.util import keyset_scan, keyset_windows
+from tests.util.base import add_fake_message
+
+
+def test_keyset_scan(db, default_namespace, thread):
+    messages = [add_fake_message(db.session, default_namespace.id, thread,
+                                 g_msgid=i) for i in range(7)]
+    ids = [message.id for message in messages]
+
+    query = db.session.query(Message). \
+        filter(Message.namespace_id == default_namespace.id)
+    assert [m.id for m in keyset_scan(query, Message.id, window=3)] == ids
+
+    windows = list(keyset_windows(query, Message.id, window=3))
+    assert [len(w) for w in windows] == [3, 3, 1]
+
+    # Column-only queries, starting point and direction.
+    query = db.session.query(Message.id, Message.g_msgid). \
+        filter(Message.namespace_id == default_namespace.id)
+    assert [row.g_msgid for row in
+            keyset_scan(query, Message.id, window=2, after_id=ids[2])] == \
+        range(3, 7)
+    assert [row.id for row in
+            keyset_scan(query, Message.id, window=2, descending=True)] == \
+        ids[::-1]
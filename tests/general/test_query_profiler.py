@@ -0,0 +1,37 @@
+from inbox.instrumentation import QueryProfiler
+from inbox.models import Message
+
+
+def test_statement_normalization():
+    profiler = QueryProfiler()
+    assert profiler.normalize(
+        "SELECT message.id FROM message WHERE message.id IN (%s, %s,\n%s) "
+        "AND message.subject = 'it\\'s' LIMIT 10") == \
+        'SELECT message.id FROM message WHERE message.id IN (?) ' \
+        'AND message.subject = ? LIMIT ?'
+
+
+def test_profiler_aggregates_by_call_site(db, default_namespace):
+    profiler = QueryProfiler(n_plus_one_threshold=3)
+    profiler.enable()
+    try:
+        for i in range(5):
+            db.session.query(Message).filter(Message.id == i).all()
+        db.session.commit()
+        db.session.query(Message).count()
+    finally:
+        profiler.disable()
+
+    queries = profiler.stats()['queries']
+    by_statement = {q['statement']: q for q in queries
+                    if q['call_site'].startswith(__name__)}
+    repeated = [q for statement, q in by_statement.items()
+                if 'WHERE message.id = ?' in statement]
+    assert len(repeated) == 1
+    assert repeated[0]['count'] == 5
+    assert repeated[0]['n_plus_one'] == 1
+    assert repeated[0]['p50_time'] <= repeated[0]['max_time']
+
+    # Nothing is recorded while disabled.
+    db.session.query(Message).all()
+    assert profiler.stats()['queries'] == queries
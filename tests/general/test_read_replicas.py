@@ -0,0 +1,63 @@
+import pytest
+from sqlalchemy import create_engine
+
+from inbox.ignition import engine_manager
+from inbox.models.session import (engine_for_id, new_session,
+                                  ReadOnlySessionError)
+from inbox.transactions.cache import transaction_cache
+
+
+@pytest.yield_fixture
+def replica(monkeypatch):
+    replica = create_engine('sqlite://')
+    monkeypatch.setitem(engine_manager.replica_engines, 0, [replica])
+    monkeypatch.setattr(engine_manager, 'replica_lag', lambda engine: 0)
+    monkeypatch.setattr(transaction_cache, 'shared', True)
+    yield replica
+    transaction_cache.clear()
+
+
+def test_reads_use_replica(db, default_namespace, replica):
+    primary = engine_manager.get_for_id(default_namespace.id)
+    transaction_cache.clear()
+    assert engine_for_id(default_namespace.id, read_only=True) is replica
+    assert engine_for_id(default_namespace.id) is primary
+
+
+def test_replicas_need_shared_cache(db, default_namespace, replica,
+                                    monkeypatch):
+    primary = engine_manager.get_for_id(default_namespace.id)
+    transaction_cache.clear()
+    monkeypatch.setattr(transaction_cache, 'shared', False)
+    assert engine_for_id(default_namespace.id, read_only=True) is primary
+
+
+def test_lagging_replica_falls_back_to_primary(db, default_namespace,
+                                               replica, monkeypatch):
+    primary = engine_manager.get_for_id(default_namespace.id)
+    transaction_cache.clear()
+    monkeypatch.setattr(engine_manager, 'replica_lag', lambda engine: 3600)
+    assert engine_for_id(default_namespace.id, read_only=True) is primary
+    monkeypatch.setattr(engine_manager, 'replica_lag', lambda engine: None)
+    assert engine_for_id(default_namespace.id, read_only=True) is primary
+
+
+def test_reads_after_writes_use_primary(db, default_namespace, thread,
+                                        replica):
+    primary = engine_manager.get_for_id(default_namespace.id)
+    thread.subject = 'Updated'
+    db.session.commit()
+    assert engine_for_id(default_namespace.id, read_only=True) is primary
+
+
+def test_read_only_session_cannot_write(db, default_namespace, thread):
+    engine = engine_manager.get_for_id(default_namespace.id)
+    session = new_session(engine, read_only=True)
+    try:
+        thread = session.merge(thread)
+        thread.subject = 'Updated'
+        with pytest.raises(ReadOnlySessionError):
+            session.flush()
+    finally:
+        session.rollback()
+        session.close()
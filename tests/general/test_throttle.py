@@ -0,0 +1,72 @@
+import time
+import datetime
+
+import gevent
+
+from inbox.util.throttle import Signal, ScheduleSignal, AdaptiveRateLimiter
+
+
+class FakeSignal(Signal):
+    name = 'fake'
+
+    def __init__(self, value):
+        self.value = value
+        self.checks = 0
+
+    def pressure(self):
+        self.checks += 1
+        if isinstance(self.value, Exception):
+            raise self.value
+        return self.value
+
+
+def test_schedule_signal():
+    signal = ScheduleSignal([[22, 4]])
+    at = lambda hour: datetime.datetime(2016, 8, 1, hour)
+    assert signal.pressure(at(23)) == 1
+    assert signal.pressure(at(1)) == 1
+    assert signal.pressure(at(2)) == 0
+    assert signal.pressure(at(12)) == 0
+
+
+def test_rate_adapts_to_pressure():
+    signal = FakeSignal(0.2)
+    limiter = AdaptiveRateLimiter('test', [signal], rate=100,
+                                  check_interval=0)
+    limiter.acquire(10)
+    assert limiter.current_rate == 100
+
+    signal.value = 0.75
+    limiter.acquire(0)
+    assert limiter.current_rate == 50
+
+    # Broken signals keep their last known pressure.
+    signal.value = ValueError()
+    assert limiter.sample() == 0.75
+    limiter.acquire(0)
+    assert limiter.current_rate == 50
+
+
+def test_limiter_blocks_under_full_pressure():
+    signal = FakeSignal(1)
+    limiter = AdaptiveRateLimiter('test', [signal], rate=100,
+                                  check_interval=0.01)
+    greenlet = gevent.spawn(limiter.acquire, 0)
+    gevent.sleep(0.1)
+    assert not greenlet.ready()
+    assert signal.checks > 1
+
+    signal.value = 0
+    greenlet.join(timeout=1)
+    assert greenlet.ready()
+
+
+def test_limiter_rate():
+    limiter = AdaptiveRateLimiter('test', [FakeSignal(0)], rate=1000,
+                                  burst=100)
+    limiter.acquire(100)
+    start = time.time()
+    # Larger requests than the bucket take their tokens from future refills.
+    limiter.acquire(200)
+    limiter.acquire(100)
+    assert time.time() - start >= 0.25
@@ -54,3 +54,33 @@ def test_matching_subdomains(monkeypatch):
     # Check that if the domains are the same, we're not doing an
     # IP address resolution.
     assert matching_subdomains('nylas.com', 'nylas.com') is True
+
+
+def test_ttl_cache_expiry_and_eviction(monkeypatch):
+    from inbox.util import lru
+    from inbox.util.lru import TTLCache
+
+    now = [1000.0]
+    monkeypatch.setattr(lru.time, 'time', lambda: now[0])
+
+    cache = TTLCache(maxsize=2, ttl=10)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=1)
+    assert cache.get('a') == 1
+    assert cache.get('b') == 2
+
+    now[0] += 5
+    assert cache.get('b') is None
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+
+    # 'c' fills the cache, so adding 'd' pushes out 'a', the least recently
+    # used entry.
+    cache.set('c', 3)
+    cache.set('d', 4)
+    assert 'a' not in cache
+    assert cache.get('c') == 3
+    assert cache.get('d') == 4
+
+    cache.invalidate('c')
+    assert cache.get('c', 'missing') == 'missing'
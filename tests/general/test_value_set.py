@@ -0,0 +1,21 @@
+import pytest
+
+from inbox.models import Message
+from inbox.sqlalchemy_ext.util import ValueSet
+from tests.util.base import add_fake_message
+
+
+@pytest.mark.parametrize('threshold', [ValueSet.TEMP_TABLE_THRESHOLD, 2])
+def test_value_set(db, default_namespace, thread, monkeypatch, threshold):
+    monkeypatch.setattr(ValueSet, 'TEMP_TABLE_THRESHOLD', threshold)
+    monkeypatch.setattr(ValueSet, 'IN_CHUNK_SIZE', 2)
+    for i in range(5):
+        add_fake_message(db.session, default_namespace.id, thread, g_msgid=i)
+    criteria = Message.namespace_id == default_namespace.id
+
+    with ValueSet(db.session, [3, 4, 5, 6, 7], Message.g_msgid.type) as values:
+        assert (values.table is not None) == (threshold == 2)
+        assert values.existing(Message.g_msgid, criteria) == {3, 4}
+        assert values.missing(Message.g_msgid, criteria) == {5, 6, 7}
+        assert values.extra(Message.g_msgid, criteria) == {0, 1, 2}
+    assert values.table is None
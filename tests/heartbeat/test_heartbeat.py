@@ -5,9 +5,10 @@ import time
 from datetime import datetime, timedelta
 
 from inbox.heartbeat.store import (HeartbeatStore, HeartbeatStatusProxy,
-                                   HeartbeatStatusKey)
+                                   HeartbeatStatusKey, HeartbeatFlusher,
+                                   HEARTBEAT_PUBLISH_INTERVAL)
 from inbox.heartbeat.status import (clear_heartbeat_status,
-                                    get_ping_status)
+                                    get_ping_status, get_dead_folders)
 import inbox.heartbeat.config as heartbeat_config
 from inbox.heartbeat.config import ALIVE_EXPIRY
 from inbox.config import config
@@ -85,6 +86,39 @@ def test_folder_publish_in_index(redis_client):
     assert fuzzy_equals(proxy.heartbeat_at, timestamp)
 
 
+def test_publish_rate_limiting(redis_client):
+    proxy = proxy_for(1, 2)
+    other_proxy = proxy_for(1, 3)
+    proxy.publish()
+    other_proxy.publish()
+    first = redis_client.zscore('1', '2')
+    assert fuzzy_equals(proxy.heartbeat_at, first)
+
+    # Heartbeats aren't written more than once per interval...
+    proxy.publish()
+    assert redis_client.zscore('1', '2') == first
+    flusher = HeartbeatFlusher.flusher()
+    assert not flusher.pending
+
+    # ...and after that, they're buffered until the next flush.
+    for p in (proxy, other_proxy):
+        p.published_at -= HEARTBEAT_PUBLISH_INTERVAL
+        p.publish()
+    assert redis_client.zscore('1', '2') == first
+    assert len(flusher.pending) == 2
+    flusher.flush()
+    assert not flusher.pending
+    assert redis_client.zscore('1', '2') == proxy.heartbeat_at
+    assert redis_client.zscore('1', '3') == other_proxy.heartbeat_at
+
+    # Clearing a folder drops its buffered heartbeat.
+    proxy.published_at -= HEARTBEAT_PUBLISH_INTERVAL
+    proxy.publish()
+    proxy.clear()
+    flusher.flush()
+    assert redis_client.zscore('1', '2') is None
+
+
 def test_kill_device_multiple():
     # If we kill a device and the folder has multiple devices, don't clear
     # the heartbeat status
@@ -141,3 +175,27 @@ def test_ping_single(random_heartbeats):
     single = ping[0]
     for f in single.folders:
         assert f.alive
+
+
+def test_bulk_operations(redis_client):
+    store = HeartbeatStore.store()
+    now = time.time()
+    dead_at = now - ALIVE_EXPIRY - 100
+    for account_id in range(1, 4):
+        for folder_id in range(1, 4):
+            timestamp = dead_at if (account_id, folder_id) == (1, 3) else now
+            store.publish(HeartbeatStatusKey(account_id, folder_id),
+                          timestamp)
+    assert redis_client.zscore('account_index', '1') == dead_at
+    assert redis_client.zscore('account_index', '2') == now
+
+    assert store.get_dead_folders(now - 1) == {1: [('3', dead_at)]}
+    assert store.get_dead_folders(now - 1, account_ids=[2, 3]) == {}
+    dead = get_dead_folders()
+    assert dead.keys() == [1]
+    assert [(f.id, f.alive) for f in dead[1].folders] == [(3, False)]
+
+    assert store.remove_accounts([1, 2]) == 6
+    assert redis_client.zrange('1', 0, -1) == []
+    assert redis_client.zrange('account_index', 0, -1) == ['3']
+    assert get_dead_folders() == {}
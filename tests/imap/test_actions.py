@@ -8,9 +8,12 @@ from inbox.actions.base import (change_labels, save_draft, update_draft,
                                 delete_folder, create_label, update_label,
                                 delete_label, mark_unread, mark_starred)
 from tests.imap.data import mock_imapclient  # noqa
-from tests.util.base import add_fake_imapuid, add_fake_category
+from tests.util.base import (add_fake_imapuid, add_fake_category,
+                             add_fake_message)
 from inbox.crispin import writable_connection_pool
-from inbox.models import Category
+from inbox.models import Category, ActionLog
+from inbox.models.action_log import schedule_action
+from inbox.transactions.actions import SyncbackService
 from inbox.sendmail.base import create_message_from_json
 from inbox.sendmail.base import update_draft as sendmail_update_draft
 
@@ -103,6 +106,66 @@ def test_change_labels(db, default_account, message, folder, mock_imapclient):
     mock_imapclient.remove_gmail_labels.assert_called_with([22], ['\\Inbox'])
 
 
+def test_coalesced_syncback(db, default_account, thread, folder,
+                            mock_imapclient):
+    mock_imapclient.add_folder_data(folder.name, {})
+    mock_imapclient.add_flags = mock.Mock()
+    mock_imapclient.remove_flags = mock.Mock()
+    namespace_id = default_account.namespace.id
+    db.session.query(ActionLog).delete()
+    messages = []
+    for uid in range(1, 6):
+        message = add_fake_message(db.session, namespace_id, thread)
+        add_fake_imapuid(db.session, default_account.id, message, folder, uid)
+        messages.append(message)
+
+    for message in messages[:3]:
+        schedule_action('mark_unread', message, namespace_id, db.session,
+                        unread=False)
+    # Marks the first message unread again after it's been marked read.
+    schedule_action('mark_unread', messages[0], namespace_id, db.session,
+                    unread=True)
+    for message in messages[3:] + messages[:1]:
+        schedule_action('mark_unread', message, namespace_id, db.session,
+                        unread=False)
+    db.session.commit()
+
+    service = SyncbackService(syncback_id=0, process_number=0,
+                              total_processes=1, num_workers=2)
+    service._process_log()
+    task = service.task_queue.get()
+    task.execute()
+
+    # Marking the first message read again can't be merged with the other
+    # actions, since it has to happen after it's marked unread.
+    assert [args[0] for args, _ in mock_imapclient.add_flags.call_args_list] \
+        == [[1, 2, 3, 4, 5], [1]]
+    mock_imapclient.remove_flags.assert_called_once_with([1], ['\\Seen'])
+    db.session.expire_all()
+    assert all(entry.status == 'successful' for entry in
+               db.session.query(ActionLog).filter(
+                   ActionLog.namespace_id == namespace_id))
+
+
+
+def test_breakers_per_imap_server(db, default_account, generic_account):
+    import socket
+    from imaplib import IMAP4
+    from inbox.transactions.actions import breaker_key, record_outcome
+    from inbox.util.circuit_breaker import CircuitBreaker, OPEN
+    assert breaker_key(default_account) == 'gmail'
+    assert breaker_key(generic_account) == 'imap.imap_custom_com'
+
+    # Errors specific to an action don't open the breaker.
+    breaker = CircuitBreaker('test', min_calls=2)
+    record_outcome(breaker, IMAP4.error('NO [TRYCREATE] No such folder'))
+    record_outcome(breaker, ValueError())
+    assert breaker.state != OPEN
+    record_outcome(breaker, socket.error())
+    record_outcome(breaker, socket.error())
+    assert breaker.state == OPEN
+
+
 @pytest.mark.parametrize('obj_type', ['folder', 'label'])
 def test_folder_crud(db, default_account, mock_imapclient, obj_type):
     mock_imapclient.create_folder = mock.Mock()
@@ -1,4 +1,5 @@
 # flake8: noqa: F401, F811
+import multiprocessing
 from datetime import datetime, timedelta
 import pytest
 from sqlalchemy import desc
@@ -11,7 +12,8 @@ from inbox.mailsync.backends.imap.common import (remove_deleted_uids,
 from inbox.mailsync.gc import DeleteHandler, LabelRenameHandler
 from inbox.models import Folder, Transaction
 from inbox.models.label import Label
-from tests.util.base import add_fake_imapuid, add_fake_message
+from tests.util.base import (add_fake_imapuid, add_fake_message,
+                             add_fake_thread)
 from tests.imap.data import mock_imapclient, MockIMAPClient
 
 
@@ -77,10 +79,7 @@ def test_deleting_from_a_message_with_multiple_uids(db, default_account,
 
 def test_deletion_with_short_ttl(db, default_account, default_namespace,
                                  marked_deleted_message, thread, folder):
-    handler = DeleteHandler(account_id=default_account.id,
-                            namespace_id=default_namespace.id,
-                            provider_name=default_account.provider,
-                            uid_accessor=lambda m: m.imapuids,
+    handler = DeleteHandler(lambda: [default_namespace.id],
                             message_ttl=0)
     handler.check(marked_deleted_message.deleted_at + timedelta(seconds=1))
     db.session.expire_all()
@@ -91,14 +90,29 @@ def test_deletion_with_short_ttl(db, default_account, default_namespace,
         thread.id
 
 
+def test_throttled_deletion_ignores_host_load(db, default_account,
+                                              default_namespace,
+                                              marked_deleted_message, thread,
+                                              folder, monkeypatch):
+    load = float(multiprocessing.cpu_count())
+    monkeypatch.setattr('os.getloadavg', lambda: (load, load, load))
+    monkeypatch.setattr('inbox.util.throttle._limiters', {})
+    handler = DeleteHandler(lambda: [default_namespace.id],
+                            message_ttl=0, throttle=True)
+    greenlet = gevent.spawn(
+        handler.check,
+        marked_deleted_message.deleted_at + timedelta(seconds=1))
+    greenlet.join(timeout=5)
+    assert greenlet.successful()
+    db.session.expire_all()
+    with pytest.raises(ObjectDeletedError):
+        marked_deleted_message.id
+
 def test_non_orphaned_messages_get_unmarked(db, default_account,
                                             default_namespace,
                                             marked_deleted_message, thread,
                                             folder, imapuid):
-    handler = DeleteHandler(account_id=default_account.id,
-                            namespace_id=default_namespace.id,
-                            provider_name=default_account.provider,
-                            uid_accessor=lambda m: m.imapuids,
+    handler = DeleteHandler(lambda: [default_namespace.id],
                             message_ttl=0)
     handler.check(marked_deleted_message.deleted_at + timedelta(seconds=1))
     db.session.expire_all()
@@ -111,10 +125,7 @@ def test_threads_only_deleted_when_no_messages_left(db, default_account,
                                                     default_namespace,
                                                     marked_deleted_message,
                                                     thread, folder):
-    handler = DeleteHandler(account_id=default_account.id,
-                            namespace_id=default_namespace.id,
-                            provider_name=default_account.provider,
-                            uid_accessor=lambda m: m.imapuids,
+    handler = DeleteHandler(lambda: [default_namespace.id],
                             message_ttl=0)
     # Add another message onto the thread
     add_fake_message(db.session, default_namespace.id, thread)
@@ -128,14 +139,46 @@ def test_threads_only_deleted_when_no_messages_left(db, default_account,
     thread.id
 
 
+def test_deletion_in_batches(db, default_account, default_namespace, folder):
+    deleted_at = datetime(2015, 2, 22, 22, 22, 22)
+    threads = [add_fake_thread(db.session, default_namespace.id)
+               for _ in range(2)]
+    dangling = []
+    for i, thread in enumerate(threads):
+        for j in range(3):
+            message = add_fake_message(
+                db.session, default_namespace.id, thread,
+                subject='{}{}'.format(i, j),
+                received_date=datetime(2015, 1, 1 + j))
+            dangling.append(message)
+    kept = add_fake_message(db.session, default_namespace.id, threads[0],
+                            subject='kept',
+                            received_date=datetime(2015, 1, 10))
+    add_fake_imapuid(db.session, default_account.id, kept, folder, 1234)
+    for message in dangling + [kept]:
+        message.deleted_at = deleted_at
+    db.session.commit()
+
+    handler = DeleteHandler(lambda: [default_namespace.id], message_ttl=0,
+                            batch_size=2)
+    handler.check(deleted_at + timedelta(seconds=1))
+    db.session.expire_all()
+    for message in dangling:
+        with pytest.raises(ObjectDeletedError):
+            message.id
+    with pytest.raises(ObjectDeletedError):
+        threads[1].id
+    # The message with an imapuid is kept, and its thread recomputed.
+    assert kept.deleted_at is None
+    assert threads[0].messages == [kept]
+    assert threads[0].subject == 'kept'
+
+
 def test_deletion_deferred_with_longer_ttl(db, default_account,
                                            default_namespace,
                                            marked_deleted_message, thread,
                                            folder):
-    handler = DeleteHandler(account_id=default_account.id,
-                            namespace_id=default_namespace.id,
-                            provider_name=default_account.provider,
-                            uid_accessor=lambda m: m.imapuids,
+    handler = DeleteHandler(lambda: [default_namespace.id],
                             message_ttl=5)
     db.session.commit()
 
@@ -149,10 +192,7 @@ def test_deletion_creates_revision(db, default_account, default_namespace,
                                    marked_deleted_message, thread, folder):
     message_id = marked_deleted_message.id
     thread_id = thread.id
-    handler = DeleteHandler(account_id=default_account.id,
-                            namespace_id=default_namespace.id,
-                            provider_name=default_account.provider,
-                            uid_accessor=lambda m: m.imapuids,
+    handler = DeleteHandler(lambda: [default_namespace.id],
                             message_ttl=0)
     handler.check(marked_deleted_message.deleted_at + timedelta(seconds=1))
     db.session.commit()
@@ -195,10 +235,7 @@ def test_deleted_labels_get_gced(empty_db, default_account, thread, message,
         for l in cat.labels:
             label_ids.append(l.id)
 
-    handler = DeleteHandler(account_id=default_account.id,
-                            namespace_id=default_namespace.id,
-                            provider_name=default_account.provider,
-                            uid_accessor=lambda m: m.imapuids,
+    handler = DeleteHandler(lambda: [default_namespace.id],
                             message_ttl=0)
     handler.gc_deleted_categories()
     empty_db.session.commit()
@@ -1,4 +1,6 @@
 # flake8: noqa: F401, F811
+import json
+import mock
 import pytest
 from hashlib import sha256
 from gevent.lock import BoundedSemaphore
@@ -323,3 +325,45 @@ def test_imap_message_deduplication(db, generic_account, inbox_folder,
     assert db.session.query(Message).filter(
         Message.namespace_id == generic_account.namespace.id,
         Message.data_sha256 == body_sha).count() == 1
+
+
+def test_handoff_resumes_folder_state(db, generic_account, inbox_folder,
+                                      mock_imapclient, monkeypatch):
+    uid_dict = uids.example()
+    mock_imapclient.add_folder_data(inbox_folder.name, uid_dict)
+
+    def new_engine():
+        engine = FolderSyncEngine(generic_account.id,
+                                  generic_account.namespace.id,
+                                  inbox_folder.name,
+                                  generic_account.email_address,
+                                  'custom',
+                                  BoundedSemaphore(1))
+        engine.poll_frequency = 0
+        return engine
+
+    old_engine = new_engine()
+    old_engine.initial_sync()
+    # Do both a slow and a fast flags refresh.
+    old_engine.poll_impl()
+    old_engine.poll_impl()
+    old_engine.drain()
+    with pytest.raises(MailsyncDone):
+        old_engine.poll_impl()
+    state = json.loads(json.dumps(old_engine.handoff_state()))
+
+    engine = new_engine()
+    engine.resume_from(state)
+    # Neither the folder info nor unchanged flags need to be reloaded or
+    # persisted again.
+    monkeypatch.setattr(engine, '_load_imap_folder_info', mock.Mock(
+        side_effect=AssertionError('folder info loaded')))
+    update_metadata = mock.Mock()
+    monkeypatch.setattr(
+        'inbox.mailsync.backends.imap.common.update_metadata',
+        update_metadata)
+    engine.poll_impl()
+    assert engine.uidnext == old_engine.uidnext
+    engine.last_fast_refresh = None
+    engine.poll_impl()
+    assert not update_metadata.called
@@ -0,0 +1,103 @@
+"""
+Microbenchmark for the per-request overhead of building and compiling the
+/threads and /messages queries in inbox.api.filtering.
+
+Runs each common filter combination against the test database, once with
+the query bakery as used in production and once with every baked query fully
+spoiled (i.e. rebuilt and recompiled on every call, as unbaked queries are).
+The difference is the per-request compilation overhead that baking saves.
+
+Usage: INBOX_ENV=test python -m tests.perf.bench_filtering [--iterations N]
+"""
+import time
+import argparse
+from datetime import datetime, timedelta
+
+from inbox.api import filtering
+from inbox.sqlalchemy_ext.util import bakery
+from tests.util.base import (make_default_account, add_fake_thread,
+                             add_fake_message, add_fake_category,
+                             make_config)
+
+COMMON_THREAD_ARGS = dict(
+    subject=None, from_addr=None, to_addr=None, cc_addr=None, bcc_addr=None,
+    any_email=None, thread_public_id=None, started_before=None,
+    started_after=None, last_message_before=None, last_message_after=None,
+    filename=None, in_=None, unread=None, starred=None, limit=100, offset=0,
+    view=None)
+
+COMBINATIONS = [
+    ('no filters', {}),
+    ('in=inbox', {'in_': 'inbox'}),
+    ('unread', {'unread': True}),
+    ('from', {'from_addr': 'alice@example.com'}),
+    ('any_email', {'any_email': ['alice@example.com', 'bob@example.com']}),
+    ('in+to+last_message_after',
+     {'in_': 'inbox', 'to_addr': 'bob@example.com',
+      'last_message_after': datetime.utcnow() - timedelta(days=30)}),
+    ('ids view', {'view': 'ids', 'in_': 'inbox'}),
+    ('count view', {'view': 'count', 'starred': False}),
+]
+
+
+def unbaked(fn):
+    return bakery(fn).spoil(full=True)
+
+
+def setup(db_session):
+    account = make_default_account(db_session.bind, make_config())
+    namespace_id = account.namespace.id
+    category = add_fake_category(db_session, namespace_id, 'inbox')
+    for _ in range(20):
+        thread = add_fake_thread(db_session, namespace_id)
+        message = add_fake_message(
+            db_session, namespace_id, thread,
+            from_addr=[('Alice', 'alice@example.com')],
+            to_addr=[('Bob', 'bob@example.com')])
+        message.categories.add(category)
+    db_session.commit()
+    return namespace_id
+
+
+def time_calls(fn, iterations, **kwargs):
+    fn(**kwargs)  # Warm up the bakery.
+    start = time.time()
+    for _ in range(iterations):
+        fn(**kwargs)
+    return (time.time() - start) / iterations * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    from inbox.ignition import engine_manager
+    from inbox.models.session import new_session
+    from inbox.util.testutils import setup_test_db
+    setup_test_db()
+    engine = engine_manager.get_for_id(0)
+    db_session = new_session(engine)
+    engine.session = db_session
+    namespace_id = setup(db_session)
+
+    print '{:<28} {:>10} {:>10} {:>10}'.format('', 'unbaked', 'baked',
+                                               'saved')
+    for endpoint, fn in (('threads', filtering.threads),
+                         ('messages', filtering.messages_or_drafts)):
+        for name, overrides in COMBINATIONS:
+            kwargs = dict(COMMON_THREAD_ARGS, namespace_id=namespace_id,
+                          db_session=db_session, **overrides)
+            if endpoint == 'messages':
+                kwargs.update(drafts=False, received_before=None,
+                              received_after=None)
+            filtering.bakery = unbaked
+            before = time_calls(fn, args.iterations, **kwargs)
+            filtering.bakery = bakery
+            after = time_calls(fn, args.iterations, **kwargs)
+            print '{:<28} {:>8.2f}ms {:>8.2f}ms {:>8.2f}ms'.format(
+                '{} {}'.format(endpoint, name), before, after, before - after)
+
+
+if __name__ == '__main__':
+    main()
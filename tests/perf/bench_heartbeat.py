@@ -0,0 +1,141 @@
+"""
+Benchmark for bulk heartbeat operations at fleet scale.
+
+Publishes heartbeats for --accounts accounts with --folders folders each
+(a few of them dead), then times each bulk operation in HeartbeatStore
+against the per-account way of doing the same thing, and counts the Redis
+round trips (commands sent on their own, or pipelines executed) each takes:
+
+* index:  maintaining the account index (oldest heartbeat per account)
+* dead:   finding the folders without a heartbeat for ALIVE_EXPIRY seconds
+          (per-account: get_ping_status() for every account)
+* remove: removing every folder of every account
+
+By default the operations run against mockredis, where round trips are
+free, so the round trip counts matter more than the times. Pass --host to
+run against a real Redis instead (its status database is flushed!).
+
+Usage: INBOX_ENV=test python -m tests.perf.bench_heartbeat [--accounts N]
+       [--folders N] [--host HOST]
+"""
+import time
+import argparse
+
+from mockredis import mock_strict_redis_client
+from redis import StrictRedis
+
+import inbox.heartbeat.config as heartbeat_config
+from inbox.heartbeat.config import ALIVE_EXPIRY, STATUS_DATABASE
+from inbox.heartbeat.status import get_ping_status
+from inbox.heartbeat.store import HeartbeatStore, HeartbeatStatusKey
+
+
+class CountingClient(object):
+    """ Counts the round trips made through a Redis client. """
+
+    def __init__(self, client):
+        self.client = client
+        self.round_trips = 0
+
+    def pipeline(self, *args, **kwargs):
+        pipe = self.client.pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def counting_execute(*args, **kwargs):
+            self.round_trips += 1
+            return execute(*args, **kwargs)
+        pipe.execute = counting_execute
+        return pipe
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def counting(*args, **kwargs):
+            self.round_trips += 1
+            return attr(*args, **kwargs)
+        return counting
+
+
+def populate(store, accounts, folders):
+    now = time.time()
+    heartbeats = []
+    for account_id in range(1, accounts + 1):
+        for folder_id in range(1, folders + 1):
+            # One account in a hundred has a dead folder.
+            dead = account_id % 100 == 0 and folder_id == 1
+            heartbeats.append((HeartbeatStatusKey(account_id, folder_id),
+                               now - ALIVE_EXPIRY * 2 if dead else now))
+    store.publish_many(heartbeats)
+
+
+def index_per_account(store, client, account_ids):
+    for account_id in account_ids:
+        _, oldest = client.zrange(account_id, 0, 0, withscores=True)[0]
+        client.zadd('account_index', oldest, account_id)
+
+
+def dead_per_account(store, client, account_ids):
+    return {account_id: [f for f in ping.folders if not f.alive]
+            for account_id, ping in get_ping_status(account_ids).items()
+            if any(not f.alive for f in ping.folders)}
+
+
+def remove_per_account(store, client, account_ids):
+    for account_id in account_ids:
+        for folder_id in client.zrange(account_id, 0, -1):
+            store.remove(HeartbeatStatusKey(account_id, folder_id))
+        store.remove_from_account_index(account_id, client)
+
+
+def run(name, func, client):
+    client.round_trips = 0
+    start = time.time()
+    result = func()
+    elapsed = time.time() - start
+    print '{:<22} {:>9.2f}s {:>14}'.format(name, elapsed, client.round_trips)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--accounts', type=int, default=100000)
+    parser.add_argument('--folders', type=int, default=5)
+    parser.add_argument('--host', default=None)
+    args = parser.parse_args()
+
+    if args.host is None:
+        raw_client = mock_strict_redis_client()
+    else:
+        raw_client = StrictRedis(args.host, heartbeat_config.REDIS_PORT,
+                                 STATUS_DATABASE)
+    raw_client.flushdb()
+    client = CountingClient(raw_client)
+    heartbeat_config.get_redis_client = lambda account_id: client
+    heartbeat_config.REDIS_SHARDS = [args.host]
+    store = HeartbeatStore.store()
+    account_ids = range(1, args.accounts + 1)
+
+    populate(store, args.accounts, args.folders)
+
+    print '{:<22} {:>10} {:>14}'.format('', 'time', 'round trips')
+    run('index per account',
+        lambda: index_per_account(store, client, account_ids), client)
+    run('index bulk',
+        lambda: store.update_accounts_index_many(account_ids), client)
+    expected = run('dead per account',
+                   lambda: dead_per_account(store, client, account_ids),
+                   client)
+    cutoff = time.time() - ALIVE_EXPIRY
+    found = run('dead bulk', lambda: store.get_dead_folders(cutoff), client)
+    assert sorted(found) == sorted(expected)
+
+    run('remove per account',
+        lambda: remove_per_account(store, client, account_ids), client)
+    populate(store, args.accounts, args.folders)
+    run('remove bulk', lambda: store.remove_accounts(account_ids), client)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Benchmark for writing the transaction log on flush.
+
+Commits 1,000 new threads, then an update to each of them, then their
+deletion, and times each commit. This is done once with the revision engine
+in inbox.models.transaction, and once with the previous implementation, which
+walked the whole session and added one ORM Transaction object per revision.
+
+Usage: INBOX_ENV=test python -m tests.perf.bench_revisions [--objects N]
+"""
+import time
+import argparse
+from datetime import datetime
+
+from inbox.models import Transaction, Thread
+from inbox.models import transaction
+from inbox.models.mixins import HasRevisions
+from tests.util.base import make_default_account, make_config
+
+
+def orm_create_revisions(session):
+    for obj in session:
+        if (not isinstance(obj, HasRevisions) or
+                obj.should_suppress_transaction_creation):
+            continue
+        if obj in session.new:
+            command = 'insert'
+        elif ((obj in session.dirty and obj.has_versioned_changes()) or
+              getattr(obj, 'dirty', False)):
+            obj.dirty = False
+            command = 'update'
+        elif obj in session.deleted:
+            command = 'delete'
+        else:
+            continue
+        session.add(Transaction(command=command, record_id=obj.id,
+                                object_type=obj.API_OBJECT_NAME,
+                                object_public_id=obj.public_id,
+                                namespace_id=obj.namespace.id))
+
+
+def timed_commit(db_session):
+    start = time.time()
+    db_session.commit()
+    return (time.time() - start) * 1000
+
+
+def run(engine, namespace_id, count):
+    from inbox.models.session import new_session
+    db_session = new_session(engine)
+    threads = []
+    now = datetime.utcnow()
+    for i in range(count):
+        thread = Thread(namespace_id=namespace_id,
+                        subject='Thread {}'.format(i),
+                        subjectdate=now, recentdate=now)
+        db_session.add(thread)
+        threads.append(thread)
+    insert = timed_commit(db_session)
+
+    for thread in threads:
+        thread.subject = 'Updated'
+    update = timed_commit(db_session)
+
+    for thread in threads:
+        db_session.delete(thread)
+    delete = timed_commit(db_session)
+    db_session.close()
+    return insert, update, delete
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--objects', type=int, default=1000)
+    args = parser.parse_args()
+
+    from inbox.ignition import engine_manager
+    from inbox.models.session import new_session
+    from inbox.util.testutils import setup_test_db
+    setup_test_db()
+    engine = engine_manager.get_for_id(0)
+    db_session = new_session(engine)
+    engine.session = db_session
+    account = make_default_account(engine, make_config())
+    namespace_id = account.namespace.id
+    db_session.close()
+
+    print '{:<10} {:>12} {:>12} {:>12}'.format('', 'insert', 'update',
+                                               'delete')
+    bulk = transaction.create_revisions
+    # Sessions look up create_revisions when they're created, so swapping
+    # the module attribute is enough to switch implementations.
+    for name, fn in (('orm', orm_create_revisions), ('bulk', bulk)):
+        transaction.create_revisions = fn
+        try:
+            timings = run(engine, namespace_id, args.objects)
+        finally:
+            transaction.create_revisions = bulk
+        print '{:<10} {:>10.1f}ms {:>10.1f}ms {:>10.1f}ms'.format(
+            name, *timings)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Memory benchmark for scanning every message in a large namespace.
+
+Fills a namespace in the test database with --messages messages (copies of
+one fake message, inserted in bulk), then reads the g_msgid of every message
+in three ways, each in a fresh child process so that peak memory use can be
+compared:
+
+* all:    session.query(Message.g_msgid).filter(...).all(), which is what
+          g_msgids() used to do for large inputs
+* orm:    keyset_scan over Message entities
+* column: keyset_scan over (Message.id, Message.g_msgid)
+
+Usage: INBOX_ENV=test python -m tests.perf.bench_scan [--messages N]
+"""
+import time
+import resource
+import argparse
+import multiprocessing
+
+from sqlalchemy import select
+
+from inbox.models import Message
+from inbox.sqlalchemy_ext.util import keyset_scan
+from tests.util.base import (make_default_account, add_fake_thread,
+                             add_fake_message, make_config)
+
+INSERT_BATCH_SIZE = 10000
+
+
+def populate(engine, db_session, count):
+    account = make_default_account(engine, make_config())
+    namespace_id = account.namespace.id
+    thread = add_fake_thread(db_session, namespace_id)
+    template = add_fake_message(db_session, namespace_id, thread, g_msgid=0)
+
+    table = Message.__table__
+    row = dict(engine.execute(
+        select([table]).where(table.c.id == template.id)).first())
+    del row['id']
+    del row['public_id']
+    for start in range(1, count, INSERT_BATCH_SIZE):
+        end = min(start + INSERT_BATCH_SIZE, count)
+        engine.execute(table.insert(), [dict(row, g_msgid=i)
+                                        for i in range(start, end)])
+    return namespace_id
+
+
+def scan(variant, namespace_id, results):
+    from inbox.ignition import engine_manager
+    from inbox.models.session import new_session
+    engine = engine_manager.get_for_id(namespace_id)
+    # Don't reuse the parent's connections.
+    engine.dispose()
+    db_session = new_session(engine, versioned=False)
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    if variant == 'all':
+        query = db_session.query(Message.g_msgid). \
+            filter(Message.namespace_id == namespace_id)
+        count = sum(1 for _ in query.all())
+    elif variant == 'orm':
+        query = db_session.query(Message). \
+            filter(Message.namespace_id == namespace_id)
+        count = sum(1 for message in keyset_scan(query, Message.id,
+                                                 window=10000)
+                    if message.g_msgid is not None)
+    else:
+        query = db_session.query(Message.id, Message.g_msgid). \
+            filter(Message.namespace_id == namespace_id)
+        count = sum(1 for _ in keyset_scan(query, Message.id, window=10000))
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    db_session.close()
+    results.put((variant, count, elapsed, (peak - baseline) / 1024.))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=2000000)
+    args = parser.parse_args()
+
+    from inbox.ignition import engine_manager
+    from inbox.models.session import new_session
+    from inbox.util.testutils import setup_test_db
+    setup_test_db()
+    engine = engine_manager.get_for_id(0)
+    db_session = new_session(engine)
+    engine.session = db_session
+    namespace_id = populate(engine, db_session, args.messages)
+    db_session.close()
+    engine.dispose()
+
+    print '{:<8} {:>10} {:>10} {:>14}'.format('', 'rows', 'time',
+                                              'peak memory')
+    for variant in ('all', 'orm', 'column'):
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=scan, args=(variant, namespace_id, results))
+        process.start()
+        variant, count, elapsed, peak_mb = results.get()
+        process.join()
+        print '{:<8} {:>10} {:>9.1f}s {:>12.1f}MB'.format(
+            variant, count, elapsed, peak_mb)
+
+
+if __name__ == '__main__':
+    main()
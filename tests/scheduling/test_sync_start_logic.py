@@ -1,14 +1,19 @@
 import json
+import time
 import mockredis
 import mock
 import pytest
 import platform
+from mockredis import mock_strict_redis_client
+from sqlalchemy.exc import OperationalError
+from inbox.heartbeat.store import HeartbeatStore, HeartbeatStatusKey
 from inbox.ignition import engine_manager
 from inbox.mailsync.frontend import HTTPFrontend
 from inbox.mailsync.service import (SyncService, NOMINAL_THRESHOLD,
                                     NUM_CPU_SAMPLES)
 from inbox.models import Account
 from inbox.models.session import session_scope_by_shard_id
+from inbox.scheduling.cost import NEW_ACCOUNT_COST, account_cost
 from inbox.scheduling.queue import QueueClient, QueuePopulator
 from tests.util.base import add_generic_imap_account
 
@@ -343,3 +348,158 @@ def test_sync_stop_after_restart_selectively_overwrites_sync_states(
     account = db.session.query(Account).get(default_account.id)
     assert account.sync_host is None
     assert account.sync_state == 'stopped'
+
+
+def test_account_cost_estimates():
+    assert account_cost(None, []) == NEW_ACCOUNT_COST
+    idle = account_cost('running', [('poll', {'remote_uid_count': 1000}),
+                                    ('finish', {})])
+    syncing = account_cost('running',
+                           [('initial', {'remote_uid_count': 1000000}),
+                            ('poll', {'remote_uid_count': 1000})])
+    assert 1 <= idle < 2
+    assert syncing > 50 * idle
+
+
+def test_claims_fit_remaining_capacity(mock_queue_client):
+    for key, cost in [(1, 5), (2, 40), (3, 100)]:
+        mock_queue_client.enqueue(key, cost)
+    # The costliest account that fits is claimed.
+    assert mock_queue_client.claim_next('p', budget=50) == '2'
+    assert mock_queue_client.claim_next('p', budget=50) == '1'
+    assert mock_queue_client.claim_next('p', budget=50) is None
+    # An idle process takes accounts that don't fit at all.
+    assert mock_queue_client.claim_next('q', budget=50, idle=True) == '3'
+    assert mock_queue_client.assigned() == {1: 'p', 2: 'p', 3: 'q'}
+    assert mock_queue_client.qsize() == 0
+
+
+def test_dont_claim_accounts_over_capacity(monkeypatch, db, config,
+                                           mock_queue_client):
+    monkeypatch.setattr('psutil.cpu_percent',
+                        lambda *args, **kwargs: [10.0, 25.0])
+    config['SYNC_STEAL_ACCOUNTS'] = True
+    purge_other_accounts()
+    accounts = [add_generic_imap_account(
+        db.session, email_address='{}@example.com'.format(i))
+        for i in range(3)]
+    s = patched_sync_service(db, mock_queue_client)
+    s.capacity = 100
+    for account, cost in zip(accounts, [60, 30, 50]):
+        mock_queue_client.enqueue(account.id, cost)
+
+    for _ in range(3):
+        s.poll()
+    assert s.syncing_accounts == {accounts[0].id, accounts[1].id}
+    assert mock_queue_client.qsize() == 1
+
+
+def test_overloaded_process_hands_off_hottest_account(
+        monkeypatch, db, config, mock_queue_client):
+    monkeypatch.setattr('psutil.cpu_percent',
+                        lambda *args, **kwargs: [10.0, 25.0])
+    config['SYNC_STEAL_ACCOUNTS'] = True
+    purge_other_accounts()
+    accounts = [add_generic_imap_account(
+        db.session, email_address='{}@example.com'.format(i))
+        for i in range(3)]
+    s1 = patched_sync_service(db, mock_queue_client, process_number=0)
+    s2 = patched_sync_service(db, mock_queue_client, process_number=1)
+    for account in accounts:
+        mock_queue_client.enqueue(account.id, 10)
+    for _ in range(3):
+        s1.poll()
+    assert len(s1.syncing_accounts) == 3
+
+    # Two accounts turn out to be much costlier than estimated; another
+    # process has room for one of them.
+    mock_queue_client.set_costs({accounts[0].id: 120, accounts[1].id: 400})
+    s2.poll()
+    s1.poll()
+    s1.handoff_greenlet.join()
+    assert accounts[0].id not in s1.syncing_accounts
+    s2.poll()
+    assert s2.syncing_accounts == {accounts[0].id}
+
+    # Handoffs are rate-limited.
+    s1.poll()
+    assert s1.syncing_accounts == {accounts[1].id, accounts[2].id}
+
+
+def test_incremental_queue_population(monkeypatch, db, config,
+                                      mock_queue_client):
+    monkeypatch.setattr('psutil.cpu_percent',
+                        lambda *args, **kwargs: [10.0, 25.0])
+    config['SYNC_STEAL_ACCOUNTS'] = True
+    purge_other_accounts()
+    account = add_generic_imap_account(db.session,
+                                       email_address='test@example.com')
+    qp = QueuePopulator(zone='testzone')
+    qp.queue_client = mock_queue_client
+    qp.reconcile()
+    assert mock_queue_client.all() == {account.id}
+
+    # Only changed accounts are looked at, and without fetching everything
+    # that's tracked in Redis.
+    monkeypatch.setattr(mock_queue_client, 'all', mock.Mock())
+    other_account = add_generic_imap_account(
+        db.session, email_address='test2@example.com')
+    qp.apply_changes()
+    assert mock_queue_client.tracked([account.id, other_account.id]) == \
+        {account.id, other_account.id}
+
+    s = patched_sync_service(db, mock_queue_client)
+    s.poll()
+    s.poll()
+    assert s.syncing_accounts == {account.id, other_account.id}
+
+    account.mark_deleted()
+    db.session.commit()
+    qp.apply_changes()
+    s.poll()
+    assert s.syncing_accounts == {other_account.id}
+    assert not mock_queue_client.all.called
+
+
+def test_startup_ramp_up(monkeypatch, db, config, mock_queue_client):
+    redis = mock_strict_redis_client()
+    monkeypatch.setattr('inbox.heartbeat.config.get_redis_client',
+                        lambda *args, **kwargs: redis)
+    purge_other_accounts()
+    accounts = [add_generic_imap_account(
+        db.session, email_address='{}@example.com'.format(i))
+        for i in range(3)]
+    s = patched_sync_service(db, mock_queue_client)
+    for account in accounts:
+        mock_queue_client.enqueue(account.id)
+        mock_queue_client.claim_next(s.process_identifier)
+    # The first account synced most recently, the last one never did.
+    now = time.time()
+    HeartbeatStore.store().publish_many([
+        (HeartbeatStatusKey(accounts[0].id, 1), now),
+        (HeartbeatStatusKey(accounts[1].id, 1), now - 3600)])
+
+    # Starting the first account fails.
+    start_sync = s.start_sync.side_effect
+
+    def fail_first(aid):
+        if aid == accounts[0].id:
+            raise OperationalError('', None, None)
+        start_sync(aid)
+    s.start_sync.side_effect = fail_first
+
+    s.ramp_up()
+    assert s.start_sync.call_args_list == [
+        mock.call(accounts[2].id), mock.call(accounts[1].id),
+        mock.call(accounts[0].id)]
+
+    frontend = HTTPFrontend(s, 16384, False, False)
+    app = frontend._create_app()
+    app.config['TESTING'] = True
+    with app.test_client() as c:
+        progress = json.loads(c.get('/startup').data)
+    assert progress['state'] == 'done'
+    assert progress['total'] == 3
+    assert progress['started'] == 2
+    assert progress['failed'] == 1
+    assert not s.ramping_accounts
@@ -1,3 +1,4 @@
+import time
 import random
 
 import pytest
@@ -6,9 +7,10 @@ import gevent
 from inbox.ignition import engine_manager
 from inbox.models.session import session_scope, session_scope_by_shard_id
 from inbox.models.action_log import ActionLog, schedule_action
-from inbox.transactions.actions import SyncbackService
+from inbox.transactions.actions import SyncbackService, ACTION_FUNCTION_MAP
 
-from tests.util.base import add_generic_imap_account
+from tests.util.base import (add_generic_imap_account, add_fake_thread,
+                             add_fake_message)
 
 
 @pytest.fixture
@@ -132,6 +134,92 @@ def test_actions_claimed_by_a_single_service(purge_accounts_and_actions,
         assert service.task_queue.peek().action_log_ids() == [actionlogs[i]]
 
 
+def test_actions_are_ordered_per_object(purge_accounts_and_actions):
+    with session_scope_by_shard_id(0) as db_session:
+        account = add_generic_imap_account(
+            db_session, email_address='person@test.com')
+        namespace_id = account.namespace.id
+        thread = add_fake_thread(db_session, namespace_id)
+        first, second = [add_fake_message(db_session, namespace_id, thread)
+                         for _ in range(2)]
+        schedule_action('mark_unread', first, namespace_id, db_session,
+                        unread=True)
+        schedule_action('mark_starred', second, namespace_id, db_session,
+                        starred=True)
+        schedule_action('mark_unread', first, namespace_id, db_session,
+                        unread=False)
+        schedule_test_action(db_session, account)
+        schedule_action('mark_starred', second, namespace_id, db_session,
+                        starred=False)
+        db_session.commit()
+        ids = [entry.id for entry in
+               db_session.query(ActionLog).order_by(ActionLog.id)]
+
+        service = SyncbackService(
+            syncback_id=0, process_number=0, total_processes=1,
+            num_workers=2)
+
+        def batches():
+            entries = db_session.query(ActionLog).filter(
+                ActionLog.status == 'pending').order_by(ActionLog.id)
+            return [task.action_log_ids() for task in
+                    service._batch_log_entries(db_session, entries.all())]
+
+        # Actions on different messages can run concurrently, but the
+        # folder creation has to wait for them.
+        assert batches() == [[ids[0], ids[2]], [ids[1]]]
+
+        # While the first action is running, the other one on the same
+        # message is held back.
+        service.running_action_ids = {ids[0]}
+        assert batches() == [[ids[1]]]
+
+        # The folder creation runs alone once they're done, and the action
+        # after it waits for it.
+        service.running_action_ids = set()
+        for entry in db_session.query(ActionLog).filter(
+                ActionLog.id.in_(ids[:3])):
+            entry.status = 'successful'
+        db_session.commit()
+        assert batches() == [[ids[3]]]
+        assert batches() == []
+
+
+def test_failed_actions_are_deferred(purge_accounts_and_actions, monkeypatch):
+    def fail(*args):
+        raise Exception('Provider is having issues')
+    monkeypatch.setitem(ACTION_FUNCTION_MAP, 'create_folder', fail)
+
+    with session_scope_by_shard_id(0) as db_session:
+        account = add_generic_imap_account(
+            db_session, email_address='person@test.com')
+        schedule_test_action(db_session, account)
+        entry = db_session.query(ActionLog).one()
+
+        service = SyncbackService(
+            syncback_id=0, process_number=0, total_processes=1,
+            num_workers=2, retry_interval=10)
+
+        def claim():
+            db_session.expire_all()
+            entries = db_session.query(ActionLog).filter(
+                ActionLog.status == 'pending').all()
+            return service._batch_log_entries(db_session, entries)
+
+        task, = claim()
+        task.execute()
+        service.notify_worker_finished(task.action_log_ids())
+        db_session.expire_all()
+        assert entry.retries == 1 and entry.status == 'pending'
+        # It's retried after 5-10 seconds, not before.
+        assert 5 <= service.retry_at[entry.id] - time.time() <= 10
+        assert claim() == []
+
+        service.retry_at[entry.id] = time.time()
+        task, = claim()
+        assert entry.id not in service.retry_at
+
+
 @pytest.mark.skipif(True, reason='Test if causing Jenkins build to fail')
 def test_actions_for_invalid_accounts_are_skipped(purge_accounts_and_actions,
                                                   patched_task):
@@ -172,3 +260,54 @@ def test_actions_for_invalid_accounts_are_skipped(purge_accounts_and_actions,
             ActionLog.namespace_id == another_namespace_id)
         assert q.filter(ActionLog.status == 'pending').count() == 0
         assert q.filter(ActionLog.status == 'successful').count() == another_count
+
+
+def test_half_open_breaker_lets_one_action_through(purge_accounts_and_actions,
+                                                   monkeypatch):
+    import socket
+    from inbox.util.circuit_breaker import CircuitBreaker, OPEN
+    calls = []
+
+    def fail(*args):
+        calls.append(args)
+        raise socket.error('Provider is unreachable')
+    monkeypatch.setitem(ACTION_FUNCTION_MAP, 'mark_unread', fail)
+    monkeypatch.setitem(ACTION_FUNCTION_MAP, 'mark_starred', fail)
+
+    with session_scope_by_shard_id(0) as db_session:
+        account = add_generic_imap_account(
+            db_session, email_address='person@test.com')
+        namespace_id = account.namespace.id
+        thread = add_fake_thread(db_session, namespace_id)
+        messages = [add_fake_message(db_session, namespace_id, thread)
+                    for _ in range(3)]
+        # Two actions that are executed together, and an unrelated one.
+        schedule_action('mark_unread', messages[0], namespace_id, db_session,
+                        unread=True)
+        schedule_action('mark_unread', messages[1], namespace_id, db_session,
+                        unread=True)
+        schedule_action('mark_starred', messages[2], namespace_id,
+                        db_session, starred=True)
+        db_session.commit()
+        ids = [entry.id for entry in db_session.query(ActionLog)]
+
+        service = SyncbackService(
+            syncback_id=0, process_number=0, total_processes=1,
+            num_workers=2)
+        now = [0]
+        breaker = CircuitBreaker('test', reset_timeout=30,
+                                 clock=lambda: now[0])
+        breaker._open()
+        service.breaker = lambda key: breaker
+
+        entries = db_session.query(ActionLog).all()
+        assert service._batch_log_entries(db_session, entries) == []
+
+        # Once the breaker is half-open, every action is claimed, but only
+        # one of them is tried.
+        now[0] = 31
+        for task in service._batch_log_entries(db_session, entries):
+            task.execute()
+        assert len(calls) == 1
+        assert breaker.state == OPEN
+        assert set(service.retry_at) == set(ids)
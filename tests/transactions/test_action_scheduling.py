@@ -33,3 +33,25 @@ def test_action_scheduling(db, default_account):
     assert entry.extra_args == \
         dict(event_uid=event.uid, calendar_name=event.calendar.name,
              calendar_uid=event.calendar.uid)
+
+
+def test_action_notifications(db, default_account, monkeypatch):
+    from inbox.ignition import engine_manager
+    from inbox.transactions.action_notifier import ActionNotifier
+    notifier = ActionNotifier()
+    monkeypatch.setattr(
+        'inbox.transactions.action_notifier.action_notifier', notifier)
+    namespace_id = default_account.namespace.id
+    shard_id = engine_manager.shard_key_for_id(namespace_id)
+    event = add_fake_event(db.session, namespace_id)
+
+    # Nothing is published for actions that are rolled back.
+    schedule_action('create_event', event, namespace_id, db.session)
+    db.session.rollback()
+    assert notifier.receive([shard_id], timeout=0) == {}
+
+    schedule_action('create_event', event, namespace_id, db.session)
+    db.session.commit()
+    assert notifier.receive([shard_id], timeout=0) == \
+        {shard_id: {namespace_id}}
+    assert notifier.receive([shard_id], timeout=0) == {}
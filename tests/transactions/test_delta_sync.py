@@ -219,3 +219,171 @@ def test_account_delta_for_different_namespace_id(db):
     txns, _ = format_transactions_after_pointer(namespace, 0, db.session, 10,
                                                 exclude_account=False)
     assert txns
+
+
+def test_latest_transaction_cache_follows_commits(db, default_namespace,
+                                                  thread):
+    from inbox.models import Transaction
+    from inbox.transactions.cache import transaction_cache
+
+    thread.subject = 'Something new'
+    db.session.commit()
+
+    latest = db.session.query(Transaction). \
+        filter(Transaction.namespace_id == default_namespace.id). \
+        order_by(Transaction.id.desc()).first()
+    cached = transaction_cache.get_latest(default_namespace.id)
+    assert cached.id == latest.id
+    assert cached.public_id == latest.public_id
+
+
+def test_cursor_resolution_is_cached(api_client, db, default_namespace,
+                                     thread):
+    from inbox.transactions import delta_sync
+    from inbox.transactions.cache import transaction_cache
+    transaction_cache.clear()
+
+    sync_data = api_client.get_data('/delta?cursor=0')
+    cursor = sync_data['cursor_end']
+    pointer = delta_sync.get_transaction_id_for_cursor(
+        default_namespace.id, cursor, db.session)
+    assert transaction_cache.get_cursor(cursor) == (default_namespace.id,
+                                                    pointer)
+
+    # Cursors are scoped to their namespace.
+    assert delta_sync.get_transaction_id_for_cursor(
+        default_namespace.id + 1, cursor, db.session) is None
+
+    # A cached cursor doesn't need the database at all.
+    assert delta_sync.get_transaction_id_for_cursor(
+        default_namespace.id, cursor, None) == pointer
+
+
+def test_catch_up_coalesces_changes(api_client, db, default_namespace,
+                                    thread, monkeypatch):
+    from inbox.transactions import delta_sync
+    ts = int(time.time() + 22)
+    cursor = get_cursor(api_client, ts)
+
+    messages = [add_fake_message(db.session, default_namespace.id, thread)
+                for _ in range(3)]
+    message_ids = [message.public_id for message in messages]
+    for i in range(20):
+        thread.subject = 'Subject {}'.format(i)
+        db.session.commit()
+    db.session.delete(messages[0])
+    db.session.commit()
+
+    monkeypatch.setattr(delta_sync, 'CATCHUP_THRESHOLD', 10)
+    monkeypatch.setattr(delta_sync, 'CATCHUP_BATCH_SIZE', 4)
+    # Catch-up only kicks in when the first page is full.
+    sync_data = api_client.get_data('/delta?cursor={}&limit=5'.format(cursor))
+    deltas = sync_data['deltas']
+
+    # One delta per object, reflecting its final state.
+    thread_deltas = [d for d in deltas if d['object'] == 'thread']
+    assert len(thread_deltas) == 1
+    assert thread_deltas[0]['event'] == 'modify'
+    assert thread_deltas[0]['attributes']['subject'] == 'Subject 19'
+
+    message_deltas = {d['id']: d for d in deltas if d['object'] == 'message'}
+    assert len(message_deltas) == 3
+    assert message_deltas[message_ids[0]]['event'] == 'delete'
+    for message_id in message_ids[1:]:
+        assert message_deltas[message_id]['event'] == 'create'
+
+    assert sync_data['cursor_end'] == deltas[-1]['cursor']
+
+
+def test_catch_up_pages_report_creates(api_client, db, default_namespace,
+                                       thread, monkeypatch):
+    from inbox.transactions import delta_sync
+    ts = int(time.time() + 22)
+    cursor = get_cursor(api_client, ts)
+
+    messages = [add_fake_message(db.session, default_namespace.id, thread)
+                for _ in range(2)]
+    # The first message's last change comes after the second's creation.
+    for _ in range(5):
+        messages[0].is_read = not messages[0].is_read
+        db.session.commit()
+
+    monkeypatch.setattr(delta_sync, 'CATCHUP_THRESHOLD', 3)
+    events = {}
+    while True:
+        sync_data = api_client.get_data(
+            '/delta?cursor={}&limit=1&exclude_types=thread'.format(cursor))
+        if not sync_data['deltas']:
+            break
+        for delta in sync_data['deltas']:
+            events.setdefault(delta['id'], []).append(delta['event'])
+        cursor = sync_data['cursor_end']
+
+    for message in messages:
+        assert events[message.public_id][0] == 'create'
+
+
+def test_catch_up_reads_backlog_once(api_client, db, default_namespace,
+                                     thread, monkeypatch):
+    from inbox.models import Transaction
+    from inbox.transactions import delta_sync
+    ts = int(time.time() + 22)
+    cursor = get_cursor(api_client, ts)
+    pointer = delta_sync.get_transaction_id_for_cursor(
+        default_namespace.id, cursor, db.session)
+    messages = [add_fake_message(db.session, default_namespace.id, thread)
+                for _ in range(30)]
+    total = db.session.query(Transaction).filter(
+        Transaction.namespace_id == default_namespace.id,
+        Transaction.id > pointer).count()
+
+    monkeypatch.setattr(delta_sync, 'CATCHUP_THRESHOLD', 3)
+    scans = []
+    coalesce = delta_sync._coalesce_transactions_after_pointer
+
+    def recording_coalesce(*args, **kwargs):
+        result = coalesce(*args, **kwargs)
+        scans.append(result[2])
+        return result
+    monkeypatch.setattr(delta_sync, '_coalesce_transactions_after_pointer',
+                        recording_coalesce)
+
+    limit = 5
+    created = set()
+    while True:
+        sync_data = api_client.get_data('/delta?cursor={}&limit={}'.format(
+            cursor, limit))
+        if not sync_data['deltas']:
+            break
+        created.update(d['id'] for d in sync_data['deltas']
+                       if d['object'] == 'message' and d['event'] == 'create')
+        cursor = sync_data['cursor_end']
+
+    assert created == {message.public_id for message in messages}
+    assert scans
+    # Each scan reads at most twice what it coalesces, plus about a page,
+    # rather than the rest of the backlog.
+    assert sum(scans) <= 2 * total + len(scans) * limit
+
+
+def test_batched_formatting_filters_types(db, default_namespace):
+    from sqlalchemy import func
+    from inbox.models import Transaction
+    from inbox.transactions.delta_sync import \
+        format_transactions_for_namespaces
+    pointer = db.session.query(func.max(Transaction.id)).filter(
+        Transaction.namespace_id == default_namespace.id).scalar() or 0
+    default_namespace.account.sync_state = 'invalid'
+    db.session.commit()
+
+    namespaces = {default_namespace.id: default_namespace}
+    pointers = {default_namespace.id: pointer}
+    # Account changes are excluded by default, so they aren't changes.
+    assert format_transactions_for_namespaces(
+        namespaces, pointers, db.session, 100) == {}
+
+    results = format_transactions_for_namespaces(
+        namespaces, pointers, db.session, 100, exclude_account=False)
+    deltas, new_pointer = results[default_namespace.id]
+    assert [d['object'] for d in deltas] == ['account']
+    assert new_pointer > pointer
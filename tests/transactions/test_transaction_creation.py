@@ -3,7 +3,7 @@ from datetime import datetime
 from sqlalchemy import desc
 from flanker import mime
 
-from inbox.models import Transaction, AccountTransaction, Calendar
+from inbox.models import Transaction, AccountTransaction, Calendar, Thread
 from inbox.models.mixins import HasRevisions
 from inbox.models.util import transaction_objects
 
@@ -341,3 +341,20 @@ def test_accounttransactions(db, default_namespace):
         assert len(accounttransactions) == 2
         assert accounttransactions[1].id != accounttransaction_id
         assert accounttransactions[1].command == 'update'
+
+
+def test_revisions_are_written_in_bulk(db, default_namespace):
+    threads = [Thread(subjectdate=datetime.utcnow(),
+                      recentdate=datetime.utcnow(),
+                      namespace_id=default_namespace.id) for _ in range(10)]
+    db.session.add_all(threads)
+    db.session.flush()
+    # Revisions are written by the flush itself rather than being added to
+    # the session.
+    assert not any(isinstance(obj, Transaction) for obj in db.session)
+    for thread in threads:
+        transaction = get_latest_transaction(db.session, 'thread', thread.id,
+                                             default_namespace.id)
+        assert transaction.command == 'insert'
+        assert transaction.object_public_id == thread.public_id
+    db.session.commit()
@@ -1,10 +1,14 @@
 import random
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date
 
+import pytest
 from sqlalchemy import desc
 
 from inbox.models import Transaction
+from inbox.models.partitioning import (list_partitions, partition_table,
+                                       ensure_partitions,
+                                       drop_partitions_before)
 from inbox.models.util import purge_transactions
 
 
@@ -76,3 +80,74 @@ def test_transaction_deletion(db, default_namespace):
     latest_transaction = get_latest_transaction(db.session,
                                                 default_namespace.id)
     assert latest_transaction.id == t0.id
+
+
+def test_partition_failure_falls_back_to_deletes(db, default_namespace,
+                                                 monkeypatch):
+    def fail(conn, table):
+        raise Exception('partition lookup failed')
+    monkeypatch.setattr('inbox.models.util.is_partitioned', fail)
+
+    now = datetime.now()
+    create_transaction(db, now, default_namespace.id)
+    for i in xrange(3):
+        create_transaction(db, now - timedelta(days=31 + i),
+                           default_namespace.id)
+    query = "SELECT count(id) FROM transaction WHERE namespace_id={}".\
+        format(default_namespace.id)
+    all_transactions = db.session.execute(query).scalar()
+
+    purge_transactions(default_namespace.id >> 48, days_ago=30, now=now,
+                       partitioned=True)
+    assert db.session.execute(query).scalar() == all_transactions - 3
+
+
+@pytest.yield_fixture
+def log_table(db):
+    db.execute('CREATE TABLE partitioned_log (id BIGINT NOT NULL '
+               'AUTO_INCREMENT, created_at DATETIME NOT NULL, '
+               'PRIMARY KEY (id))')
+    yield 'partitioned_log'
+    db.execute('DROP TABLE partitioned_log')
+
+
+def test_partitioned_purge(db, log_table):
+    today = date(2016, 8, 1)
+    now = datetime(2016, 8, 1, 12)
+    for days in (0, 1, 2, 5, 40):
+        db.execute("INSERT INTO partitioned_log (created_at) VALUES ({})".
+                   format(format_datetime(now - timedelta(days=days))))
+
+    partition_table(db, log_table, today, days_ahead=2)
+    partitions = list_partitions(db, log_table)
+    # One partition per day from the oldest row up to two days from now.
+    assert len(partitions) == 43 + 1
+    assert partitions[0][0] == 'p20160622'
+    assert partitions[-2][:2] == ('p20160803', date(2016, 8, 4))
+    assert partitions[-1][:2] == ('pmax', None)
+
+    assert ensure_partitions(db, log_table, today, days_ahead=2) == []
+    assert ensure_partitions(db, log_table, today + timedelta(days=1),
+                             days_ahead=2) == ['p20160804']
+
+    expired = drop_partitions_before(db, log_table, now - timedelta(days=2),
+                                     dry_run=True)
+    assert expired[-1][:2] == ('p20160729', date(2016, 7, 30))
+    assert db.execute('SELECT count(*) FROM partitioned_log').scalar() == 5
+
+    drop_partitions_before(db, log_table, now - timedelta(days=2))
+    assert list_partitions(db, log_table)[0][0] == 'p20160730'
+    # Rows from the partial day at the cutoff are kept until its partition
+    # expires entirely.
+    assert db.execute('SELECT count(*) FROM partitioned_log').scalar() == 3
+
+
+def test_ensure_partitions_from_catch_all(db, log_table):
+    db.execute('ALTER TABLE partitioned_log DROP PRIMARY KEY, '
+               'ADD PRIMARY KEY (id, created_at) '
+               'PARTITION BY RANGE (TO_DAYS(created_at)) '
+               '(PARTITION pmax VALUES LESS THAN MAXVALUE)')
+    today = date(2016, 8, 1)
+    assert ensure_partitions(db, log_table, today, days_ahead=1) == \
+        ['p20160801', 'p20160802']
+    assert list_partitions(db, log_table)[-1][:2] == ('pmax', None)